@@ -27,6 +27,7 @@
 # **************************************************************************
 
 import os
+import atexit
 from glob import glob
 
 
@@ -44,6 +45,7 @@ def create_app(test_config=None):
                         send_json_data, send_error)
     from .utils.mail import MailManager
     from .data.data_content import DataContent
+    from .data.data_cache import ContentCache
 
     here = os.path.abspath(os.path.dirname(__file__))
     templates = [os.path.basename(f) for f in glob(os.path.join(here, 'templates', '*.html'))]
@@ -92,6 +94,34 @@ def create_app(test_config=None):
     os.makedirs(app.config['SESSIONS'], exist_ok=True)
     os.makedirs(app.config['PAGES'], exist_ok=True)
 
+    # Static files URLs include a hash of the file content ('v' argument),
+    # so browsers can keep them until the file changes
+    STATIC_FOLDERS = {'static': '', 'images.static': 'images'}
+    static_versions = {}
+
+    @app.url_defaults
+    def static_version(endpoint, values):
+        if endpoint in STATIC_FOLDERS and 'filename' in values:
+            path = os.path.join(app.static_folder, STATIC_FOLDERS[endpoint],
+                                values['filename'])
+            version = utils.file_version(path, static_versions)
+            if version:
+                values.setdefault('v', version)
+
+    @app.after_request
+    def static_cache_control(response):
+        # Only successful responses, errors (e.g. a removed file) must
+        # not be cached for a long time
+        if (response.status_code == 200
+                and flask.request.endpoint in STATIC_FOLDERS
+                and 'v' in flask.request.args):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+            response.cache_control.max_age = app.config.get('STATIC_MAX_AGE',
+                                                            365 * 24 * 3600)
+        return response
+
     # Define some content_id list that does not requires login
     NO_LOGIN_CONTENT = ['users_list',
                         'user_reset_password',
@@ -264,9 +294,19 @@ def create_app(test_config=None):
             content_kwargs = flask.request.form.to_dict()
 
         content_id = content_kwargs['content_id']
+        # Allow to skip the content cache with no_cache=1
+        noCache = content_kwargs.pop('no_cache', None) not in (None, '0', 'false')
+        cache = None if noCache else app.content_cache
+        cacheKey = None
 
         if content_id in NO_LOGIN_CONTENT or app.user.is_authenticated:
             try:
+                if cache is not None:
+                    cacheKey = app.dc.get_cache_key(**content_kwargs)
+                if cacheKey is not None:
+                    html = cache.get(cacheKey)
+                    if html is not None:
+                        return _content_response(html, 'hit')
                 kwargs = app.dc.get(**content_kwargs)
             except Exception as e:
                 import traceback
@@ -288,7 +328,11 @@ def create_app(test_config=None):
         if content_template in templates:
             kwargs['is_devel'] = app.is_devel
             kwargs['booking_types'] = app.dm.Booking.TYPES
-            return flask.render_template(content_template, **kwargs)
+            html = flask.render_template(content_template, **kwargs)
+            if cacheKey is not None:
+                cache.put(cacheKey, html)
+                return _content_response(html, 'miss')
+            return _content_response(html, 'bypass' if noCache else None)
 
         error = {
             "message": "Template '%s' not found." % content_template
@@ -296,6 +340,12 @@ def create_app(test_config=None):
         return flask.render_template('error_dialog.html', error=error)
 
 
+    def _content_response(html, cacheStatus):
+        response = flask.make_response(html)
+        if cacheStatus:
+            response.headers['X-Content-Cache'] = cacheStatus
+        return response
+
     @app.template_filter('basename')
     def basename(filename):
         return os.path.basename(filename)
@@ -323,8 +373,17 @@ def create_app(test_config=None):
 
     from emhub.data.data_manager import DataManager
     app.user = flask_login.current_user
-    app.dm = DataManager(app.instance_path, user=app.user)
+    app.dm = DataManager(app.instance_path, user=app.user,
+                         engineOptions=app.config.get('DB_ENGINE_OPTIONS', None),
+                         logOptions=app.config.get('DB_LOG_OPTIONS',
+                                                   {'buffered': True}))
+    # Write pending (buffered) logs before the process exits. Gunicorn
+    # workers do it from the worker_exit hook (see emhub.gunicorn_config)
+    atexit.register(app.dm.close_logs)
     app.dc = DataContent(app)
+    # Cache of rendered contents, disabled unless a max size is set
+    cacheBytes = app.config.get('CONTENT_CACHE_MAX_BYTES', 0)
+    app.content_cache = ContentCache(cacheBytes) if cacheBytes else None
 
     app.jinja_env.filters['booking_to_event'] = app.dc.booking_to_event
 
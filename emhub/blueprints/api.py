@@ -37,7 +37,7 @@ from flask import current_app as app
 import flask_login
 
 from emhub.utils import (datetime_from_isoformat, datetime_to_isoformat,
-                         send_json_data, send_error)
+                         send_json_data, send_error, versioned_get)
 from emhub.data import DataContent
 
 
@@ -353,17 +353,40 @@ def get_bookings():
     return filter_request(app.dm.get_bookings)
 
 
-# Shortcut method to get a range of bookings, used by the Calendar
+# Shortcut method to get a range of bookings
 @api_bp.route('/get_bookings_range', methods=['POST'])
 @flask_login.login_required
 def get_bookings_range():
     d = request.json or request.form
-    bookings = app.dm.get_bookings_range(
+    return send_json_data(app.dc.booking_events(
         datetime_from_isoformat(d['start']),
         datetime_from_isoformat(d['end'])
-    )
-    func = app.dc.booking_to_event
-    return send_json_data([func(b) for b in bookings])
+    ))
+
+
+# Data versions that calendar events depend on (see booking_to_event)
+EVENTS_VERSIONS = ['bookings', 'users', 'applications', 'resources', 'forms']
+
+
+@api_bp.route('/get_booking_events', methods=['GET'])
+@flask_login.login_required
+@versioned_get(*EVENTS_VERSIONS)
+def get_booking_events():
+    """ Events feed used by the Calendar. It returns the events of bookings
+    overlapping the requested start/end (and resource_id if given).
+    Responses have an ETag computed from the data versions, so unchanged
+    windows are answered with 304 (Not Modified) without loading bookings.
+    """
+    try:
+        # FullCalendar sends the range with the local time offset
+        start = datetime_from_isoformat(request.args['start'], keepOffset=True)
+        end = datetime_from_isoformat(request.args['end'], keepOffset=True)
+        resource_id = request.args.get('resource_id', None, type=int)
+    except Exception as e:
+        return send_error("Invalid events range: %s" % e)
+
+    return send_json_data(app.dc.booking_events(start, end,
+                                                resource=resource_id))
 
 
 @api_bp.route('/update_booking', methods=['POST'])
@@ -394,6 +417,12 @@ def get_sessions():
 @api_bp.route('/poll_sessions', methods=['POST'])
 @flask_login.login_required
 def poll_sessions():
+    """ Long-poll for pending sessions: return all of them as soon as
+    there is any, or an empty list after 'timeout' seconds (max 300).
+    """
+    params = request.get_json(silent=True) or {}
+    timeout = min(float(params.get('timeout', 60)), 300)
+    sessions = app.dm.wait_pending_sessions(timeout=timeout)
     session_folders = app.dm.get_session_folders()
 
     def _user(u):
@@ -404,25 +433,25 @@ def poll_sessions():
                     'email': u.email
                     }
 
-    while True:
-        sessions = app.dm.get_sessions(condition='status=="pending"')
-        if sessions:
-            for s in sessions:
-                b = s.booking
-                e = app.dc.booking_to_event(b)
-                data = [{
-                    'id': s.id,
-                    'name': s.name,
-                    'booking_id': s.booking_id,
-                    'start': datetime_to_isoformat(s.start),
-                    'user': _user(b.owner),
-                    'pi': _user(b.owner.get_pi()),
-                    'operator': _user(b.operator),
-                    'folder': session_folders[s.name[:3]],
-                    'title': e['title']
-                 }]
-                return send_json_data(data)
-        time.sleep(3)
+    serializer = app.dc.booking_serializer()
+    data = []
+
+    for s in sessions:
+        b = s.booking
+        e = serializer(b)
+        data.append({
+            'id': s.id,
+            'name': s.name,
+            'booking_id': s.booking_id,
+            'start': datetime_to_isoformat(s.start),
+            'user': _user(b.owner),
+            'pi': _user(b.owner.get_pi()),
+            'operator': _user(b.operator),
+            'folder': session_folders[s.name[:3]],
+            'title': e['title']
+        })
+
+    return send_json_data(data)
 
 
 @api_bp.route('/create_session', methods=['POST'])
@@ -513,6 +542,28 @@ def update_session_item():
     return handle_session_data(handle, mode="a")
 
 
+@api_bp.route('/add_session_items', methods=['POST'])
+@flask_login.login_required
+def add_session_items():
+    """ Add many items (attrs['items']) opening the session data once. """
+    def handle(session, set_id, items, **attrs):
+        session.data.add_set_items(set_id, items)
+        return {'items': {'count': len(items)}}
+
+    return handle_session_data(handle, mode="a", retry=False)
+
+
+@api_bp.route('/update_session_items', methods=['POST'])
+@flask_login.login_required
+def update_session_items():
+    """ Update many existing items opening the session data once. """
+    def handle(session, set_id, items, **attrs):
+        session.data.update_set_items(set_id, items)
+        return {'items': {'count': len(items)}}
+
+    return handle_session_data(handle, mode="a", retry=False)
+
+
 @api_bp.route('/get_session_data', methods=['POST'])
 @flask_login.login_required
 def get_session_data():
@@ -579,8 +630,9 @@ def delete_transaction():
 
 @api_bp.route('/get_forms', methods=['GET', 'POST'])
 @flask_login.login_required
+@versioned_get('forms')
 def get_forms():
-    return send_json_data([f.json() for f in app.dm.get_forms()])
+    return send_json_data(app.dm.get_forms(asJson=True))
 
 
 @api_bp.route('/create_form', methods=['POST'])
@@ -605,8 +657,9 @@ def delete_form():
 
 @api_bp.route('/get_projects', methods=['GET', 'POST'])
 @flask_login.login_required
+@versioned_get('projects')
 def get_projects():
-    return send_json_data([p.json() for p in app.dm.get_projects()])
+    return send_json_data(app.dm.get_projects(asJson=True))
 
 
 @api_bp.route('/create_project', methods=['POST'])
@@ -631,8 +684,9 @@ def delete_project():
 
 @api_bp.route('/get_entries', methods=['GET', 'POST'])
 @flask_login.login_required
+@versioned_get('entries')
 def get_entries():
-    return send_json_data([p.json() for p in app.dm.get_entries()])
+    return filter_request(app.dm.get_entries)
 
 
 @api_bp.route('/create_entry', methods=['POST'])
@@ -681,8 +735,9 @@ def delete_entry():
 
 @api_bp.route('/get_pucks', methods=['GET', 'POST'])
 @flask_login.login_required
+@versioned_get('pucks')
 def get_pucks():
-    return send_json_data([p.json() for p in app.dm.get_pucks()])
+    return filter_request(app.dm.get_pucks)
 
 
 @api_bp.route('/create_puck', methods=['POST'])
@@ -703,22 +758,46 @@ def delete_puck():
     return handle_puck(app.dm.delete_puck)
 
 
-# -------------------- UTILS functions ----------------------------------------
+# ------------------------------ LOGS ---------------------------------
 
-def filter_request(func):
-    condition = request.json.get('condition', None)
-    orderBy = request.json.get('orderBy', None)
+@api_bp.route('/get_log_stats', methods=['GET', 'POST'])
+@flask_login.login_required
+def get_log_stats():
+    """ Metrics of the logs writer (queue depth, flush latency). """
+    if not app.user.is_manager:
+        return send_error("Only managers can access logs metrics.")
+    return send_json_data(app.dm.get_log_stats())
 
-    items = func(condition=condition, orderBy=orderBy,
-                 asJson=True)
 
-    if 'attrs' in request.json:
-        attrs = request.json['attrs']
+@api_bp.route('/get_content_cache_stats', methods=['GET', 'POST'])
+@flask_login.login_required
+def get_content_cache_stats():
+    """ Metrics of the rendered content cache (size, hits, misses). """
+    if not app.user.is_manager:
+        return send_error("Only managers can access content cache metrics.")
+    cache = app.content_cache
+    return send_json_data(cache.get_stats() if cache is not None
+                          else {'enabled': False})
+
 
-        def _filter(s):
-            return {k: v for k, v in s.items()
-                    if not attrs or k in attrs}
-        items = [_filter(s) for s in items]
+# -------------------- UTILS functions ----------------------------------------
+
+def filter_request(func):
+    """ Return the items from func filtered by the request parameters:
+    condition, orderBy, attrs and the keyset pagination ones:
+    limit and after_id (the last id from the previous page).
+    """
+    params = request.get_json(silent=True) or {}
+    kwargs = {k: params[k] for k in ['limit', 'after_id']
+              if params.get(k, None) is not None}
+
+    try:
+        items = func(condition=params.get('condition', None),
+                     orderBy=params.get('orderBy', None),
+                     asJson=True, attrs=params.get('attrs', None),
+                     **kwargs)
+    except Exception as e:
+        return send_error('ERROR from Server: %s' % e)
 
     return send_json_data(items)
 
@@ -757,8 +836,9 @@ def handle_booking(result_key, booking_func, booking_transform=None):
 
         fix_dates(attrs, *dates)
 
-        bt = booking_transform or app.dc.booking_to_event
-        return [bt(b) for b in booking_func(**attrs)]
+        bookings = booking_func(**attrs)
+        bt = booking_transform or app.dc.booking_serializer()
+        return [bt(b) for b in bookings]
 
     return _handle_item(handle, result_key)
 
@@ -788,6 +868,7 @@ def handle_application(application_func):
 def handle_resource(resource_func):
     def handle(**attrs):
         r = resource_func(**attrs)
+        saved = False
 
         for f in request.files:
             file = request.files[f]
@@ -797,6 +878,13 @@ def handle_resource(resource_func):
                 old_files = glob(app.dm.get_resource_image_path(r, '*'))
                 clean_files(old_files)
                 file.save(app.dm.get_resource_image_path(r, fn))
+                # Generate the thumbnail now, not on the first page load
+                app.dm.get_resource_thumbnail(r)
+                saved = True
+
+        # Cached contents showing the image must be updated
+        if saved:
+            app.dm.bump_data_version('resources')
         return r.json()
 
     return _handle_item(handle, 'resource')
@@ -810,23 +898,32 @@ def handle_session(session_func):
     return _handle_item(handle, 'session')
 
 
-def handle_session_data(handle, mode="r"):
+def handle_session_data(handle, mode="r", retry=True):
+    """ Open the session data and call handle with it, retrying up to
+    3 times on OSError. If retry is False, only opening the data is
+    retried, not the handle (e.g. batch writes might be partially done).
+    """
     attrs = request.json['attrs']
     session_id = attrs.pop("session_id")
     set_id = attrs.pop("set_id", None)
     tries = 0
+    result = {}
 
     while tries < 3:
+        session = None
         try:
             session = app.dm.load_session(sessionId=session_id, mode=mode)
             result = handle(session, set_id, **attrs)
-            session.data.close()
             break
         except OSError:
+            if session is not None and not retry:
+                raise
             print("Error with session data, sleeping 3 secs")
             time.sleep(3)
-            result = {}
             tries += 1
+        finally:
+            if session is not None:
+                session.data.close()
 
     return send_json_data(result)
 
@@ -35,11 +35,13 @@ import flask
 from flask import request
 from flask import current_app as app
 
-from emhub.utils import send_json_data
+from emhub.utils import send_json_data, not_modified
 
 
 images_bp = flask.Blueprint('images', __name__)
 
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600  # seconds
+
 
 @images_bp.route("/static", methods=['GET', 'POST'])
 def static():
@@ -52,6 +54,16 @@ def static():
 
 @images_bp.route("/user_profile", methods=['GET', 'POST'])
 def user_profile():
+    """ Serve the user profile image. The 'v' argument (image name and
+    modification time) changes with the image, so browsers can keep it
+    and revalidate it without any database query.
+    """
+    etag = request.args.get('v', None)
+    if etag:
+        resp = not_modified(etag)
+        if resp is not None:
+            return resp
+
     try:
         user_id = request.args['user_id']
         user = app.dm.get_user_by(id=user_id)
@@ -59,12 +71,50 @@ def user_profile():
         if user.profile_image is None:
             return app.send_static_file(os.path.join('images', 'user-icon.png'))
 
-        return flask.send_from_directory(app.config["USER_IMAGES"],
-                                         filename=user.profile_image)
+        resp = flask.send_from_directory(app.config["USER_IMAGES"],
+                                         user.profile_image)
+        if etag:
+            resp.set_etag(etag)
+        return resp
     except FileNotFoundError:
         flask.abort(404)
 
 
+@images_bp.route("/resource_thumbnail", methods=['GET'])
+def resource_thumbnail():
+    """ Serve the resource image thumbnail. The 'v' argument (image
+    modification time) changes with the image, so the thumbnail can be
+    cached by browsers for a long time.
+    """
+    resourceId = request.args.get('resource_id', type=int)
+    if resourceId is None:
+        flask.abort(400)
+
+    # The ETag is only a valid validator when it includes the version
+    version = request.args.get('v', None)
+    etag = None if version is None else 'thumb-%s-%s' % (resourceId, version)
+    if etag:
+        resp = not_modified(etag)
+        if resp is not None:
+            return resp
+
+    resource = app.dm.get_resource_by(id=resourceId)
+    if resource is None:
+        flask.abort(404)
+
+    thumbPath, _ = app.dm.get_resource_thumbnail(resource)
+    if thumbPath is None:
+        flask.abort(404)
+
+    response = flask.send_file(thumbPath, mimetype='image/png')
+    if etag:
+        response.set_etag(etag)
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = THUMBNAIL_MAX_AGE
+    return response
+
+
 @images_bp.route("/get_mic_data", methods=['POST'])
 def get_mic_data():
     micId = int(request.form['micId'])
@@ -143,7 +143,37 @@ class DataClient:
         """
         return self._method('update_session_item', 'item', attrs)
 
+    def add_session_items(self, attrs, chunkSize=100):
+        """ Add many items to a set in the session, sending them in
+        requests of chunkSize items.
+        Mandatory in attrs:
+            session_id: the id of the session
+            set_id: the id of the set
+            items: list of items (dicts with the 'item_id' and attributes)
+        """
+        return self._items_method('add_session_items', attrs, chunkSize)
+
+    def update_session_items(self, attrs, chunkSize=100):
+        """ Update many existing items in the set in the session, sending
+        them in requests of chunkSize items.
+        Mandatory in attrs:
+            session_id: the id of the session
+            set_id: the id of the set
+            items: list of items (dicts with the 'item_id' and attributes)
+        """
+        return self._items_method('update_session_items', attrs, chunkSize)
+
     #---------------------- Internal functions ------------------------------
+    def _items_method(self, method, attrs, chunkSize):
+        """ Call the method with chunks of the items in attrs,
+        return the number of items processed. """
+        items = list(attrs['items'])
+        count = 0
+        for i in range(0, len(items), chunkSize):
+            chunkAttrs = dict(attrs, items=items[i:i + chunkSize])
+            count += self._method(method, 'items', chunkAttrs)['count']
+        return count
+
     def _method(self, method, resultKey, attrs, condition=None):
         r = self.request(method,
                          jsonData={'attrs': attrs,
@@ -166,11 +196,30 @@ class DataClient:
         self.r.raise_for_status()
         return self.r
 
-    def get(self, name, condition=None, orderBy=None, attrs=None):
+    def get(self, name, condition=None, orderBy=None, attrs=None,
+            limit=None, after_id=None):
         return self.request('get_%s' % name,
                             jsonData={'condition': condition,
                                       'orderBy': orderBy,
-                                      'attrs': attrs})
+                                      'attrs': attrs,
+                                      'limit': limit,
+                                      'after_id': after_id})
+
+    def iter_items(self, name, condition=None, attrs=None, limit=500):
+        """ Iterate over all items from a get_* listing, requesting
+        pages of 'limit' items (sorted by id) until all are retrieved.
+        """
+        after_id = None
+        while True:
+            items = self.get(name, condition=condition, attrs=attrs,
+                             limit=limit, after_id=after_id).json()
+            if 'error' in items:
+                raise Exception("ERROR from Server: ", items['error'])
+            for item in items:
+                yield item
+            if len(items) < limit:
+                break
+            after_id = items[-1]['id']
 
     def json(self):
         if self.r.status_code == 200:
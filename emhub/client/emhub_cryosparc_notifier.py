@@ -227,20 +227,23 @@ class CSLiveSession:
         }
         coordList = []
         lastMicId = None
+        items = []
 
         for coord in coordsSet.iterItems(orderBy='_micId', direction='ASC'):
             micId = coord.getMicId()
             if micId != lastMicId:
                 # Update the coordinates information if necessary
                 if lastMicId is not None:
-                    attrs['item_id'] = lastMicId
-                    attrs['coordinates'] = coordList
-
-                    dc.update_session_item(attrs)
+                    items.append({'item_id': lastMicId,
+                                  'coordinates': coordList})
                 lastMicId = micId
                 coordList = []
             coordList.append(coord.getPosition())
 
+        # Send all updates in a few requests instead of one per micrograph
+        attrs['items'] = items
+        dc.update_session_items(attrs)
+
     def run(self):
         with open_client() as dc:
             sessionDict = dc.get_session(self._sessionId)
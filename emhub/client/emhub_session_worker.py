@@ -157,16 +157,19 @@ def main():
         try:
             with open_client() as dc:
                 eprint("Connected to server: ", config.EMHUB_SERVER_URL)
-                r = dc.request('poll_sessions', jsonData={})
-
-                for s in r.json():
-                    eprint("Handling session %s: " % s['id'])
-                    eprint("   - Creating folder: ",
-                          os.path.join(s['folder'], s['name']))
-                    eprint("   - Updating session")
-                    session_info = create_session_folder(s)
-                    pprint(session_info)
-                    dc.update_session(session_info)
+                while True:
+                    # Returns as soon as there are pending sessions,
+                    # or an empty list after the timeout
+                    r = dc.request('poll_sessions', jsonData={'timeout': 60})
+
+                    for s in r.json():
+                        eprint("Handling session %s: " % s['id'])
+                        eprint("   - Creating folder: ",
+                              os.path.join(s['folder'], s['name']))
+                        eprint("   - Updating session")
+                        session_info = create_session_folder(s)
+                        pprint(session_info)
+                        dc.update_session(session_info)
         except Exception as e:
             eprint("Some error happened: ", str(e))
             eprint("Waiting 60 seconds before retrying...")
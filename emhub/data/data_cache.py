@@ -0,0 +1,98 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+import sys
+import threading
+from collections import OrderedDict
+
+
+class ContentCache:
+    """ In-memory LRU cache of rendered contents (HTML strings).
+
+    Keys should include everything the content depends on (e.g. the
+    content params, user permissions and the version of the tables used),
+    so entries never need to be invalidated: outdated ones are just not
+    requested anymore and are evicted when the cache reaches maxBytes.
+    """
+    def __init__(self, maxBytes=32 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ Remove all items and reset the statistics. """
+        with self._lock:
+            self._items = OrderedDict()  # key -> (value, size)
+            self._bytes = 0
+            self._hits = self._misses = self._evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """ Return the value for the key or None if it is not cached. """
+        with self._lock:
+            item = self._items.get(key, None)
+            if item is None:
+                self._misses += 1
+                return None
+            self._items.move_to_end(key)
+            self._hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        """ Store the value, evicting the least recently used items if
+        needed. Values bigger than maxBytes are not stored. """
+        size = sys.getsizeof(value)
+        if size > self.maxBytes:
+            return
+
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self._bytes += size
+
+            while self._bytes > self.maxBytes:
+                _, (_, oldSize) = self._items.popitem(last=False)
+                self._bytes -= oldSize
+                self._evictions += 1
+
+    def get_stats(self):
+        """ Return a dict with the cache size and hit/miss counters. """
+        with self._lock:
+            requests = self._hits + self._misses
+            return {
+                'items': len(self._items),
+                'bytes': self._bytes,
+                'max_bytes': self.maxBytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_ratio': self._hits / requests if requests else 0
+            }
@@ -31,6 +31,8 @@ import datetime as dt
 import json
 from collections import defaultdict
 
+import numpy as np
+
 import flask
 import flask_login
 
@@ -39,6 +41,18 @@ from emhub.utils import (pretty_datetime, datetime_to_isoformat, pretty_date,
                          image)
 
 
+def cached_content(*tables, perUser=False):
+    """ Declare that the rendered content only depends on the given tables,
+    the request params and the user permissions (or the user itself if
+    perUser=True), so it can be stored in the content cache.
+    """
+    def decorator(func):
+        func.cache_tables = tables
+        func.cache_per_user = perUser
+        return func
+    return decorator
+
+
 class DataContent:
     """ This class acts as an intermediary between the DataManager and
     the Flask application.
@@ -50,6 +64,10 @@ class DataContent:
     def __init__(self, app):
         """ Create a new content for the given Flask application. """
         self.app = app
+        # Cache of the dashboard bookings digest per user (see
+        # get_dashboard), valid while the data versions do not change
+        self._digestCache = {}
+        self._digestVersions = None
 
     def _dateStr(self, datetime):
         return
@@ -63,23 +81,94 @@ class DataContent:
             dataDict.update(get_func(**kwargs))
         return dataDict
 
+    def get_cache_key(self, **kwargs):
+        """ Return the key to cache the rendered content, or None if the
+        content was not declared as cacheable (see cached_content).
+        The key changes whenever any of the declared tables is modified.
+        """
+        content_id = kwargs['content_id']
+        get_func_name = 'get_%s' % content_id.replace('-', '_')
+        get_func = getattr(self, get_func_name, None)
+        tables = getattr(get_func, 'cache_tables', None)
+        if not tables:
+            return None
+
+        user = self.app.user
+        if user.is_authenticated:
+            flags, staffUnit = user.get_permissions()
+            userKey = (tuple(sorted(flags)), staffUnit)
+            if get_func.cache_per_user:
+                userKey += (user.id,)
+        else:
+            userKey = 'anonymous'
+
+        return (content_id, tuple(sorted(kwargs.items())), userKey,
+                self.app.dm.get_data_versions(*tables))
+
     def get_dashboard(self, **kwargs):
         dataDict = self.get_resources(image=True)
         user = self.app.user  # shortcut
-        resource_bookings = {}
 
         # Provide upcoming bookings sorted by proximity
+        digest = self.__get_bookings_digest(user)
+        bookings = [(title, list(bList)) for title, bList in digest['bookings']]
+
+        # Today's bookings are loaded to show their sessions
+        # FIXME: If there is already a session, also return its id
+        ids = digest['resource_bookings']
+        resource_bookings = {b.resource_id: b for b in
+                             self.app.dm.get_bookings_by_ids(list(ids.values()))}
+
+        dataDict.update({'bookings': bookings,
+                         'lab_members': self.get_lab_members(user),
+                         'resource_bookings': resource_bookings})
+
+        return dataDict
+
+    def __get_bookings_digest(self, user):
+        """ Return the upcoming bookings of the user's lab (all bookings for
+        managers) grouped as 'Today', 'Next 7 days' and 'Next 30 days'.
+        Digests are cached per user until bookings in the upcoming window,
+        users or resources are modified, or until the bookings would move
+        to another group with time.
+        """
+        dm = self.app.dm
+        versions = dm.get_data_versions('bookings:upcoming', 'users',
+                                        'resources')
+        if versions != self._digestVersions:
+            self._digestCache = {}
+            self._digestVersions = versions
+
+        now = dm.now()
+        cached = self._digestCache.get(user.id, None)
+        if cached is not None and now < cached[0]:
+            return cached[1]
+
+        day = dt.timedelta(days=1)
+        next7 = now + 7 * day
+        next30 = now + 30 * day
+        # Bookings starting in the extra days might enter 'Next 30 days'
+        # before the digest expires
+        windowEnd = now + dm.UPCOMING_DAYS * day
+        expires = [windowEnd - 30 * day]
+
+        owners = None
+        pi = user.get_pi()
+        if not user.is_manager and pi is not None:
+            owners = [pi.id] + [u.id for u in pi.lab_members]
+
         bookings = [('Today', []),
                     ('Next 7 days', []),
                     ('Next 30 days', [])]
+        resource_bookings = {}
 
-        now = self.app.dm.now()
-        next7 = now + dt.timedelta(days=7)
-        next30 = now + dt.timedelta(days=30)
-
-        for b in self.app.dm.get_bookings(orderBy='start'):
+        for b in dm.get_bookings_range(now, windowEnd, load='calendar',
+                                       owners=owners):
             if not user.is_manager and not user.same_pi(b.owner) or not b.is_booking:
                 continue
+            # Times when the booking will move to another group
+            expires.extend(t for t in [b.start - 30 * day, b.start - 7 * day,
+                                       b.start, b.end] if t > now)
             bDict = {'owner': b.owner.name,
                      'resource': b.resource.name,
                      'start': pretty_datetime(b.start),
@@ -98,14 +187,11 @@ class DataContent:
                 bookings[i][1].append(bDict)
                 r = b.resource
                 if i == 0 and r.is_microscope and 'solna' in r.tags:  # Today's bookings
-                    # FIXME: If there is already a session, also return its id
-                    resource_bookings[r.id] = b
+                    resource_bookings[r.id] = b.id
 
-        dataDict.update({'bookings': bookings,
-                         'lab_members': self.get_lab_members(user),
-                         'resource_bookings': resource_bookings})
-
-        return dataDict
+        digest = {'bookings': bookings, 'resource_bookings': resource_bookings}
+        self._digestCache[user.id] = (min(expires), digest)
+        return digest
 
     def get_lab_members(self, user):
         if user.is_staff:
@@ -208,17 +294,17 @@ class DataContent:
 
     def get_sessions_list(self, **kwargs):
         dm = self.app.dm  # shortcut
-        all_sessions = dm.get_sessions()
+        all_sessions = dm.get_sessions(load='session_list')
         sessions = []
         bookingDict = {}
+        serializer = self.booking_serializer(prettyDate=True, piApp=True)
 
         for s in all_sessions:
             if s.booking:
                 a = s.booking.application
                 if a is None or a.allows_access(self.app.user):
                     sessions.append(s)
-                    b = self.booking_to_event(s.booking,
-                                              prettyDate=True, piApp=True)
+                    b = serializer(s.booking)
                     bookingDict[s.booking.id] = b
 
                     if not os.path.exists(dm.get_session_data_path(s)):
@@ -231,6 +317,7 @@ class DataContent:
             'possible_operators': self.get_possible_operators(),
         }
 
+    @cached_content('users', 'applications')
     def get_users_list(self, **kwargs):
         users = self.app.dm.get_users()
         for u in users:
@@ -319,10 +406,11 @@ class DataContent:
             return {'resources': []}
 
         def _image(r):
-            fn = self.app.dm.get_resource_image_path(r)
-            if os.path.exists(fn):
-                base64 = image.Base64Converter(max_size=(128, 128))
-                return 'data:image/%s;base64, ' + base64.from_path(fn)
+            # Thumbnails are generated once and served with cache headers
+            _, version = self.app.dm.get_resource_thumbnail(r, create=False)
+            if version is not None:
+                return flask.url_for('images.resource_thumbnail',
+                                     resource_id=r.id, v=version)
             else:
                 return flask.url_for('images.static', filename=r.image)
 
@@ -351,6 +439,7 @@ class DataContent:
         ]
         return {'resources': resource_list}
 
+    @cached_content('resources')
     def get_resources_list(self, **kwargs):
         kwargs['all'] = True  # show all resources despite status
         kwargs['image'] = True  # load resource image
@@ -404,10 +493,9 @@ class DataContent:
 
     def get_booking_calendar(self, **kwargs):
         dm = self.app.dm  # shortcut
+        # Events are loaded by the calendar for the visible dates only
+        # (see booking_events)
         dataDict = self.get_resources()
-        dataDict['bookings'] = [self.booking_to_event(b)
-                                for b in dm.get_bookings()
-                                if b.resource is not None]
         dataDict['applications'] = [{'id': a.id,
                                      'code': a.code,
                                      'alias': a.alias}
@@ -460,6 +548,8 @@ class DataContent:
         data.update(self.get_projects_list())
         return data
 
+    @cached_content('applications', 'templates', 'users',
+                    perUser=True)
     def get_applications(self, **kwargs):
         dataDict = self.get_raw_applications_list()
         dataDict['template_statuses'] = ['preparation', 'active', 'closed']
@@ -507,17 +597,15 @@ class DataContent:
                  'noslot': app.no_slot(r.id),
                  } for r in dm.get_resources() if r.is_microscope]
 
-        # Check which PIs are in the application
-        in_app = set(pi.id for pi in app.pi_list)
-
         return {'application': app,
+                'usage': dm.get_application_usage(app) if app.id else {},
                 'application_statuses': dm.Application.STATUSES,
                 'template_id': kwargs.get('template_id', None),
                 'microscopes': mics,
                 'pi_list': [{'id': u.id,
                              'name': u.name,
                              'email': u.email,
-                             'in_app': u.id in in_app,
+                             'in_app': app.has_pi(u),
                              'status': 'representative' if u.id == app.representative_id else ''
                              }
                             for u in dm.get_users() if u.is_pi],
@@ -660,17 +748,47 @@ class DataContent:
         return result
 
     def get_reports_time_distribution(self, **kwargs):
+        dm = self.app.dm
+        frame, range_dict = self.get_booking_frame(kwargs)
+        # Non-slot bookings of resources with cost (as get_booking_in_range)
+        frame = frame.select(self.__cost_mask(frame) & ~frame.is_type('slot'))
 
-        def _booking_to_json(booking, **kwargs):
-            bj = self.booking_to_event(booking, **kwargs)
-            bj.update({
-                'total_cost': booking.total_cost,
-                'days': booking.days,
-                'type': booking.type
-            })
-            return bj
+        resources = {r.id: r for r in dm.get_resources()}
+        users = {u.id: u for u in dm.get_users()}
+        apps = {a.id: a for a in dm.get_applications()}
+        serializer = self.booking_serializer()
 
-        bookings, range_dict = self.get_booking_in_range(kwargs, bookingFunc=_booking_to_json)
+        def _datetime(ts):
+            return dt.datetime.fromtimestamp(ts, dt.timezone.utc)
+
+        # Booking dicts (as events) are built from the frame rows
+        bookings = []
+        columns = ['id', 'start', 'end', 'resource_id', 'owner_id',
+                   'operator_id', 'application_id', 'pi_id', 'type', 'title',
+                   'days', 'total_cost']
+        for (bid, start, end, rid, owner_id, operator_id, app_id, pi_id,
+             btype, b_title, days, cost) in zip(*[frame[c].tolist()
+                                                  for c in columns]):
+            btype = frame.types[btype]
+            a, pi = apps.get(app_id, None), users.get(pi_id, None)
+            title, _, _ = serializer.event_title(
+                btype, b_title, resources.get(rid, None), users[owner_id],
+                users.get(operator_id, None), a, pi)
+            b = {
+                'id': bid,
+                'title': title,
+                'pretty_start': pretty_datetime(_datetime(start)),
+                'pretty_end': pretty_datetime(_datetime(end)),
+                'total_cost': cost,
+                'days': days,
+                'type': btype
+            }
+            if pi is not None:
+                b['pi_id'] = pi.id
+                b['pi_name'] = pi.name
+            if a is not None:
+                b['app_id'] = a.id
+            bookings.append(b)
 
         from emhub.reports import get_booking_counters
         counters, cem_counters = get_booking_counters(bookings)
@@ -691,7 +809,7 @@ class DataContent:
 
             return list(pi_bookings.values())
 
-        app_dict = {a.code: a.alias for a in self.app.dm.get_applications()}
+        app_dict = {a.code: a.alias for a in apps.values()}
         if details_key.startswith('CEM') and len(details_key) > 3:
             alias = app_dict.get(details_key, None)
             details_title = details_key + (' (%s)' % alias if alias else '')
@@ -726,7 +844,7 @@ class DataContent:
         return d
 
     def get_reports_invoices(self, **kwargs):
-        bookings, range_dict = self.get_booking_in_range(kwargs, asJson=False)
+        frame, range_dict = self.get_booking_frame(kwargs)
 
         portal_users = {
             pu['email']: pu for pu in self.app.sll_pm.fetchAccountsJson()
@@ -743,51 +861,42 @@ class DataContent:
             } for pi in a.pi_list
             }
 
-        def update_pi_info(pi_info, b):
-            pi_info['bookings'].append(b)
-            pi_info['sum_cost'] += b.total_cost
-            pi_info['sum_days'] += b.days
+        def update_pi_info(pi_info, key):
+            pi_info['bookings'].extend(booking_ids[key])
+            pi_info['sum_cost'] += sum_cost[key]
+            pi_info['sum_days'] += sum_days[key]
 
         # Create a dictionary where pi/bookings are grouped by Application
         # and another one grouped by pi
         apps_dict = {}
         pi_dict = {}
+        apps_codes = {}
 
         for a in self.app.dm.get_applications():
             apps_dict[a.code] = create_pi_info_dict(a)
             pi_dict.update(create_pi_info_dict(a))
-
-        for b in bookings:
-            if b.application is None:
-                continue
-
-            app_id = b.application.code
-
-            if app_id not in apps_dict:
-                print(">>> Missing app: ", app_id)
-                continue
-
-            pi = b.owner.get_pi()
-
-            if pi is None:
-                print(">>>  None pi, user: ", b.owner.name)
-                continue
-
-            # Only take into account booking type (i.e no slot, downtime, etc)
-            if not b.is_booking:
-                continue
-
+            apps_codes[a.id] = a.code
+
+        # Only take into account bookings with application and PI and
+        # of booking type (i.e no slot, downtime, etc)
+        frame = frame.select(self.__cost_mask(frame) &
+                             frame.is_type('booking') &
+                             (frame['application_id'] > 0) &
+                             (frame['pi_id'] > 0))
+        key = ('application_id', 'pi_id')
+        booking_ids = frame.group_values(key, 'id')
+        sum_cost = frame.group_sum(key, 'total_cost')
+        sum_days = frame.group_sum(key, 'days')
+
+        for app_pi in booking_ids:
+            app_id, pi_id = app_pi
             try:
-                update_pi_info(apps_dict[app_id][pi.id], b)
-                update_pi_info(pi_dict[pi.id], b)
-
-                if b.total_cost == 0:
-                    print(">>> 0 cost booking!!!")
-                    print(b.json())
-
+                app_code = apps_codes[app_id]
+                update_pi_info(apps_dict[app_code][pi_id], app_pi)
+                update_pi_info(pi_dict[pi_id], app_pi)
             except KeyError:
                 print("Got KeyError, app_id: %s, pi_id: %s"
-                      % (app_id, pi.id))
+                      % (app_id, pi_id))
 
         result = {
             'apps_dict': apps_dict,
@@ -882,22 +991,22 @@ class DataContent:
         pi_user = self.__get_pi_user(kwargs)
         dm = self.app.dm  # shortcut
 
-        def _filter(b):
-            pi = b.owner.get_pi()
-            return (b.resource.daily_cost > 0 and
-                    b.start <= dm.now() and
-                    b.is_booking and pi and pi.id == pi_user.id)
-
+        frame = dm.get_booking_frame(end=dm.now())
+        frame = frame.select(self.__cost_mask(frame) &
+                             frame.is_type('booking') &
+                             (frame['pi_id'] == pi_user.id))
+        amounts = dict(zip(frame['id'].tolist(),
+                           frame['total_cost'].tolist()))
         entries = []
+        serializer = self.booking_serializer()
 
-        for b in dm.get_bookings():
-            if _filter(b):
-                entries.append({'id': b.id,
-                                'title': self.booking_to_event(b)['title'],
-                                'date': b.start,
-                                'amount': b.total_cost,
-                                'type': 'booking'
-                                })
+        for b in dm.get_bookings_by_ids(list(amounts), load='report'):
+            entries.append({'id': b.id,
+                            'title': serializer(b)['title'],
+                            'date': b.start,
+                            'amount': amounts[b.id],
+                            'type': 'booking'
+                            })
 
         for t in dm.get_transactions():
             if t.user.id == pi_user.id:
@@ -1076,23 +1185,17 @@ class DataContent:
         return self.get_report_microscopes_usage(**kwargs)
 
     def get_report_microscopes_usage(self, **kwargs):
-        def _filter(b):
-            return not b.is_slot
-
+        dm = self.app.dm
         app_id = int(kwargs.get('application', 0))
         selected_app = self.app.dm.get_application_by(id=app_id)
         applications = self.app.dm.get_visible_applications()
         if not selected_app:
             selected_app = applications[-1]
 
-        bookings, range_dict = self.get_booking_in_range(kwargs,
-                                                         asJson=False,
-                                                         filter=_filter)
+        frame, range_dict = self.get_booking_frame(kwargs)
         pi_dict = {}
-        pi_list = [pi.id for pi in selected_app.pi_list]
         pid = int(kwargs.get('pi', 0))
         selected_pi = None
-        total_days = 0
 
         resources = self.get_resources()['resources']
         # selected resources
@@ -1101,30 +1204,34 @@ class DataContent:
         else:
             selected = [r['id'] for r in resources if r['is_microscope']]
 
-        for b in bookings:
-            pi = b.owner.get_pi()
-            r = b.resource.id
-            # Facility bookings or with no PI will not be counted
-            if pi and r in selected and pi.id in pi_list:
-                if not pi.email in pi_dict:
-                    pi_dict[pi.email] = {
-                        'id': pi.id,
-                        'name': pi.name,
-                        'email': pi.email,
-                        'bookings': [],
-                        'days': defaultdict(lambda: 0),
-                        'total_days': 0,
-                        'users': set()
-                    }
-                pi_entry = pi_dict[pi.email]
-                pi_entry['bookings'].append(b)
-                rid = b.resource.id
-                pi_entry['days'][rid] += b.days
-                pi_entry['total_days'] += b.days
-                pi_entry['users'].add(b.owner.email)
-                total_days += b.days
-                if pi.id == pid:
-                    selected_pi = pi_entry
+        # Facility bookings or with no PI will not be counted
+        frame = frame.select(~frame.is_type('slot') &
+                             np.isin(frame['resource_id'], selected) &
+                             np.isin(frame['pi_id'], selected_app.pi_ids))
+        total_days = int(frame['days'].sum())
+        pi_days = frame.group_sum(('pi_id', 'resource_id'), 'days')
+        pi_owners = frame.group_unique('pi_id', 'owner_id')
+        users = {u.id: u for u in dm.get_users()}
+
+        for pi_id, total in frame.group_sum('pi_id', 'days').items():
+            pi = users[pi_id]
+            pi_dict[pi_id] = {
+                'id': pi.id,
+                'name': pi.name,
+                'email': pi.email,
+                'bookings': [],  # only loaded for the selected PI
+                'days': defaultdict(lambda: 0),
+                'total_days': total,
+                'users': set(users[uid].email for uid in pi_owners[pi_id])
+            }
+
+        for (pi_id, rid), days in pi_days.items():
+            pi_dict[pi_id]['days'][rid] = days
+
+        if pid in pi_dict:
+            selected_pi = pi_dict[pid]
+            ids = frame.select(frame['pi_id'] == pid)['id'].tolist()
+            selected_pi['bookings'] = dm.get_bookings_by_ids(ids, load='report')
 
         data = {
             'pi_list': sorted(pi_dict.values(), key=lambda pi: pi['total_days'], reverse=True),
@@ -1141,8 +1248,7 @@ class DataContent:
         return data
 
     def get_report_pis_usage(self, **kwargs):
-
-        bookings, range_dict = self.get_booking_in_range(kwargs, asJson=False)
+        frame, range_dict = self.get_booking_frame(kwargs)
 
         pi_dict = {}
         try:
@@ -1156,27 +1262,26 @@ class DataContent:
                     return v
             return default
 
-        for b in bookings:
-            pi = b.owner.get_pi()
-            if pi:
-                parts = pi.name.split()
-                first_name = ' '.join(parts[:-1])
-                last_name = parts[-1]
-                if not pi.email in pi_dict:
-                    pi_dict[pi.email] = {
-                        'first_name': first_name,
-                        'last_name': last_name,
-                        'email': pi.email,
-                        # 'email_rev': pi.email[::-1],  # reverse email for sorting
-                        'university': _get_univ(pi.email, 'z-Unknown'),
-                        'bookings': 0,
-                        'days': 0,
-                        'users': set()
-                    }
-                pi_entry = pi_dict[pi.email]
-                pi_entry['bookings'] += 1
-                pi_entry['days'] += b.days
-                pi_entry['users'].add(b.owner.email)
+        # Same bookings used by default in get_booking_in_range
+        frame = frame.select(self.__cost_mask(frame) &
+                             ~frame.is_type('slot') & (frame['pi_id'] > 0))
+        pi_days = frame.group_sum('pi_id', 'days')
+        pi_owners = frame.group_unique('pi_id', 'owner_id')
+        users = {u.id: u for u in self.app.dm.get_users()}
+
+        for pi_id, count in frame.group_sum('pi_id').items():
+            pi = users[pi_id]
+            parts = pi.name.split()
+            pi_dict[pi.email] = {
+                'first_name': ' '.join(parts[:-1]),
+                'last_name': parts[-1],
+                'email': pi.email,
+                # 'email_rev': pi.email[::-1],  # reverse email for sorting
+                'university': _get_univ(pi.email, 'z-Unknown'),
+                'bookings': count,
+                'days': pi_days[pi_id],
+                'users': set(users[uid].email for uid in pi_owners[pi_id])
+            }
 
         data = {
             'pi_list': sorted(pi_dict.values(), key=lambda pi: pi['university'].lower())
@@ -1217,6 +1322,7 @@ class DataContent:
             'pi_list': [u for u in dm.get_users() if u.is_pi]
         }
 
+    @cached_content('invoice_periods', perUser=True)
     def get_invoice_periods_list(self, **kwargs):
         c = 0
         periods = []
@@ -1508,6 +1614,7 @@ class DataContent:
             'session': session
         }
 
+    @cached_content('pucks', 'entries', 'projects', 'users')
     def get_grids_storage(self, **kwargs):
         return self.get_grids_cane(**kwargs)
 
@@ -1519,28 +1626,18 @@ class DataContent:
 
         pucks = self.app.dm.get_pucks(condition=condStr, orderBy='id')
 
-        dewars = defaultdict(lambda: defaultdict(dict))
-
         dewar = int(kwargs.get('dewar', 0) or 0)
         cane = int(kwargs.get('cane', 0) or 0)
+        position = int(kwargs.get('puck', 0) or 0) or None
 
         storage = self.app.dm.PuckStorage(pucks)
 
         for puck in storage.pucks():
             puck['gridboxes'] = defaultdict(dict)
 
-        cond = "type=='grids_storage'"
-        for entry in self.app.dm.get_entries(condition=cond):
-            table = entry.extra['data']['grids_storage_table']
-            for row in table:
-                try:
-                    slot = int(row['box_position'])
-                    puck = storage.get_puck(int(row['puck_id']))
-                    slot_key = ','.join(row['grid_position'])
-                    row['entry'] = entry
-                    puck['gridboxes'][slot][slot_key] = row
-                except:
-                    pass
+        # Only load the grids stored in the requested cane (or puck)
+        if dewar and cane:
+            self.__load_gridboxes(storage.pucks(dewar, cane, position))
 
         return {
             'storage': storage,
@@ -1554,6 +1651,20 @@ class DataContent:
         data['puck'] = int(kwargs.get('puck', 0) or 0)
         return data
 
+    def __load_gridboxes(self, pucks):
+        """ Fill the 'gridboxes' of the given pucks with the rows of
+        'grids_storage' entries stored there. """
+        pucks = {p['id']: p for p in pucks}
+        if not pucks:
+            return
+
+        for slot, entry in self.app.dm.get_grid_slots(list(pucks)):
+            table = entry.extra['data']['grids_storage_table']
+            row = table[slot.row_index]
+            row['entry'] = entry
+            puck = pucks[slot.puck_id]
+            puck['gridboxes'][slot.box_position][slot.grid_position] = row
+
     def get_raw_user_issues(self, **kwargs):
         users = self.get_users_list()['users']
         filterKey = kwargs.get('filter', 'noroles')
@@ -1604,119 +1715,42 @@ class DataContent:
         }
 
     # --------------------- Internal  helper methods ---------------------------
+    def booking_events(self, start, end, resource=None):
+        """ Return the calendar events of the bookings overlapping
+        the [start, end] range, optionally only from one resource. """
+        bookings = self.app.dm.get_bookings_range(start, end,
+                                                  resource=resource,
+                                                  load='calendar')
+        serializer = self.booking_serializer()
+        return [serializer(b) for b in bookings if b.resource is not None]
+
+    def booking_serializer(self, **kwargs):
+        """ Return a BookingEventSerializer for the current user.
+        It should be used (instead of booking_to_event) when converting
+        many bookings, e.g. all bookings of a request.
+
+        Keyword Args:
+            prettyDate: add pretty_start and pretty_end to events.
+            piApp: add PI and application ids to events.
+        """
+        return BookingEventSerializer(self.app.dm, self.app.user, **kwargs)
+
     def booking_to_event(self, booking, **kwargs):
         """ Return a dict that can be used as calendar Event object. """
-        resource = booking.resource
-        # Bookings should have resources, just in case an erroneous one
-        if resource is None:
-            resource = self.app.dm.Resource(
-                name='Error: MISSING',
-                status='inactive',
-                tags='',
-                image='',
-                color='rgba(256, 256, 256, 1.0)',
-                extra={})
-
-        owner = booking.owner
-        owner_name = owner.name
-        operator = booking.operator  # shortcut
-        if operator:
-            operator_dict = {'id': operator.id, 'name': operator.name}
-        else:
-            operator_dict = {'id': None, 'name': ''}
-
-        creator = booking.creator
-        a = booking.application
-        user = self.app.user
-        dm = self.app.dm
-        b_title = booking.title
-        b_description = booking.description
-
-        user_can_book = False
-        # Define which users are allowed to modify the booking
-        # - managers
-        # - application creators
-        # - the owner and pi of the owner
-        can_modify_list = [owner.id]
-
-        if a is not None:
-            can_modify_list.append(a.creator.id)
-
-        if user.is_manager and (a is None or a.allows_access(user)):
-            can_modify_list.append(user.id)
-
-        pi = owner.get_pi()
-        if pi is not None:
-            can_modify_list.append(pi.id)
-
-        user_can_modify = user.id in can_modify_list
-        user_can_view = user_can_modify or user.same_pi(owner)
-        color = resource.color if resource else 'grey'
-
-        application_label = 'None'
-
-        if booking.type == 'special':
-            color = 'rgba(98,50,45,1.0)'
-            title = "%s (SPECIAL): %s" % (resource.name, b_title)
-        if booking.type == 'downtime':
-            color = 'rgba(181,4,0,1.0)'
-            title = "%s (DOWNTIME): %s" % (resource.name, b_title)
-        if booking.type == 'maintenance' or any(k in b_title for k in ['cycle', 'installation', 'maintenance', 'afis']):
-            color = 'rgba(255,107,53,1.0)'
-            title = "%s (MAINTENANCE): %s" % (resource.name, b_title)
-        elif booking.type == 'slot':
-            color = color.replace('1.0', '0.5')  # transparency for slots
-            title = "%s (SLOT): %s" % (resource.name,
-                                       booking.slot_auth.get('applications', ''))
-            user_can_book = user.can_book_slot(booking)
-        else:
-            # Show all booking information in title in some cases only
-            display = dm.get_config('bookings')['display']
-            emptyApp = a is None or display['show_application'] == 'no'
-            appStr = '' if emptyApp else ', %s' % a.code
-            emptyOp = operator is None or display['show_operator'] == 'no'
-            opStr = '' if emptyOp else ' -> ' + operator.name
-            extra = "%s%s%s" % (owner.name, appStr, opStr)
-            if user_can_view:
-                title = "%s (%s) %s" % (resource.name, extra, b_title)
-                if a:
-                    application_label = a.code
-                    if a.alias:
-                        application_label += "  (%s)" % a.alias
-            else:
-                title = "%s (%s)" % (resource.name, extra)
-                b_title = "Hidden title"
-                b_description = "Hidden description"
-
-        bd = {
-            'id': booking.id,
-            'title': title,
-            'resource': {'id': resource.id},
-            'start': datetime_to_isoformat(booking.start),
-            'end': datetime_to_isoformat(booking.end),
-            'color': color,
-            'textColor': 'white',
-            'booking_title': b_title,
-        }
-
-        if kwargs.get('prettyDate', False):
-            bd['pretty_start'] = pretty_datetime(booking.start)
-            bd['pretty_end'] = pretty_datetime(booking.end)
-
-        if kwargs.get('piApp', False):
-            if pi is not None:
-                bd['pi_id'] = pi.id
-                bd['pi_name'] = pi.name
-
-            app = booking.application
-            if app is not None:
-                bd['app_id'] = app.id
-
-        return bd
+        return self.booking_serializer(**kwargs)(booking)
 
     def user_profile_image(self, user):
-        if getattr(user, 'profile_image', None):
-            return flask.url_for('images.user_profile', user_id=user.id)
+        profile_image = getattr(user, 'profile_image', None)
+        if profile_image:
+            # The version changes with the image, to validate browser caches
+            imagePath = os.path.join(self.app.config['USER_IMAGES'],
+                                     profile_image)
+            try:
+                version = '%s-%d' % (profile_image, os.stat(imagePath).st_mtime)
+            except OSError:
+                version = None
+            return flask.url_for('images.user_profile', user_id=user.id,
+                                 v=version)
         else:
             return flask.url_for('images.static', filename='user-icon.png')
 
@@ -1834,23 +1868,9 @@ class DataContent:
                     for u in dm.get_users() if 'manager' in u.roles]
         return []
 
-    def get_booking_in_range(self, kwargs,
-                             asJson=True, filter=None, bookingFunc=None):
-        """ Return the list of bookings in the given range.
-         It will also attach PI information to each booking.
-         This function is used from report functions.
-         If 'start' and 'end' keys are not in kwargs, the current
-         year quarter will be used for the range.
-         Args:
-             kwargs: dict from where to read 'start' and 'end'
-             asJson: if True return json entries for each booking
-             filter: function to filter bookings. If None, the
-                non-slot bookings with non-zero cost resource
-                will be used.
-            bookingFunc: if asJson is True, function used to convert
-                booking into a jsonDict. If it is none, booking_to_event is used.
-        """
-
+    def __get_range(self, kwargs):
+        """ Return the dict with 'start' and 'end' strings for the range
+        in kwargs (or the current quarter) and the range datetimes. """
         if 'start' in kwargs and 'end' in kwargs:
             # d = request.json or request.form
             d = {'start': kwargs['start'], 'end': kwargs['end']}
@@ -1869,12 +1889,45 @@ class DataContent:
                  'end': '%d/%s' % (now.year, end)
                  }
 
-        bookings = self.app.dm.get_bookings_range(
-            datetime_from_isoformat(d['start'].replace('/', '-')),
-            datetime_from_isoformat(d['end'].replace('/', '-'))
-        )
+        return d, (datetime_from_isoformat(d['start'].replace('/', '-')),
+                   datetime_from_isoformat(d['end'].replace('/', '-')))
+
+    def get_booking_frame(self, kwargs):
+        """ Return the BookingFrame with bookings in the range given by
+        kwargs (as in get_booking_in_range) and the range dict. """
+        d, (start, end) = self.__get_range(kwargs)
+        return self.app.dm.get_booking_frame(start, end), d
+
+    def __cost_mask(self, frame):
+        """ Mask of the bookings of resources with non-zero cost. """
+        rids = [r.id for r in self.app.dm.get_resources() if r.daily_cost > 0]
+        return np.isin(frame['resource_id'], rids)
+
+    def get_booking_in_range(self, kwargs,
+                             asJson=True, filter=None, bookingFunc=None):
+        """ Return the list of bookings in the given range.
+         It will also attach PI information to each booking.
+         This function is used from report functions.
+         If 'start' and 'end' keys are not in kwargs, the current
+         year quarter will be used for the range.
+         Args:
+             kwargs: dict from where to read 'start' and 'end'
+             asJson: if True return json entries for each booking
+             filter: function to filter bookings. If None, the
+                non-slot bookings with non-zero cost resource
+                will be used.
+            bookingFunc: if asJson is True, function used to convert
+                booking into a jsonDict. If it is none, a
+                BookingEventSerializer is used.
+        """
+        d, (start, end) = self.__get_range(kwargs)
+        bookings = self.app.dm.get_bookings_range(start, end, load='report')
+
+        if bookingFunc is None:
+            serializer = self.booking_serializer(prettyDate=True, piApp=True)
 
-        bookingFunc = bookingFunc or self.booking_to_event
+            def bookingFunc(b, **kwargs):
+                return serializer(b)
 
         def process_booking(b):
             if not asJson:
@@ -1888,3 +1941,129 @@ class DataContent:
         bookings = [process_booking(b) for b in bookings if filterFunc(b)]
 
         return bookings, d
+
+
+class BookingEventSerializer:
+    """ Convert bookings into dicts that can be used as calendar Event
+    objects. Values that are the same for all bookings (e.g. the user
+    permissions or the bookings display config) are computed once,
+    so the same serializer should be used for all bookings of a request.
+    """
+    MAINTENANCE_KEYS = ['cycle', 'installation', 'maintenance', 'afis']
+
+    def __init__(self, dm, user, prettyDate=False, piApp=False):
+        self._dm = dm
+        self._user = user
+        self._userId = user.id
+        self._isManager = user.is_manager
+        self._userPi = user.get_pi()
+        self._prettyDate = prettyDate
+        self._piApp = piApp
+        self._display = None  # Loaded only if needed
+        self._slotColors = {}
+        self._missingResource = None
+
+    def __missing_resource(self):
+        # Bookings should have resources, just in case an erroneous one
+        if self._missingResource is None:
+            self._missingResource = self._dm.Resource(
+                name='Error: MISSING',
+                status='inactive',
+                tags='',
+                image='',
+                color='rgba(256, 256, 256, 1.0)',
+                extra={})
+        return self._missingResource
+
+    def __get_display(self):
+        if self._display is None:
+            display = self._dm.get_config('bookings')['display']
+            self._display = (display['show_application'] == 'no',
+                             display['show_operator'] == 'no')
+        return self._display
+
+    def __slot_color(self, color):
+        if color not in self._slotColors:
+            # transparency for slots
+            self._slotColors[color] = color.replace('1.0', '0.5')
+        return self._slotColors[color]
+
+    def __call__(self, booking):
+        resource = booking.resource or self.__missing_resource()
+        a = booking.application
+        pi = booking.owner.get_pi()
+        title, b_title, color = self.event_title(
+            booking.type, booking.title, resource, booking.owner,
+            booking.operator, a, pi,
+            slotApps=booking.slot_auth.get('applications', ''))
+
+        bd = {
+            'id': booking.id,
+            'title': title,
+            'resource': {'id': resource.id},
+            'start': datetime_to_isoformat(booking.start),
+            'end': datetime_to_isoformat(booking.end),
+            'color': color,
+            'textColor': 'white',
+            'booking_title': b_title,
+        }
+
+        if self._prettyDate:
+            bd['pretty_start'] = pretty_datetime(booking.start)
+            bd['pretty_end'] = pretty_datetime(booking.end)
+
+        if self._piApp:
+            if pi is not None:
+                bd['pi_id'] = pi.id
+                bd['pi_name'] = pi.name
+
+            if a is not None:
+                bd['app_id'] = a.id
+
+        return bd
+
+    def event_title(self, btype, b_title, resource, owner, operator, a, pi,
+                    slotApps=''):
+        """ Return the event title, the booking title (hidden if the user
+        can not view it) and the color of a booking with the given values.
+        """
+        resource = resource or self.__missing_resource()
+        uid = self._userId
+
+        # Define which users are allowed to modify the booking
+        # - managers
+        # - application creators
+        # - the owner and pi of the owner
+        user_can_modify = (uid == owner.id
+                           or (a is not None and uid == a.creator.id)
+                           or (self._isManager and
+                               (a is None or a.allows_access(self._user)))
+                           or (pi is not None and uid == pi.id))
+        user_can_view = user_can_modify or self._userPi == pi
+        color = resource.color
+
+        if btype == 'special':
+            color = 'rgba(98,50,45,1.0)'
+            title = "%s (SPECIAL): %s" % (resource.name, b_title)
+        if btype == 'downtime':
+            color = 'rgba(181,4,0,1.0)'
+            title = "%s (DOWNTIME): %s" % (resource.name, b_title)
+        if btype == 'maintenance' or any(k in b_title for k in self.MAINTENANCE_KEYS):
+            color = 'rgba(255,107,53,1.0)'
+            title = "%s (MAINTENANCE): %s" % (resource.name, b_title)
+        elif btype == 'slot':
+            color = self.__slot_color(color)
+            title = "%s (SLOT): %s" % (resource.name, slotApps)
+        else:
+            # Show all booking information in title in some cases only
+            hideApp, hideOp = self.__get_display()
+            appStr = '' if a is None or hideApp else ', %s' % a.code
+            opStr = '' if operator is None or hideOp else ' -> ' + operator.name
+            extra = "%s%s%s" % (owner.name, appStr, opStr)
+            if user_can_view:
+                title = "%s (%s) %s" % (resource.name, extra, b_title)
+            else:
+                title = "%s (%s)" % (resource.name, extra)
+                b_title = "Hidden title"
+
+        return title, b_title, color
@@ -29,8 +29,10 @@
 import os
 import datetime as dt
 import decimal
+import operator
 
 import sqlalchemy
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -38,13 +40,93 @@ from sqlalchemy.ext.declarative import declarative_base
 class DbManager:
     """ Helper class to deal with DB stuff
     """
-    def init_db(self, dbPath, cleanDb=False, create=True):
+    # Default profile used to create the SQLite engine. Any of these values
+    # can be overwritten from the instance config.py file through the
+    # DB_ENGINE_OPTIONS dict. Pragmas are applied to every new connection.
+    ENGINE_OPTIONS = {
+        # Write-Ahead-Log allows readers to continue while there is a writer
+        'journal_mode': 'WAL',
+        # NORMAL is safe with WAL and avoid one fsync per transaction
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,  # bytes
+        'cache_size': -32000,  # negative means KiB instead of pages
+        # How long a connection will wait for a lock before raising
+        # "database is locked" error
+        'busy_timeout': 30000,  # milliseconds
+        'foreign_keys': False,
+        # Connection pool parameters
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 30,  # seconds
+        'pool_recycle': 3600,  # seconds
+    }
+
+    PRAGMAS = ['journal_mode', 'synchronous', 'mmap_size',
+               'cache_size', 'busy_timeout', 'foreign_keys']
+
+    @classmethod
+    def get_engine_options(cls, engineOptions=None):
+        """ Return the engine options resulting of updating the
+        default ones with the given dict. """
+        options = dict(cls.ENGINE_OPTIONS)
+        options.update(engineOptions or {})
+        return options
+
+    def _create_engine(self, dbPath, engineOptions=None):
+        """ Create the SQLAlchemy engine for the given SQLite file.
+
+        Args:
+            dbPath: path to the SQLite database file.
+            engineOptions: dict to overwrite the default ENGINE_OPTIONS.
+                If None is passed, the default options will be used.
+                Pass False to create a plain engine (no pragmas, no pool).
+        """
         do_echo = os.environ.get('SQLALCHEMY_ECHO', '0') == '1'
+        url = 'sqlite:///' + dbPath
+
+        if engineOptions is False:
+            return sqlalchemy.create_engine(url, echo=do_echo)
 
-        if cleanDb and os.path.exists(dbPath):
-            os.remove(dbPath)
+        options = self.get_engine_options(engineOptions)
+        pragmas = [(p, options[p]) for p in self.PRAGMAS
+                   if options.get(p, None) is not None]
 
-        engine = sqlalchemy.create_engine('sqlite:///' + dbPath, echo=do_echo)
+        engine = sqlalchemy.create_engine(
+            url, echo=do_echo,
+            poolclass=QueuePool,
+            pool_size=options['pool_size'],
+            max_overflow=options['max_overflow'],
+            pool_timeout=options['pool_timeout'],
+            pool_recycle=options['pool_recycle'],
+            connect_args={
+                # Wait at the driver level as well (in seconds)
+                'timeout': options['busy_timeout'] / 1000.0,
+                # Connections are shared between threads through the pool
+                'check_same_thread': False
+            })
+
+        @sqlalchemy.event.listens_for(engine, 'connect')
+        def _set_pragmas(dbapi_conn, conn_record):
+            cursor = dbapi_conn.cursor()
+            for key, value in pragmas:
+                if isinstance(value, bool):
+                    value = 'ON' if value else 'OFF'
+                cursor.execute('PRAGMA %s=%s' % (key, value))
+            cursor.close()
+
+        return engine
+
+    def init_db(self, dbPath, cleanDb=False, create=True, engineOptions=None):
+        if cleanDb:
+            # Also remove WAL related files
+            for fn in [dbPath, dbPath + '-wal', dbPath + '-shm']:
+                if os.path.exists(fn):
+                    os.remove(fn)
+
+        # Check before the engine connects and creates an empty file
+        exists = os.path.exists(dbPath)
+        engine = self._create_engine(dbPath, engineOptions)
+        self._db_engine = engine
 
         self._db_session = scoped_session(sessionmaker(autocommit=False,
                                                        autoflush=False,
@@ -54,8 +136,13 @@ class DbManager:
 
         self._create_models()
 
+        # Resolve once the columns and values conversion of each model
+        for mapper in self.Base.registry.mappers:
+            Model = mapper.class_
+            Model.row_serializer = RowSerializer(Model.__table__)
+
         # Create the database if it does not exists
-        if not os.path.exists(dbPath) and create:
+        if not exists and create:
             self.Base.metadata.create_all(bind=engine)
 
     def commit(self):
@@ -69,6 +156,24 @@ class DbManager:
     def close(self):
         self._db_session.remove()
 
+    def dispose(self):
+        """ Close the session and all pooled connections. """
+        self.close()
+        self._db_engine.dispose()
+
+    def count_queries(self, maxCount=None):
+        """ Return a QueryCounter context manager to count the SQL
+        statements executed through this manager's engine, e.g:
+
+            with dm.count_queries(maxCount=10) as counter:
+                dm.get_bookings(load='calendar')
+            print(counter.count)
+
+        If maxCount is not None, an AssertionError is raised when exiting
+        the context if more statements were executed.
+        """
+        return QueryCounter(self._db_engine, maxCount=maxCount)
+
     # ------------------- Some utility methods --------------------------------
     def now(self):
         from tzlocal import get_localzone
@@ -88,6 +193,9 @@ class DbManager:
     @staticmethod
     def json_from_object(obj):
         """ Return row info as json dict. """
+        serializer = getattr(obj, 'row_serializer', None)
+        if serializer is not None:
+            return serializer.from_object(obj)
         return {c.key: DbManager.json_from_value(getattr(obj, c.key))
                 for c in obj.__table__.c}
 
@@ -95,3 +203,111 @@ class DbManager:
     def json_from_dict(d):
         """ Return row info as json dict. """
         return {k: DbManager.json_from_value(v) for k, v in d.items()}
+
+
+class RowSerializer:
+    """ Convert rows of a table to json dicts (as DbManager.json_from_value
+    does for each value). The columns and the conversion needed by each of
+    them (e.g. isoformat for dates) are resolved once from the column types
+    and the conversion functions are compiled once for each set of keys.
+    """
+    def __init__(self, table):
+        self.table = table
+        self.keys = tuple(c.key for c in table.c)
+        self._converters = {c.key: _json_converter(c.type) for c in table.c}
+        self._funcs = {}
+        self._getter = _tuple_getter(self.keys)
+        self._objectFunc = self.row_func()
+
+    def columns(self, keys=None):
+        """ Return the table columns for the given keys (all by default),
+        to be used in a query whose rows will be converted by row_func. """
+        return [self.table.c[k] for k in keys or self.keys]
+
+    def row_func(self, keys=None):
+        """ Return a function to convert a row (tuple of values of the given
+        keys, all columns by default) to a json dict. """
+        keys = tuple(keys or self.keys)
+        func = self._funcs.get(keys, None)
+
+        if func is None:
+            converters = [(i, self._converters[k])
+                          for i, k in enumerate(keys) if self._converters[k]]
+
+            if not converters:
+                def func(row):
+                    return dict(zip(keys, row))
+            else:
+                def func(row):
+                    values = list(row)
+                    for i, convert in converters:
+                        if values[i] is not None:
+                            values[i] = convert(values[i])
+                    return dict(zip(keys, values))
+
+            self._funcs[keys] = func
+
+        return func
+
+    def from_object(self, obj):
+        """ Return the json dict with all columns of a model instance. """
+        return self._objectFunc(self._getter(obj))
+
+
+def _json_converter(columnType):
+    """ Return the function to convert values of the given column type
+    to json, or None if no conversion is needed. """
+    while isinstance(columnType, sqlalchemy.types.TypeDecorator):
+        columnType = columnType.impl  # e.g. UtcDateTime
+
+    try:
+        pythonType = columnType.python_type
+    except NotImplementedError:  # e.g. JSON columns
+        return None
+
+    if issubclass(pythonType, dt.date):  # also datetimes
+        return operator.methodcaller('isoformat')
+    if issubclass(pythonType, decimal.Decimal):
+        return float
+    return None
+
+
+def _tuple_getter(keys):
+    """ Return a function to get the values of the given attributes
+    as a tuple (even for a single key). """
+    getter = operator.attrgetter(*keys)
+    if len(keys) == 1:
+        return lambda obj: (getter(obj),)
+    return getter
+
+
+class QueryCounter:
+    """ Count the SQL statements executed by an engine while the context
+    is active. Useful in tests to detect N+1 queries regressions. """
+    def __init__(self, engine, maxCount=None):
+        self._engine = engine
+        self._maxCount = maxCount
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _before_execute(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        sqlalchemy.event.listen(self._engine, 'before_cursor_execute',
+                                self._before_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sqlalchemy.event.remove(self._engine, 'before_cursor_execute',
+                                self._before_execute)
+
+        if (exc_type is None and self._maxCount is not None
+                and self.count > self._maxCount):
+            raise AssertionError("Expected at most %d queries, but %d were "
+                                 "executed:\n%s"
+                                 % (self._maxCount, self.count,
+                                    '\n'.join(self.statements)))
@@ -0,0 +1,183 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+import numpy as np
+
+DAY_SECONDS = 24 * 3600
+
+
+class BookingFrame:
+    """ Columnar view of bookings (one NumPy array per column) used to
+    compute reports with vectorized operations instead of looping over
+    Booking objects.
+
+    Columns:
+        id, start, end (epoch seconds), resource_id, owner_id, operator_id,
+        pi_id, application_id, type (index in Booking.TYPES), days,
+        base_cost and extra_cost. Missing ids (e.g. no application or no PI)
+        are 0. The title column is an array of strings (dtype object).
+    Derived columns: total_cost and month (YYYYMM of the start, UTC).
+    """
+    COLUMNS = ['id', 'start', 'end', 'resource_id', 'owner_id', 'operator_id',
+               'pi_id', 'application_id', 'type', 'days', 'base_cost',
+               'extra_cost']
+    TEXT_COLUMNS = ['title']
+
+    def __init__(self, types, **columns):
+        self.types = list(types)
+        self._columns = {c: np.asarray(columns[c], dtype=np.int64)
+                         for c in self.COLUMNS}
+        for c in self.TEXT_COLUMNS:
+            self._columns[c] = np.asarray(columns[c], dtype=object)
+
+    @classmethod
+    def from_rows(cls, rows, types, dailyCosts):
+        """ Create the frame from rows with the values:
+        (id, start, end, resource_id, owner_id, application_id, type, extra,
+         owner_roles, owner_pi_id, operator_id, title)
+        where start and end are datetimes. Days and costs are computed
+        in the same way as Booking.days and Booking.total_cost.
+
+        Args:
+            types: list of booking types (Booking.TYPES)
+            dailyCosts: dict with resource_id -> daily cost
+        """
+        typeIndex = {t: i for i, t in enumerate(types)}
+        values = {c: [] for c in cls.COLUMNS + cls.TEXT_COLUMNS}
+
+        for (bid, start, end, rid, owner_id, app_id, btype, extra,
+             roles, pi_id, operator_id, title) in rows:
+            values['id'].append(bid)
+            values['start'].append(int(start.timestamp()))
+            values['end'].append(int(end.timestamp()))
+            values['resource_id'].append(rid or 0)
+            values['owner_id'].append(owner_id or 0)
+            values['operator_id'].append(operator_id or 0)
+            values['title'].append(title or '')
+            # PI are considered PI of themselves (as User.get_pi)
+            if owner_id and 'pi' in (roles or []):
+                pi_id = owner_id
+            values['pi_id'].append(pi_id or 0)
+            values['application_id'].append(app_id or 0)
+            values['type'].append(typeIndex.get(btype, -1))
+            values['extra_cost'].append(_extra_cost(extra))
+
+        start = np.asarray(values['start'], dtype=np.int64)
+        end = np.asarray(values['end'], dtype=np.int64)
+        # Days spanned by the booking (UTC dates), as Booking.days
+        values['days'] = end // DAY_SECONDS - start // DAY_SECONDS + 1
+
+        # Daily cost of each booking resource, from a lookup array
+        rids = np.asarray(values['resource_id'], dtype=np.int64)
+        costs = np.zeros(max(list(dailyCosts) + [0]) + 1, dtype=np.int64)
+        for rid, cost in dailyCosts.items():
+            costs[rid] = cost or 0
+        rids[rids >= len(costs)] = 0
+        values['base_cost'] = values['days'] * costs[rids]
+
+        return cls(types, **values)
+
+    def __len__(self):
+        return len(self._columns['id'])
+
+    def __getitem__(self, name):
+        """ Return the array of the given column (also derived ones). """
+        if name == 'total_cost':
+            return self._columns['base_cost'] + self._columns['extra_cost']
+        if name == 'month':
+            months = self._columns['start'].astype('datetime64[s]').astype(
+                'datetime64[M]').astype(np.int64)  # months since 1970
+            return (months // 12 + 1970) * 100 + months % 12 + 1
+        return self._columns[name]
+
+    def is_type(self, *types):
+        """ Return a mask with bookings of any of the given types. """
+        codes = [self.types.index(t) for t in types]
+        return np.isin(self._columns['type'], codes)
+
+    def select(self, mask):
+        """ Return a new frame with the rows selected by the mask. """
+        return BookingFrame(self.types,
+                            **{c: a[mask] for c, a in self._columns.items()})
+
+    def group_sum(self, key, values=None):
+        """ Sum values grouped by key.
+
+        Args:
+            key: column name or tuple with column names.
+            values: column name to sum, if None count the rows.
+        Returns:
+            dict with key value (or tuple of values) -> sum
+        """
+        keys, inverse = self.__group(key)
+        if values is None:
+            sums = np.bincount(inverse, minlength=len(keys))
+        else:
+            sums = np.bincount(inverse, weights=self[values],
+                               minlength=len(keys)).round().astype(np.int64)
+        return {k: int(s) for k, s in zip(keys, sums)}
+
+    def group_values(self, key, values):
+        """ Return a dict key -> list of values in the group, in the same
+        order of the rows. """
+        keys, inverse = self.__group(key)
+        order = np.argsort(inverse, kind='stable')
+        splits = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+        groups = np.split(self[values][order], splits)
+        return {k: g.tolist() for k, g in zip(keys, groups)}
+
+    def group_unique(self, key, values):
+        """ Return a dict key -> set of distinct values in the group. """
+        result = {}
+        for k, v in zip(*self.__group_pairs(key, values)):
+            result.setdefault(k, set()).add(v)
+        return result
+
+    def __group(self, key):
+        if isinstance(key, str):
+            keys, inverse = np.unique(self[key], return_inverse=True)
+            return [int(k) for k in keys], inverse
+        stacked = np.stack([self[k] for k in key], axis=1)
+        keys, inverse = np.unique(stacked, axis=0, return_inverse=True)
+        return [tuple(int(v) for v in k) for k in keys], inverse.ravel()
+
+    def __group_pairs(self, key, values):
+        pairs = np.unique(np.stack([self[key], self[values]], axis=1), axis=0)
+        return [int(k) for k in pairs[:, 0]], [int(v) for v in pairs[:, 1]]
+
+
+def _extra_cost(extra):
+    """ Sum of extra costs, ignoring invalid values (as Booking.total_cost).
+    """
+    cost = 0
+    for _, _, c in (extra or {}).get('costs', []):
+        try:
+            cost += int(c)
+        except:
+            pass
+    return cost
@@ -0,0 +1,160 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+import time
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+
+class BookingIndex:
+    """ In-memory index of bookings intervals, grouped by resource.
+
+    For each resource, bookings are kept in a list sorted by start time
+    (as epoch seconds) together with the maximum duration of any booking
+    in that resource. Overlapping bookings with a given [start, end] range
+    are found by bisecting the starts in the range [start - maxDuration, end],
+    so the lookup cost is O(log n + k).
+
+    The index is filled from the database and kept updated by the
+    DataManager when bookings are created, updated or deleted. The 'version'
+    attribute stores the 'bookings' data version that the index reflects.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """ Remove all items and mark the index as not loaded. """
+        self._resources = {}  # resource_id -> _ResourceIntervals
+        self._items = {}  # booking_id -> (resource_id, start, end, type)
+        self.version = None
+        self.loadTime = None
+
+    @property
+    def loaded(self):
+        return self.version is not None
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, booking_id):
+        return booking_id in self._items
+
+    @staticmethod
+    def _ts(value):
+        return value if isinstance(value, (int, float)) else value.timestamp()
+
+    def load(self, rows, version):
+        """ Load the index from rows (id, resource_id, start, end, type). """
+        self.clear()
+        for row in rows:
+            self.add(*row)
+        self.version = version
+        self.loadTime = time.time()
+
+    def add(self, booking_id, resource_id, start, end, btype):
+        """ Add a booking to the index (or replace it if already there). """
+        if booking_id in self._items:
+            self.remove(booking_id)
+
+        item = (resource_id, self._ts(start), self._ts(end), btype)
+        self._items[booking_id] = item
+
+        if resource_id not in self._resources:
+            self._resources[resource_id] = _ResourceIntervals()
+        self._resources[resource_id].add(booking_id, item[1], item[2], btype)
+
+    def remove(self, booking_id):
+        """ Remove the booking from the index (if it is there). """
+        item = self._items.pop(booking_id, None)
+        if item is not None:
+            self._resources[item[0]].remove(booking_id, item[1])
+
+    def overlap(self, resource_id, start, end, slots=None):
+        """ Return ids of the bookings in resource that overlap [start, end].
+
+        Args:
+            slots: If None, all bookings are returned. If True, only slots
+                and if False only non-slot bookings are returned.
+        """
+        intervals = self._resources.get(resource_id, None)
+        if intervals is None:
+            return []
+        return intervals.overlap(self._ts(start), self._ts(end), slots)
+
+    def items(self):
+        """ Iterate over (id, (resource_id, start, end, type)) items. """
+        return self._items.items()
+
+    def check(self, rows):
+        """ Compare the index with rows (id, resource_id, start, end, type).
+
+        Returns:
+            A list of (booking_id, index_item, row_item) with differences,
+            empty if the index is consistent.
+        """
+        rowItems = {r[0]: (r[1], self._ts(r[2]), self._ts(r[3]), r[4])
+                    for r in rows}
+        diffs = []
+        for bid in set(rowItems) | set(self._items):
+            a, b = self._items.get(bid, None), rowItems.get(bid, None)
+            if a != b:
+                diffs.append((bid, a, b))
+        return sorted(diffs, key=lambda d: d[0])
+
+
+class _ResourceIntervals:
+    """ Sorted intervals for a single resource. """
+    def __init__(self):
+        self.starts = []  # sorted list of (start, booking_id)
+        self.entries = {}  # booking_id -> (end, is_slot)
+        self.maxDuration = 0
+
+    def add(self, booking_id, start, end, btype):
+        insort(self.starts, (start, booking_id))
+        self.entries[booking_id] = (end, btype == 'slot')
+        self.maxDuration = max(self.maxDuration, end - start)
+
+    def remove(self, booking_id, start):
+        i = bisect_left(self.starts, (start, booking_id))
+        if i < len(self.starts) and self.starts[i] == (start, booking_id):
+            del self.starts[i]
+        del self.entries[booking_id]
+        # maxDuration is not reduced, it is only an upper bound
+
+    def overlap(self, start, end, slots=None):
+        starts = self.starts
+        lo = bisect_left(starts, (start - self.maxDuration, ))
+        hi = bisect_right(starts, (end, float('inf')))
+        result = []
+        for i in range(lo, hi):
+            bStart, bid = starts[i]
+            bEnd, isSlot = self.entries[bid]
+            if bEnd >= start and (slots is None or slots == isSlot):
+                result.append(bid)
+        return result
@@ -26,6 +26,11 @@
 # *
 # **************************************************************************
 
+import sys
+import time
+import queue
+import threading
+
 from sqlalchemy import Column, Integer, String, JSON
 from sqlalchemy_utc import UtcDateTime
 
@@ -35,8 +40,23 @@ from .data_db import DbManager
 class DataLog(DbManager):
     """ Main class that will manage the logs about data operations.
     """
-    def __init__(self, dbPath, cleanDb=False):
-        self.init_db(dbPath, cleanDb=cleanDb)
+    def __init__(self, dbPath, cleanDb=False, engineOptions=None,
+                 buffered=False, flushInterval=0.5, flushSize=100,
+                 maxRetrySize=10000):
+        """
+        Args:
+            buffered: If True, logs are written in batches from a background
+                thread, instead of one commit per log (the default).
+            flushInterval: max seconds that a buffered log waits to be written.
+            flushSize: max number of logs written in a single batch.
+            maxRetrySize: max number of logs kept to be written again after
+                write errors, the oldest ones are dropped.
+        """
+        self.init_db(dbPath, cleanDb=cleanDb, engineOptions=engineOptions)
+        self._writer = (LogWriter(self, flushInterval=flushInterval,
+                                  flushSize=flushSize,
+                                  maxRetrySize=maxRetrySize)
+                        if buffered else None)
 
     def _create_models(self):
         """ Function called from the init_db method. """
@@ -71,20 +91,164 @@ class DataLog(DbManager):
 
     def log(self, log_user_id, log_type, log_name,
             *args, **kwargs):
-
-        log = self.Log(
-            user_id=log_user_id,
-            type=log_type,
-            name=log_name,
-            timestamp=self.now(),
-            args=args,
-            kwargs=kwargs)
-
+        """ Write a new log. Return the committed Log instance or,
+        in buffered mode, the dict of values queued to be written.
+        """
+        row = dict(user_id=log_user_id,
+                   type=log_type,
+                   name=log_name,
+                   timestamp=self.now(),
+                   args=args,
+                   kwargs=kwargs)
+
+        if self._writer is not None:
+            self._writer.put(row)
+            return row
+
+        log = self.Log(**row)
         self._db_session.add(log)
         self.commit()
-
         return log
 
     def get_logs(self):
+        self.flush()
         return self._db_session.query(self.Log).all()
 
+    def flush(self):
+        """ Wait until all buffered logs are written. """
+        if self._writer is not None:
+            self._writer.flush()
+
+    def get_stats(self):
+        """ Return a dict with the buffered writer metrics. """
+        if self._writer is None:
+            return {'buffered': False}
+        return self._writer.get_stats()
+
+    def close(self):
+        self.flush()
+        DbManager.close(self)
+
+    def dispose(self):
+        if self._writer is not None:
+            self._writer.stop()
+        DbManager.dispose(self)
+
+
+class LogWriter:
+    """ Write Log rows in batches from a background thread.
+
+    Rows are put in a queue and the thread inserts them (in a single
+    transaction) when flushSize rows are collected or flushInterval
+    seconds passed since the first one. The thread is started with the
+    first log, so it is also started after a process fork.
+    """
+    _FLUSH = 'flush'
+    _STOP = 'stop'
+
+    def __init__(self, dataLog, flushInterval=0.5, flushSize=100,
+                 maxRetrySize=10000):
+        self._engine = dataLog._db_engine
+        self._table = dataLog.Log.__table__
+        self.flushInterval = flushInterval
+        self.flushSize = flushSize
+        self.maxRetrySize = maxRetrySize
+        self._queue = queue.Queue()
+        self._failed = []  # rows to retry after a write error
+        self._thread = None
+        self._lock = threading.Lock()
+        # Stats are updated from the writer thread and read from requests
+        self._statsLock = threading.Lock()
+        self._stats = {'written': 0, 'flushes': 0, 'errors': 0, 'dropped': 0,
+                       'last_flush_ms': 0.0, 'max_flush_ms': 0.0,
+                       'total_flush_ms': 0.0}
+
+    def put(self, row):
+        self._start()
+        self._queue.put(row)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='DataLogWriter',
+                                                daemon=True)
+                self._thread.start()
+
+    def _is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def flush(self):
+        """ Write all queued rows and wait until it is done. """
+        if self._is_running():
+            self._queue.put(self._FLUSH)
+            self._queue.join()
+
+    def stop(self):
+        """ Write all queued rows and stop the background thread. """
+        if self._is_running():
+            self._queue.put(self._STOP)
+            self._thread.join()
+
+    def _run(self):
+        q = self._queue
+        markers = (self._FLUSH, self._STOP)
+        stop = False
+
+        while not stop:
+            items = [q.get()]
+            deadline = time.monotonic() + self.flushInterval
+            while items[-1] not in markers and len(items) < self.flushSize:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stop = items[-1] is self._STOP
+            self._write([i for i in items if i not in markers])
+            for _ in items:
+                q.task_done()
+
+    def _write(self, rows):
+        rows = self._failed + rows
+        if not rows:
+            return
+
+        t = time.monotonic()
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(self._table.insert(), rows)
+        except Exception as e:
+            # Keep the newest rows to retry, up to maxRetrySize
+            dropped = max(0, len(rows) - self.maxRetrySize)
+            with self._statsLock:
+                self._failed = rows[dropped:]
+                self._stats['errors'] += 1
+                self._stats['dropped'] += dropped
+            print("ERROR writing %d logs (%d dropped): %s"
+                  % (len(rows), dropped, e), file=sys.stderr)
+            return
+
+        ms = (time.monotonic() - t) * 1000
+        with self._statsLock:
+            self._failed = []
+            stats = self._stats
+            stats['written'] += len(rows)
+            stats['flushes'] += 1
+            stats['last_flush_ms'] = ms
+            stats['max_flush_ms'] = max(stats['max_flush_ms'], ms)
+            stats['total_flush_ms'] += ms
+
+    def get_stats(self):
+        """ Return queue depth and flush latency metrics. """
+        with self._statsLock:
+            stats = dict(self._stats)
+            failed = len(self._failed)
+        flushes = stats['flushes']
+        stats['avg_flush_ms'] = stats['total_flush_ms'] / flushes if flushes else 0.0
+        stats['queue_depth'] = self._queue.qsize() + failed
+        stats['buffered'] = True
+        return stats
@@ -28,15 +28,21 @@
 
 import datetime as dt
 import os
+import copy
 import uuid
+import time
+import threading
 from collections import defaultdict
 
 import emhub.utils
 import sqlalchemy
+from sqlalchemy.orm import joinedload, selectinload
 
 from emhub.utils import datetime_from_isoformat, datetime_to_isoformat
 from .data_db import DbManager
 from .data_log import DataLog
+from .data_index import BookingIndex
+from .data_frame import BookingFrame
 from .data_models import create_data_models
 from .data_session import H5SessionData
 
@@ -44,8 +50,16 @@ from .data_session import H5SessionData
 class DataManager(DbManager):
     """ Main class that will manage the sessions and their information.
     """
+    # Changes of bookings overlapping the next UPCOMING_DAYS also increase
+    # the 'bookings:upcoming' data version (e.g. used by the dashboard)
+    UPCOMING_DAYS = 31
+    # Min seconds between reloads of the bookings index when it is outdated
+    # by changes from other processes (meanwhile, the database is queried)
+    BOOKING_INDEX_RELOAD = 60
+
     def __init__(self, dataPath, dbName='emhub.sqlite',
-                 user=None, cleanDb=False, create=True):
+                 user=None, cleanDb=False, create=True, engineOptions=None,
+                 logOptions=None):
         self._dataPath = dataPath
         self._sessionsPath = os.path.join(dataPath, 'sessions')
         self._entryFiles = os.path.join(dataPath, 'entry_files')
@@ -53,15 +67,38 @@ class DataManager(DbManager):
 
         # Initialize main database
         dbPath = os.path.join(dataPath, dbName)
-        self.init_db(dbPath, cleanDb=cleanDb, create=create)
+        self.init_db(dbPath, cleanDb=cleanDb, create=create,
+                     engineOptions=engineOptions)
 
         self._lastSession = None
         self._user = user  # Logged user
 
+        # In-memory index of bookings intervals, loaded when first needed
+        self._bookingIndex = BookingIndex()
+
+        # Cache of values read from configuration Forms, valid while the
+        # 'forms' data version does not change
+        self._configCache = {}
+        self._configVersion = None
+        self._configChecked = False
+
+        # Notified when sessions are set 'pending' by this process, other
+        # processes are noticed from the 'sessions:pending' data version
+        self._pendingSessions = threading.Condition()
+
+        # Keep track of changes to update data versions and the index
+        for event, func in [('after_flush', self.__after_flush),
+                            ('after_commit', self.__after_commit),
+                            ('after_rollback', self.__after_rollback)]:
+            sqlalchemy.event.listen(self._db_session, event, func)
+
         if create:
             # Create a separate database for logs
             logDbPath = dbPath.replace('.sqlite', '-logs.sqlite')
-            self._db_log = DataLog(logDbPath, cleanDb=cleanDb)
+            # (logOptions can enable the buffered writer, see DataLog)
+            self._db_log = DataLog(logDbPath, cleanDb=cleanDb,
+                                   engineOptions=engineOptions,
+                                   **(logOptions or {}))
 
             # Create sessions dir if not exists
             os.makedirs(self._sessionsPath, exist_ok=True)
@@ -69,6 +106,44 @@ class DataManager(DbManager):
     def _create_models(self):
         """ Function called from the init_db method. """
         create_data_models(self)
+        self._load_profiles = self.__create_load_profiles()
+
+    def __create_load_profiles(self):
+        """ Create named loading profiles, with the relationships that will
+        be loaded together with the items (instead of one lazy load per item)
+        for the pages that list many of them.
+        Returns:
+            dict with profile name -> (ModelClass, [loader options])
+        """
+        B, U, A, S = self.Booking, self.User, self.Application, self.Session
+
+        # Relationships used when converting a booking to an event
+        bookingOptions = [joinedload(B.resource),
+                          selectinload(B.owner).selectinload(U.pi),
+                          selectinload(B.operator),
+                          selectinload(B.creator),
+                          selectinload(B.application).selectinload(A.creator)]
+
+        return {
+            'calendar': (B, bookingOptions),
+            # Reports also convert bookings to events (with pi info)
+            'report': (B, bookingOptions),
+            'session_list': (S, [selectinload(S.operator),
+                                 selectinload(S.booking).options(*bookingOptions)])
+        }
+
+    def get_load_options(self, ModelClass, load):
+        """ Return the loader options for the given profile name.
+        Raise an exception if the profile does not exist or is defined
+        for a different model. """
+        if load not in self._load_profiles:
+            raise Exception("Invalid loading profile '%s'" % load)
+
+        profileClass, options = self._load_profiles[load]
+        if profileClass is not ModelClass:
+            raise Exception("Loading profile '%s' is for %s items, not %s"
+                            % (load, profileClass.__name__, ModelClass.__name__))
+        return options
 
     def log(self, log_type, log_name, *args, **kwargs):
         log_user_id = None if self._user is None else self._user.id
@@ -79,6 +154,198 @@ class DataManager(DbManager):
     def get_logs(self):
         return self._db_log.get_logs()
 
+    def flush_logs(self):
+        """ Wait until all buffered logs are written. """
+        self._db_log.flush()
+
+    def get_log_stats(self):
+        """ Return the logs writer metrics (e.g. queue depth, flush latency).
+        """
+        return self._db_log.get_stats()
+
+    def close_logs(self):
+        """ Write pending logs and stop the logs writer.
+        Should be called when the application is shutting down. """
+        self._db_log.dispose()
+
+    # ----------------------- DATA VERSIONS ----------------------------
+    def get_data_version(self, name):
+        """ Return the current version of a given table (e.g 'bookings').
+        The version is increased every time the table is modified.
+        """
+        version = self._db_session.query(self.DataVersion.version).filter_by(
+            name=name).scalar()
+        return version or 0
+
+    def get_data_versions(self, *names):
+        """ Return a tuple with the versions of the given names,
+        with a single query. """
+        DV = self.DataVersion
+        query = self._db_session.query(DV.name, DV.version).filter(
+            DV.name.in_(names))
+        versions = dict(query.all())
+        return tuple(versions.get(n, 0) for n in names)
+
+    def bump_data_version(self, *names):
+        """ Increase the version of the given names, when data related
+        to them is modified out of the database (e.g. resource images).
+        """
+        for name in names:
+            self._db_session.execute(_SQL_BUMP_VERSION, {'name': name})
+        self.commit()
+
+    def __after_flush(self, session, flush_context):
+        """ Increase the version of modified tables, in the same transaction,
+        and keep track of bookings changes to update the index on commit.
+        """
+        tables = set()
+        changes = session.info.setdefault('data_changes',
+                                          {'versions': {}, 'bookings': []})
+        usage = defaultdict(lambda: 0)  # (application_id, resource_id) -> days
+
+        def _usage(values, sign):
+            app_id, rid, start, end = values
+            if None not in values:
+                usage[(app_id, rid)] += sign * _usage_days(start, end)
+
+        entries = {}  # entry_id -> grid slots rows (None if removed)
+        now = self.now()
+        upcoming = (now, now + dt.timedelta(days=self.UPCOMING_DAYS))
+
+        def _upcoming(values):
+            start, end = values[2:]
+            return (start is not None and end is not None
+                    and start <= upcoming[1] and end >= upcoming[0])
+
+        def _add(obj, op):
+            name = getattr(obj, '__tablename__', None)
+            if name is None:
+                return
+            tables.add(name)
+            if name == 'entries':
+                entries[obj.id] = (_entry_grid_slots(obj.id, obj.type, obj.extra)
+                                   if op == 'add' else None)
+            if name == 'bookings':
+                changes['bookings'].append(
+                    (op, (obj.id, obj.resource_id, obj.start, obj.end, obj.type)))
+                # Update the quota usage ledger with previous and new values
+                values = _booking_usage_values(obj)
+                if op == 'add':
+                    _usage(values, 1)
+                if obj not in session.new:
+                    previous = _booking_usage_values(obj, previous=True)
+                    _usage(previous, -1)
+                else:
+                    previous = values
+                if _upcoming(values) or _upcoming(previous):
+                    tables.add('bookings:upcoming')
+            if name == 'sessions' and op == 'add' and obj.status == 'pending':
+                tables.add('sessions:pending')
+
+        for obj in session.new:
+            _add(obj, 'add')
+        for obj in session.dirty:
+            if session.is_modified(obj):
+                _add(obj, 'add')
+        for obj in session.deleted:
+            _add(obj, 'remove')
+
+        if 'applications' in tables or 'users' in tables:
+            # Cached permissions might depend on applications creator
+            for obj in list(session.identity_map.values()):
+                if isinstance(obj, self.User):
+                    obj.clear_permissions()
+
+        conn = session.connection()
+        tags = {}
+        for (app_id, rid), days in usage.items():
+            if days == 0:
+                continue
+            if rid not in tags:
+                tags[rid] = _resource_tags(conn, rid)
+            for tag in [''] + tags[rid]:
+                conn.execute(_SQL_ADD_USAGE, {'application_id': app_id,
+                                              'resource_id': rid,
+                                              'tag': tag, 'days': days})
+
+        # Replace the grid slots of modified entries
+        for entry_id, slots in entries.items():
+            conn.execute(_SQL_DELETE_GRID_SLOTS, {'entry_id': entry_id})
+            if slots:
+                conn.execute(self.GridSlot.__table__.insert(), slots)
+
+        for name in tables:
+            conn.execute(_SQL_BUMP_VERSION, {'name': name})
+            v = conn.execute(_SQL_GET_VERSION, {'name': name}).scalar()
+            first, _ = changes['versions'].get(name, (v, v))
+            changes['versions'][name] = (first, v)
+
+    def __after_commit(self, session):
+        changes = session.info.pop('data_changes', None)
+
+        if changes is None:
+            return
+
+        if 'forms' in changes['versions']:
+            self.clear_config_cache()
+
+        if 'sessions:pending' in changes['versions']:
+            with self._pendingSessions:
+                self._pendingSessions.notify_all()
+
+        if 'bookings' not in changes['versions']:
+            return
+
+        first, last = changes['versions']['bookings']
+        index = self._bookingIndex
+
+        with index.lock:
+            # Only apply our changes if the index was up-to-date before them,
+            # otherwise other process also modified bookings and the index
+            # stays outdated until it is reloaded (see get_booking_index)
+            if index.loaded and index.version == first - 1:
+                for op, row in changes['bookings']:
+                    if op == 'add':
+                        index.add(*row)
+                    else:
+                        index.remove(row[0])
+                index.version = last
+
+    def __after_rollback(self, session):
+        session.info.pop('data_changes', None)
+
+    # ----------------------- CONFIG CACHE ----------------------------
+    def close(self):
+        DbManager.close(self)
+        # Check again the forms version on next use (e.g. next request),
+        # in case other process has modified them
+        self._configChecked = False
+
+    def clear_config_cache(self):
+        """ Remove all cached values from configuration Forms. """
+        self._configCache = {}
+        self._configVersion = None
+        self._configChecked = False
+
+    def __cached_config(self, key, loadFunc):
+        """ Return the cached value for key, calling loadFunc if it is not
+        in the cache. The cache is cleared when forms are modified. The
+        'forms' version is only queried once after each close() (i.e once
+        per request), so other config reads are just a dict lookup.
+        Values are shared, so they should not be modified.
+        """
+        if not self._configChecked:
+            version = self.get_data_version('forms')
+            if version != self._configVersion:
+                self._configCache = {}
+                self._configVersion = version
+            self._configChecked = True
+
+        cache = self._configCache
+        if key not in cache:
+            cache[key] = loadFunc()
+        return cache[key]
+
     # ------------------------- USERS ----------------------------------
     def create_admin(self, password='admin'):
         """ Create special user 'admin'. """
@@ -111,16 +378,24 @@ class DataManager(DbManager):
         self.delete(user)
         return user
 
-    def get_users(self, condition=None, orderBy=None, asJson=False):
+    def get_users(self, condition=None, orderBy=None, asJson=False,
+                  **kwargs):
         return self.__items_from_query(self.User,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       **kwargs)
 
     def get_user_by(self, **kwargs):
         """ This should return a single user or None. """
         return self.__item_by(self.User, **kwargs)
 
+    def count_created_applications(self, user):
+        """ Number of applications created by this user. """
+        return self._db_session.query(sqlalchemy.func.count(
+            self.Application.id)).filter(
+            self.Application.creator_id == user.id).scalar()
+
     # ---------------------------- FORMS ---------------------------------
     def create_form(self, **attrs):
         return self.__create_item(self.Form, **attrs)
@@ -153,18 +428,43 @@ class DataManager(DbManager):
 
         return form
 
+    def get_form_definition(self, formName):
+        """ Return the (cached) JSON definition of the form with this name.
+        The returned dict is shared and should not be modified.
+        If the form does not exist, an Exception is thrown.
+        """
+        return self.__cached_config(
+            ('form', formName),
+            lambda: copy.deepcopy(self.get_form_by_name(formName).definition))
+
     # ---------------------------- RESOURCES ---------------------------------
     def create_resource(self, **attrs):
         return self.__create_item(self.Resource, **attrs)
 
     def update_resource(self, **attrs):
+        if 'tags' in attrs:
+            attrs['special_update'] = self.__update_resource_tags
         return self.__update_item(self.Resource, **attrs)
 
-    def get_resources(self, condition=None, orderBy=None, asJson=False):
+    def __update_resource_tags(self, resource, attrs):
+        """ Quota usage is stored by resource tags, so the ledger rows of
+        this resource are computed again, in the same transaction. """
+        tags = attrs['tags']
+        if tags != resource.tags:
+            U = self.QuotaUsage
+            usage = self.__compute_quota_usage(
+                resourceId=resource.id, tags=tags.split() if tags else [])
+            self._db_session.query(U).filter(
+                U.resource_id == resource.id).delete()
+            self.__insert_quota_usage(usage)
+
+    def get_resources(self, condition=None, orderBy=None, asJson=False,
+                      **kwargs):
         return self.__items_from_query(self.Resource,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       **kwargs)
 
     def get_resource_by(self, **kwargs):
         """ This should return a single Resource or None. """
@@ -180,15 +480,53 @@ class DataManager(DbManager):
         return os.path.join(self._resourceFiles,
                             'resource-image-%06d-%s' % (resource.id, fn))
 
+    def get_resource_thumbnail(self, resource, create=True):
+        """ Return the (path, version) of the resource image thumbnail.
+
+        Thumbnails are stored in the 'thumbnails' folder, with the
+        resource id and the image modification time in the name. They are
+        created the first time that are requested after the image changes,
+        so only a stat of the image is done if the thumbnail already exists.
+        Returns (None, None) if the resource image file does not exist.
+        """
+        imagePath = self.get_resource_image_path(resource)
+        try:
+            version = int(os.stat(imagePath).st_mtime)
+        except OSError:
+            return None, None
+
+        thumbDir = os.path.join(self._resourceFiles, 'thumbnails')
+        prefix = 'resource-thumb-%06d-' % resource.id
+        thumbPath = os.path.join(thumbDir, '%s%d.png' % (prefix, version))
+
+        if create and not os.path.exists(thumbPath):
+            from emhub.utils.image import create_thumbnail
+            os.makedirs(thumbDir, exist_ok=True)
+            # Remove thumbnails from previous images
+            for fn in os.listdir(thumbDir):
+                if fn.startswith(prefix) and fn.endswith('.png'):
+                    try:
+                        os.remove(os.path.join(thumbDir, fn))
+                    except FileNotFoundError:  # removed by other process
+                        pass
+            try:
+                create_thumbnail(imagePath, thumbPath)
+            except OSError:  # also raised by PIL for invalid images
+                return None, None
+
+        return thumbPath, version
+
     # ---------------------------- APPLICATIONS --------------------------------
     def create_template(self, **attrs):
         return self.__create_item(self.Template, **attrs)
 
-    def get_templates(self, condition=None, orderBy=None, asJson=False):
+    def get_templates(self, condition=None, orderBy=None, asJson=False,
+                      **kwargs):
         return self.__items_from_query(self.Template,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       **kwargs)
 
     def get_template_by(self, **kwargs):
         """ Return a single Template or None. """
@@ -217,11 +555,13 @@ class DataManager(DbManager):
             attrs['creator_id'] = self._user.id
         return self.__create_item(self.Application, **attrs)
 
-    def get_applications(self, condition=None, orderBy=None, asJson=False):
+    def get_applications(self, condition=None, orderBy=None, asJson=False,
+                         **kwargs):
         return self.__items_from_query(self.Application,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       **kwargs)
 
     def get_visible_applications(self):
         return [a for a in self.get_applications()
@@ -238,7 +578,6 @@ class DataManager(DbManager):
 
     def __update_application_pi(self, application, pi_to_add, pi_to_remove):
         errorMsg = ""
-        pi_list = application.pi_list
 
         def _get_pi(pid):
             pi = self.get_user_by(id=int(pid))
@@ -258,7 +597,7 @@ class DataManager(DbManager):
             if pi is None:
                 continue
 
-            if pi in pi_list:
+            if application.has_pi(pi):
                 errorMsg += "\nPI %s is already in the Application" % pi.name
                 continue
 
@@ -271,7 +610,7 @@ class DataManager(DbManager):
             if pi is None:
                 continue
 
-            if pi not in pi_list:
+            if not application.has_pi(pi):
                 errorMsg += "\nPI %s is not in the Application" % pi.name
                 continue
 
@@ -313,11 +652,7 @@ class DataManager(DbManager):
         bookings = []
 
         def _add_booking(attrs):
-            b = self.create_basic_booking(attrs)
-            self.__validate_booking(b,
-                                    check_min_booking=check_min_booking,
-                                    check_max_booking=check_max_booking)
-            bookings.append(b)
+            bookings.append(self.create_basic_booking(attrs))
 
         if repeat_value == 'no':
             _add_booking(attrs)
@@ -331,9 +666,16 @@ class DataManager(DbManager):
                 _add_booking(attrs)
                 repeater.move()  # will move next start,end in attrs
 
-        # Insert all created bookings
+        # Validate all occurrences together, sharing the loaded data and
+        # accumulating the quota used by the series itself
+        batch = BookingBatch(bookings)
         for b in bookings:
-            self._db_session.add(b)
+            self.__validate_booking(b, batch=batch,
+                                    check_min_booking=check_min_booking,
+                                    check_max_booking=check_max_booking)
+
+        # Insert all created bookings in a single transaction
+        self._db_session.add_all(bookings)
         self.commit()
 
         # Log operations after create
@@ -357,7 +699,7 @@ class DataManager(DbManager):
         repeat = attrs.get('repeat_value', 'no')
         repeater = RepeatRanges(repeat, attrs) if repeat != 'no' else None
 
-        def update(b):
+        def update(b, batch):
             self.__check_cancellation(b, attrs)
             for attr, value in attrs.items():
                 if attr != 'id':
@@ -365,7 +707,7 @@ class DataManager(DbManager):
             if repeater:
                 repeater.move()  # move start, end for repeating bookings
 
-            self.__validate_booking(b)
+            self.__validate_booking(b, batch=batch)
 
         result = self._modify_bookings(attrs, update)
 
@@ -378,45 +720,146 @@ class DataManager(DbManager):
         """ Return a single Application or None. """
         return self.__item_by(self.Booking, **kwargs)
 
-    def get_bookings(self, condition=None, orderBy=None, asJson=False):
+    def get_bookings(self, condition=None, orderBy=None, asJson=False,
+                     load=None, **kwargs):
+        """ Return bookings matching the condition.
+
+        Args:
+            load: optional loading profile name (e.g 'calendar' or 'report')
+                to also load the relationships required by that page.
+        """
         return self.__items_from_query(self.Booking,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       load=load,
+                                       **kwargs)
+
+    def get_bookings_range(self, start, end, resource=None, load=None,
+                           owners=None):
+        """ Return the bookings overlapping with the [start, end] range,
+        sorted by start.
+
+        Args:
+            start: datetime (timezone aware) of the range start.
+            end: datetime (timezone aware) of the range end.
+            resource: optional Resource (or resource id) to restrict the query.
+            load: optional loading profile name (see get_bookings).
+            owners: optional list of owner ids to restrict the query.
+        """
+        query = self._query_bookings_range(start, end, resource=resource)
+        if owners is not None:
+            query = query.filter(self.Booking.owner_id.in_(owners))
+        if load is not None:
+            query = query.options(*self.get_load_options(self.Booking, load))
+        return query.all()
+
+    def get_bookings_by_ids(self, ids, load=None):
+        """ Return the bookings with the given ids, sorted by start. """
+        if not len(ids):
+            return []
+        query = self._db_session.query(self.Booking).filter(
+            self.Booking.id.in_([int(i) for i in ids]))
+        if load is not None:
+            query = query.options(*self.get_load_options(self.Booking, load))
+        return query.order_by(self.Booking.start).all()
+
+    def get_booking_frame(self, start=None, end=None):
+        """ Return a BookingFrame with the bookings overlapping the
+        [start, end] range (all bookings if start and end are None).
+        Only the needed columns are loaded, with a single query.
+        """
+        B, U = self.Booking, self.User
+        query = self._db_session.query(
+            B.id, B.start, B.end, B.resource_id, B.owner_id,
+            B.application_id, B.type, B.extra, U.roles, U.pi_id,
+            B.operator_id, B.title).outerjoin(U, U.id == B.owner_id)
+        if start is not None:
+            query = query.filter(B.end >= start)
+        if end is not None:
+            query = query.filter(B.start <= end)
+
+        dailyCosts = {r.id: r.daily_cost for r in self.get_resources()}
+        return BookingFrame.from_rows(query.order_by(B.start), B.TYPES,
+                                      dailyCosts)
+
+    def _query_bookings_range(self, start, end, resource=None):
+        """ Build the query for bookings overlapping [start, end].
+        Two intervals overlap if each one starts before the other ends,
+        so the query can be served by the indexes on (start, end) and
+        (resource_id, start, end).
+        """
+        Booking = self.Booking
+        query = self._db_session.query(Booking).filter(Booking.start <= end,
+                                                       Booking.end >= start)
+        if resource is not None:
+            rid = resource if isinstance(resource, int) else resource.id
+            query = query.filter(Booking.resource_id == rid)
+
+        return query.order_by(Booking.start)
+
+    def get_booking_index(self, reload=False):
+        """ Return the in-memory index of bookings intervals, or None if
+        it is outdated because bookings were modified by other process.
+        The index is loaded the first time, when reload is True or when it
+        was loaded more than BOOKING_INDEX_RELOAD seconds ago. Otherwise
+        callers should query the database for the bookings range.
+        """
+        index = self._bookingIndex
+        version = self.get_data_version('bookings')
+
+        with index.lock:
+            if index.version != version:
+                if (reload or not index.loaded or time.time() - index.loadTime
+                        >= self.BOOKING_INDEX_RELOAD):
+                    index.load(self.__booking_index_rows(), version)
+                else:
+                    return None
 
-    def get_bookings_range(self, start, end, resource=None):
-        """ Shortcut function to retrieve a range of bookings. """
-        # JMRT: For some reason the retrieval of the date ranges is not working
-        # as expected for the time. So we are taking on day before for the start
-        # and one day after for the end and filter later
-        newStart = (start - dt.timedelta(days=1)).replace(hour=23, minute=59)
-        newEnd = (end + dt.timedelta(days=1)).replace(hour=0, minute=0)
-        rangeStr = datetime_to_isoformat(newStart), datetime_to_isoformat(newEnd)
+        return index
 
-        startBetween = "(start>='%s' AND start<='%s')" % rangeStr
-        endBetween = "(end>='%s' AND end<='%s')" % rangeStr
-        rangeOver = "(start<='%s' AND end>='%s')" % rangeStr
-        conditionStr = "(%s OR %s OR %s)" % (startBetween, endBetween, rangeOver)
+    def check_booking_index(self):
+        """ Compare the bookings index with the database.
+        Return the list of differences (empty if the index is consistent).
+        """
+        index = self.get_booking_index(reload=True)
+        return index.check(self.__booking_index_rows())
+
+    def __booking_index_rows(self):
+        B = self.Booking
+        return self._db_session.query(B.id, B.resource_id,
+                                      B.start, B.end, B.type).all()
+
+    def get_bookings_overlap(self, booking, resource_id=None):
+        """ Return other bookings overlapping with the given one
+        (in the same resource unless resource_id is passed).
+        The in-memory index is used to find them.
+        """
+        index = self.get_booking_index()
+        rid = resource_id or booking.resource_id
+        B = self.Booking
 
-        if resource is not None:
-            conditionStr += " AND resource_id=%s" % resource.id
+        if index is None:
+            query = self._query_bookings_range(booking.start, booking.end, rid)
+            return query.filter(B.id != booking.id).all()
+
+        ids = [bid for bid in index.overlap(rid, booking.start, booking.end)
+               if bid != booking.id]
 
-        def in_range(b):
-            s, e = b.start, b.end
-            return ((s >= start and s <= end) or
-                    (e >= start and e <= end) or
-                    (s <= start and e >= end))
+        if not ids:
+            return []
 
-        return [b for b in self.get_bookings(condition=conditionStr, orderBy='start')
-                if in_range(b)]
+        return self._db_session.query(B).filter(
+            B.id.in_(ids)).order_by(B.start).all()
 
     def get_next_bookings(self, user):
         """ Retrieve upcoming (from now) bookings for this user. """
-        conditionStr = "start>='%s'" % datetime_to_isoformat(self.now())
+        B = self.Booking
+        query = self._db_session.query(B).filter(B.start >= self.now())
         if user:
-            conditionStr += " AND owner_id=%s" % user.id
+            query = query.filter(B.owner_id == user.id)
 
-        return self.get_bookings(condition=conditionStr, orderBy='start')
+        return query.order_by(B.start).all()
 
     def delete_booking(self, **attrs):
         """ Delete one or many bookings (in case of repeating events)
@@ -426,7 +869,7 @@ class DataManager(DbManager):
             modify_all: Boolean flag in case the booking is a repeating event.
                 If True, all bookings from this one, will be also deleted.
         """
-        def delete(b):
+        def delete(b, batch):
             self.__check_cancellation(b)
             self.delete(b, commit=False)
 
@@ -442,32 +885,100 @@ class DataManager(DbManager):
         pass
 
     def count_booking_resources(self, applications,
-                                resource_ids=None, resource_tags=None):
+                                resource_ids=None, resource_tags=None,
+                                exclude_ids=None):
         """ Count how many days has been used by applications from the
         current bookings. The count can be done by resources or by tags.
+        Values are read from the quota usage ledger (see QuotaUsage).
+        Bookings with id in exclude_ids are not counted.
         """
         application_ids = set(a for a in applications)
         count_dict = defaultdict(lambda: defaultdict(lambda: 0))
 
-        for b in self.get_bookings():
-            if b.application is None:
-                continue
-
-            baid = b.application.id
-            if baid in application_ids:
-                rid = b.resource.id
-                if resource_tags is not None:
-                    for tag in resource_tags:
-                        if tag in b.resource.tags:
-                            count_dict[baid][tag] += b.days
-                elif not resource_ids or rid in resource_ids:
-                    count_dict[baid][rid] += b.days
+        def _count(app_id, rid, tag, days):
+            if resource_tags is not None:
+                if tag in resource_tags:
+                    count_dict[app_id][tag] += days
+            elif tag == '' and (not resource_ids or rid in resource_ids):
+                count_dict[app_id][rid] += days
+
+        U = self.QuotaUsage
+        query = self._db_session.query(U).filter(
+            U.application_id.in_(application_ids), U.days != 0)
+        for u in query:
+            _count(u.application_id, u.resource_id, u.tag, u.days)
+
+        if exclude_ids:
+            B = self.Booking
+            conn = self._db_session.connection()
+            # Query only columns to get the stored values
+            query = self._db_session.query(
+                B.application_id, B.resource_id, B.start, B.end).filter(
+                B.id.in_(exclude_ids), B.application_id.in_(application_ids))
+            for app_id, rid, start, end in query:
+                days = _usage_days(start, end)
+                for tag in [''] + _resource_tags(conn, rid):
+                    _count(app_id, rid, tag, -days)
 
         return count_dict
 
+    def get_application_usage(self, application):
+        """ Return a dict with the days used by the application
+        for each resource tag. """
+        U = self.QuotaUsage
+        query = self._db_session.query(U.tag, sqlalchemy.func.sum(U.days)).filter(
+            U.application_id == application.id, U.tag != '').group_by(U.tag)
+        return {tag: days for tag, days in query}
+
+    def __compute_quota_usage(self, resourceId=None, tags=None):
+        """ Compute the quota usage ledger rows from all bookings, or only
+        from the bookings of one resource (optionally with the given tags).
+        """
+        B = self.Booking
+        query = self._db_session.query(
+            B.application_id, B.resource_id, B.start, B.end).filter(
+            B.application_id.isnot(None))
+        if resourceId is not None:
+            query = query.filter(B.resource_id == resourceId)
+        return _compute_quota_usage(
+            self._db_session.connection(), query,
+            tags=None if tags is None else {resourceId: tags})
+
+    def __insert_quota_usage(self, usage):
+        if usage:
+            self._db_session.execute(self.QuotaUsage.__table__.insert(), [
+                {'application_id': a, 'resource_id': r, 'tag': t, 'days': d}
+                for (a, r, t), d in usage.items()])
+
+    def rebuild_quota_usage(self):
+        """ Recreate the quota usage ledger from all bookings.
+        Returns the number of rows in the ledger.
+        """
+        usage = self.__compute_quota_usage()
+        self._db_session.query(self.QuotaUsage).delete()
+        self.__insert_quota_usage(usage)
+        self.commit()
+        self.log('operation', 'rebuild_QuotaUsage', rows=len(usage))
+        return len(usage)
+
+    def verify_quota_usage(self):
+        """ Compare the quota usage ledger with the values computed from
+        all bookings. Returns a list of differences as tuples:
+            (application_id, resource_id, tag, ledger_days, computed_days)
+        """
+        usage = self.__compute_quota_usage()
+        ledger = {(u.application_id, u.resource_id, u.tag): u.days
+                  for u in self._db_session.query(self.QuotaUsage)}
+        diffs = []
+        for key in sorted(set(usage) | set(ledger)):
+            a, b = ledger.get(key, 0), usage.get(key, 0)
+            if a != b:
+                diffs.append(key + (a, b))
+        return diffs
+
     # ---------------------------- SESSIONS -----------------------------------
-    def __get_section(self, sectionName):
-        formDef = self.get_form_by_name('sessions_config').definition
+    def __get_section(self, sectionName, formDef=None):
+        formDef = formDef or self.get_form_definition('sessions_config')
         for s in formDef['sections']:
             if s['label'] == sectionName:
                 return formDef, s
@@ -479,27 +990,35 @@ class DataManager(DbManager):
             yield p
 
     def __get_session_dict(self, section):
-        return {p['label']: p['value']
-                for p in self.__iter_config_params(section)}
+        return self.__cached_config(
+            ('sessions_config', section),
+            lambda: {p['label']: p['value']
+                     for p in self.__iter_config_params(section)})
 
     def get_session_counter(self, group_code):
-        return int(self.__get_session_dict('counters').get(group_code, 1))
-
-    def update_session_counter(self, group_code, new_counter):
-        # Update counter for this session group
-        formDef, section = self.__get_section('counters')
-
-        found = False
-        for p in section['params']:
-            if p['label'] == group_code:
-                p['value'] = new_counter
-                found = True
-        if not found:
-            section['params'].append({'label': group_code,
-                                      'value': new_counter})
-
-        form = self.get_form_by_name('sessions_config')
-        self.update_form(id=form.id, definition=formDef)
+        """ Return the counter that will be used for the next session
+        of this group. """
+        value = self._db_session.query(self.SessionCounter.value).filter_by(
+            group_code=group_code).scalar()
+        return value or 1
+
+    def next_session_counter(self, group_code):
+        """ Reserve the next counter of this group, with a single atomic
+        update in the current transaction. """
+        return self._db_session.execute(_SQL_NEXT_COUNTER,
+                                        {'code': group_code}).scalar()
+
+    def update_session_counter(self, group_code, new_counter,
+                               onlyIncrease=False, commit=True):
+        """ Set the next counter of this group. If onlyIncrease is True,
+        the counter is only modified if it is lower than new_counter.
+        If commit is False, the update is left in the current transaction.
+        """
+        sql = _SQL_INCREASE_COUNTER if onlyIncrease else _SQL_SET_COUNTER
+        self._db_session.execute(sql, {'code': group_code,
+                                       'value': new_counter})
+        if commit:
+            self.commit()
 
     def get_session_cameras(self, resourceId):
         cameras = []
@@ -517,10 +1036,10 @@ class DataManager(DbManager):
 
     def get_session_processing(self):
         # Load processing options from the 'processing' Form
-        form_proc = self.get_form_by_name('processing')
+        formDef = self.get_form_definition('processing')
 
         processing = []
-        for section in form_proc.definition['sections']:
+        for section in formDef['sections']:
             steps = []
             processing.append({'name': section['label'], 'steps': steps})
             for param in section['params']:
@@ -531,15 +1050,20 @@ class DataManager(DbManager):
     def get_session_data_path(self, session):
         return os.path.join(self._sessionsPath, session.data_path)
 
-    def get_new_session_info(self, booking_id):
+    def get_new_session_info(self, booking_id, reserve=False):
         """ Return the name for the new session, base on the booking and
-        the previous sessions counter (stored in Form 'counters').
+        the previous sessions counter (see SessionCounter).
+        If reserve is True, the counter is increased (in the current
+        transaction), so the name will not be used by other session.
         """
         b = self.get_bookings(condition="id=%s" % booking_id)[0]
         a = b.application
         code = 'fac' if a is None else a.code.lower()
         sep = '' if len(code) == 3 else '_'
-        c = self.get_session_counter(code)
+        if reserve:
+            c = self.next_session_counter(code)
+        else:
+            c = self.get_session_counter(code)
 
         return {
             'code': code,
@@ -547,14 +1071,47 @@ class DataManager(DbManager):
             'name': '%s%s%05d' % (code, sep, c)
         }
 
-    def get_sessions(self, condition=None, orderBy=None, asJson=False):
+    def get_sessions(self, condition=None, orderBy=None, asJson=False,
+                     load=None, **kwargs):
         """ Returns a list.
         condition example: text("id<:value and name=:name")
+        load: optional loading profile name (e.g 'session_list')
         """
         return self.__items_from_query(self.Session,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       load=load,
+                                       **kwargs)
+
+    def wait_pending_sessions(self, timeout=60, interval=1):
+        """ Return all pending sessions. If there are none, wait until
+        some session is set as pending or until timeout seconds are elapsed
+        (returning an empty list).
+        While waiting, the 'sessions:pending' data version is checked every
+        interval seconds (or as soon as this process commits a pending
+        session) with a short-lived connection, so the objects already
+        loaded in the current session are not expired.
+        """
+        deadline = time.time() + timeout
+        name = {'name': 'sessions:pending'}
+
+        with self._db_engine.connect() as conn:
+            version, pending = conn.execute(_SQL_PENDING_SESSIONS, name).one()
+
+        while not pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return []
+            with self._pendingSessions:
+                self._pendingSessions.wait(min(interval, remaining))
+            with self._db_engine.connect() as conn:
+                if conn.execute(_SQL_GET_VERSION, name).scalar() != version:
+                    version, pending = conn.execute(_SQL_PENDING_SESSIONS,
+                                                    name).one()
+
+        return self.get_sessions(condition='status=="pending"',
+                                 load='session_list')
 
     def get_session_by(self, **kwargs):
         """ This should return a single Session or None. """
@@ -573,7 +1130,8 @@ class DataManager(DbManager):
         if 'status' not in attrs:
             attrs['status'] = 'pending'
 
-        session_info = self.get_new_session_info(b.id)
+        # The counter is increased in the same transaction of the new session
+        session_info = self.get_new_session_info(b.id, reserve=True)
         attrs['name'] = session_info['name']
 
         session = self.__create_item(self.Session, **attrs)
@@ -588,18 +1146,19 @@ class DataManager(DbManager):
             data = H5SessionData(self._session_data_path(session), mode='a')
             data.close()
 
-        # Update counter for this session group
-        self.update_session_counter(session_info['code'],
-                                    session_info['counter'] + 1)
-
         return session
 
     def update_session(self, **attrs):
         """ Update session attrs. """
-        session = self.__update_item(self.Session, **attrs)
+        if 'name' in attrs:
+            attrs['special_update'] = self.__update_session_name
+
+        return self.__update_item(self.Session, **attrs)
 
-        # Update the session counter if it was modified
-        name = session.name
+    def __update_session_name(self, session, attrs):
+        """ Increase the session counter (if needed) in the same
+        transaction that updates the session name. """
+        name = attrs['name']
 
         if '_' in name:
             code, counterStr = name.split('_')
@@ -607,12 +1166,8 @@ class DataManager(DbManager):
             code = name[:3]
             counterStr = name[3:]
 
-        c = self.get_session_counter(code)
-        counter = int(counterStr)
-        if c < counter:
-            self.update_session_counter(code, counter + 1)
-
-        return session
+        self.update_session_counter(code, int(counterStr) + 1,
+                                    onlyIncrease=True, commit=False)
 
     def delete_session(self, **attrs):
         """ Remove a session row. """
@@ -647,14 +1202,16 @@ class DataManager(DbManager):
         return session
 
     # -------------------------- INVOICE PERIODS ------------------------------
-    def get_invoice_periods(self, condition=None, orderBy=None, asJson=False):
+    def get_invoice_periods(self, condition=None, orderBy=None, asJson=False,
+                            **kwargs):
         """ Returns a list.
         condition example: text("id<:value and name=:name")
         """
         return self.__items_from_query(self.InvoicePeriod,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       **kwargs)
 
     def create_invoice_period(self, **attrs):
         """ Add a new session row. """
@@ -673,14 +1230,16 @@ class DataManager(DbManager):
         return self.__item_by(self.InvoicePeriod, **kwargs)
 
     # ---------------------------- TRANSACTIONS -------------------------------
-    def get_transactions(self, condition=None, orderBy=None, asJson=False):
+    def get_transactions(self, condition=None, orderBy=None, asJson=False,
+                         **kwargs):
         """ Returns a list.
         condition example: text("id<:value and name=:name")
         """
         return self.__items_from_query(self.Transaction,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       **kwargs)
 
     def create_transaction(self, **attrs):
         """ Add a new session row. """
@@ -744,11 +1303,13 @@ class DataManager(DbManager):
 
         return self.__delete_item(self.Project, **attrs)
 
-    def get_projects(self, condition=None, orderBy=None, asJson=False):
+    def get_projects(self, condition=None, orderBy=None, asJson=False,
+                     **kwargs):
         return self.__items_from_query(self.Project,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       **kwargs)
 
     def get_project_by(self, **kwargs):
         """ This should return a single Resource or None. """
@@ -758,7 +1319,7 @@ class DataManager(DbManager):
     def get_config(self, configName):
         """ Find a form named config:configName and return
         the associated JSON definition. """
-        return self.get_form_by_name(f'config:{configName}').definition
+        return self.get_form_definition(f'config:{configName}')
 
     def get_entry_config(self, entry_type):
         return self.get_config('projects')['entries'][entry_type]
@@ -811,16 +1372,45 @@ class DataManager(DbManager):
         """ Remove a session row. """
         return self.__delete_item(self.Entry, **attrs)
 
-    def get_entries(self, condition=None, orderBy=None, asJson=False):
+    def get_entries(self, condition=None, orderBy=None, asJson=False,
+                    **kwargs):
         return self.__items_from_query(self.Entry,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       **kwargs)
 
     def get_entry_by(self, **kwargs):
         """ This should return a single Resource or None. """
         return self.__item_by(self.Entry, **kwargs)
 
+    def get_grid_slots(self, puckIds):
+        """ Return the grid slots in the given pucks, as a list of
+        (GridSlot, Entry) tuples, sorted by entry and row.
+        """
+        GS, E = self.GridSlot, self.Entry
+        query = self._db_session.query(GS, E).join(E, GS.entry_id == E.id)
+        query = query.filter(GS.puck_id.in_(puckIds))
+        return query.order_by(GS.entry_id, GS.row_index).all()
+
+    def rebuild_grid_slots(self):
+        """ Recreate the grid slots from all 'grids_storage' entries.
+        Returns the number of slots.
+        """
+        E = self.Entry
+        query = self._db_session.query(E.id, E.type, E.extra).filter(
+            E.type == 'grids_storage')
+        slots = []
+        for entry_id, entryType, extra in query:
+            slots.extend(_entry_grid_slots(entry_id, entryType, extra))
+
+        self._db_session.query(self.GridSlot).delete()
+        if slots:
+            self._db_session.execute(self.GridSlot.__table__.insert(), slots)
+        self.commit()
+        self.log('operation', 'rebuild_GridSlots', rows=len(slots))
+        return len(slots)
+
     def get_entry_path(self, entry, filename):
         return os.path.join(self._entryFiles,
                             'entry-file-%06d-%s' % (entry.id, filename))
@@ -869,19 +1459,24 @@ class DataManager(DbManager):
     def delete_puck(self, **attrs):
         return self.__delete_item(self.Puck, **attrs)
 
-    def get_pucks(self, condition=None, orderBy=None, asJson=False):
+    def get_pucks(self, condition=None, orderBy=None, asJson=False,
+                  **kwargs):
         return self.__items_from_query(self.Puck,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       **kwargs)
 
     def get_puck_by(self, **kwargs):
         return self.__item_by(self.Entry, **kwargs)
 
     # --------------- Internal implementation methods -------------------------
     def get_universities_dict(self):
-        formDef = self.get_form_by_name('universities').definition
-        return {p['value']: p['label'] for p in formDef['params']}
+        def _load():
+            formDef = self.get_form_definition('universities')
+            return {p['value']: p['label'] for p in formDef['params']}
+
+        return self.__cached_config('universities', _load)
 
     def __create_item(self, ModelClass, **attrs):
         special_create = attrs.pop('special_create', None)
@@ -896,17 +1491,79 @@ class DataManager(DbManager):
         return new_item
 
     def __items_from_query(self, ModelClass,
-                           condition=None, orderBy=None, asJson=False):
-        query = self._db_session.query(ModelClass)
+                           condition=None, orderBy=None, asJson=False,
+                           load=None, limit=None, after_id=None, attrs=None):
+        """ Query items of the given model.
+
+        Args:
+            condition: SQL condition string (e.g "status='active'")
+            orderBy: column to sort the items.
+            asJson: return json dicts instead of model objects.
+            load: optional loading profile name (see get_load_options)
+            limit: max number of items to return. When limit or after_id
+                are used, items are sorted by id (keyset pagination).
+            after_id: only return items with id greater than this one
+                (i.e. the last id of the previous page).
+            attrs: list of attributes to return in json dicts (only with
+                asJson=True). If all of them are table columns, only those
+                columns are selected. The 'id' is always included when
+                paginating. Without attrs, json dicts have all columns
+                (as ModelClass.json() unless json_from_row is False).
+        """
+        paginate = limit is not None or after_id is not None
+        if paginate and orderBy not in [None, 'id']:
+            raise Exception("Items can only be sorted by 'id' when using "
+                            "'limit' or 'after_id'.")
+
+        # Json dicts are built from the rows of a projected query (no ORM
+        # objects), unless non-column attrs (e.g. 'pi_list') are needed
+        keys = None
+        if asJson:
+            serializer = ModelClass.row_serializer
+            if attrs:
+                attrs = list(attrs)
+                if paginate and 'id' not in attrs:
+                    attrs.insert(0, 'id')
+                if all(a in serializer.keys for a in attrs):
+                    keys = attrs
+            elif getattr(ModelClass, 'json_from_row', True):
+                keys = serializer.keys
+
+        if keys:
+            query = self._db_session.query(*serializer.columns(keys))
+        else:
+            query = self._db_session.query(ModelClass)
+
+        if load is not None and not keys:
+            query = query.options(*self.get_load_options(ModelClass, load))
 
         if condition is not None:
             query = query.filter(sqlalchemy.text(condition))
 
-        if orderBy is not None:
+        if after_id is not None:
+            query = query.filter(ModelClass.id > int(after_id))
+
+        if paginate:
+            query = query.order_by(ModelClass.id)
+        elif orderBy is not None:
             query = query.order_by(orderBy)
 
+        if limit is not None:
+            query = query.limit(int(limit))
+
+        if keys:
+            rowFunc = serializer.row_func(keys)
+            return [rowFunc(row) for row in query]
+
         result = query.all()
-        return [s.json() for s in result] if asJson else result
+        if not asJson:
+            return result
+
+        items = [s.json() for s in result]
+        if attrs:
+            items = [{k: v for k, v in item.items() if k in attrs}
+                     for item in items]
+        return items
 
     def __item_by(self, ModelClass, **kwargs):
         query = self._db_session.query(ModelClass)
@@ -972,8 +1629,18 @@ class DataManager(DbManager):
 
         return self.Booking(**attrs)
 
-    def __validate_booking(self, booking, **kwargs):
-        r = self.get_resource_by(id=booking.resource_id)
+    def __validate_booking(self, booking, batch=None, **kwargs):
+        """ Check that the booking can be created or updated, raising an
+        Exception otherwise. The booking's application is also set here.
+
+        Args:
+            batch: BookingBatch shared when validating many bookings
+                (e.g. all occurrences of a repeating series), so the
+                required data is only loaded once.
+        """
+        batch = batch or BookingBatch([booking])
+        rid = booking.resource_id
+        r = batch.get(('resource', rid), lambda: self.get_resource_by(id=rid))
         if r is None:
             raise Exception("Select a valid Resource for this booking.")
 
@@ -1012,23 +1679,22 @@ class DataManager(DbManager):
 
             # Validate if there are restrictions in max number of bookings for
             # this type of resource or similar ones (same tags)
-            pending = self.__get_session_dict('pending_bookings')
-            nextBookings = None
+            pending = batch.get('pending', lambda: self.__get_session_dict(
+                'pending_bookings'))
             for tagName, maxPending in pending.items():
                 m = int(maxPending)
                 if m > 0 and tagName in r.tags:
                     # Only retrieve the next bookings when it is required
-                    if nextBookings is None:
-                        nextBookings = self.get_next_bookings(user)
+                    nextBookings = batch.get(
+                        'next', lambda: self.get_next_bookings(user))
                     count = sum(1 for b in nextBookings if tagName in b.resource.tags)
+                    count += batch.pending[tagName]
                     if count >= m:
                         raise Exception("You already reached the maximum number"
                                         " of pending bookings for resource tag "
                                         "'%s'" % tagName)
 
-        overlap = self.get_bookings_range(booking.start,
-                                          booking.end,
-                                          resource=r)
+        overlap = self.__batch_overlap(booking, r, batch)
 
         app = None
 
@@ -1045,7 +1711,8 @@ class DataManager(DbManager):
 
             # Always try to find the Application to set in the booking unless
             # the owner is a manager
-            owner = self.get_user_by(id=booking.owner_id)
+            oid = booking.owner_id
+            owner = batch.get(('user', oid), lambda: self.get_user_by(id=oid))
 
             if not owner.is_manager:
                 apps = owner.get_applications()
@@ -1085,9 +1752,14 @@ class DataManager(DbManager):
 
         if app is not None:
             booking.application_id = app.id
-            count = self.count_booking_resources([app.id],
-                                                 resource_tags=r.tags.split())
-            for tagKey, tagCount in count[app.id].items():
+            tags = r.tags.split()
+            count = batch.get(('count', app.id, r.tags),
+                              lambda: self.count_booking_resources(
+                                  [app.id], resource_tags=tags,
+                                  exclude_ids=batch.exclude)[app.id])
+            for tagKey in tags:
+                # Days used by bookings in the batch are counted separately
+                tagCount = count.get(tagKey, 0) + batch.usage[app.id][tagKey]
                 alloc = app.get_quota(tagKey)
                 if alloc:  # if different from None or 0, then check
                     if tagCount + booking.days > alloc:
@@ -1097,6 +1769,43 @@ class DataManager(DbManager):
         else:
             booking.application_id = None
 
+        batch.register(booking, r, app, self.now())
+
+    def __batch_overlap(self, booking, resource, batch):
+        """ Return the bookings overlapping with the given one in the
+        resource. Bookings in the batch are checked with their new values,
+        the rest are found with the in-memory index.
+        """
+        if resource.id not in batch.loaded:
+            # Load once all bookings in the range spanned by the batch
+            start, end = batch.span(resource.id)
+            batch.loaded[resource.id] = {
+                b.id: b for b in self.get_bookings_range(start, end, resource)
+            }
+        loaded = batch.loaded[resource.id]
+
+        index = batch.get('index', self.get_booking_index)
+        if index is None:
+            # Outdated index, all overlapping bookings are already loaded
+            ids = [b.id for b in loaded.values()
+                   if b.start <= booking.end and b.end >= booking.start]
+        else:
+            ids = index.overlap(resource.id, booking.start, booking.end)
+        ids = [bid for bid in ids
+               if bid != booking.id and bid not in batch.exclude]
+        missing = [bid for bid in ids if bid not in loaded]
+        if missing:
+            B = self.Booking
+            for b in self._db_session.query(B).filter(B.id.in_(missing)):
+                loaded[b.id] = b
+
+        overlap = [loaded[bid] for bid in ids]
+        overlap.extend(b for b in batch.validated[resource.id]
+                       if b is not booking and b.start <= booking.end
+                       and b.end >= booking.start)
+
+        return sorted(overlap, key=lambda b: b.start)
+
     def __check_cancellation(self, booking, attrs=None):
         """ Check if this booking can be updated or deleted.
         Normal users can only delete or modify the booking up to X hours
@@ -1164,8 +1873,9 @@ class DataManager(DbManager):
                 for b in repeats:
                     b.repeat_id = uid
 
+        batch = BookingBatch(result)
         for b in result:
-            modifyFunc(b)
+            modifyFunc(b, batch)
 
         self.commit()
 
@@ -1175,6 +1885,158 @@ class DataManager(DbManager):
         return os.path.join(self._sessionsPath, session.data_path)
 
 
+_SQL_BUMP_VERSION = sqlalchemy.text(
+    "INSERT INTO data_versions (name, version) VALUES (:name, 1) "
+    "ON CONFLICT(name) DO UPDATE SET version = version + 1")
+
+_SQL_GET_VERSION = sqlalchemy.text(
+    "SELECT version FROM data_versions WHERE name = :name")
+
+_SQL_PENDING_SESSIONS = sqlalchemy.text(
+    "SELECT (SELECT version FROM data_versions WHERE name = :name), "
+    "       EXISTS (SELECT 1 FROM sessions WHERE status = 'pending')")
+
+_SQL_ADD_USAGE = sqlalchemy.text(
+    "INSERT INTO quota_usage (application_id, resource_id, tag, days) "
+    "VALUES (:application_id, :resource_id, :tag, :days) "
+    "ON CONFLICT(application_id, resource_id, tag) "
+    "DO UPDATE SET days = days + :days")
+
+# Return the reserved value (the previous one) of the counter
+_SQL_NEXT_COUNTER = sqlalchemy.text(
+    "INSERT INTO session_counters (group_code, value) VALUES (:code, 2) "
+    "ON CONFLICT(group_code) DO UPDATE SET value = value + 1 "
+    "RETURNING value - 1")
+
+_SQL_SET_COUNTER = sqlalchemy.text(
+    "INSERT INTO session_counters (group_code, value) VALUES (:code, :value) "
+    "ON CONFLICT(group_code) DO UPDATE SET value = :value")
+
+_SQL_INCREASE_COUNTER = sqlalchemy.text(
+    "INSERT INTO session_counters (group_code, value) VALUES (:code, :value) "
+    "ON CONFLICT(group_code) DO UPDATE SET value = :value "
+    "WHERE value < :value")
+
+_SQL_DELETE_GRID_SLOTS = sqlalchemy.text(
+    "DELETE FROM grid_slots WHERE entry_id = :entry_id")
+
+_SQL_RESOURCE_TAGS = sqlalchemy.text("SELECT tags FROM resources WHERE id = :id")
+
+
+def _resource_tags(conn, resource_id):
+    tags = conn.execute(_SQL_RESOURCE_TAGS, {'id': resource_id}).scalar()
+    return tags.split() if tags else []
+
+
+def _compute_quota_usage(conn, bookings, tags=None):
+    """ Return the quota usage ledger rows, as a dict
+    (application_id, resource_id, tag) -> days, from the
+    (application_id, resource_id, start, end) values of the bookings.
+    If tags (resource_id -> tags list) is not given, resource tags
+    are read from the database. """
+    tags = dict(tags or {})
+    usage = defaultdict(lambda: 0)
+    for app_id, rid, start, end in bookings:
+        if rid not in tags:
+            tags[rid] = _resource_tags(conn, rid)
+        days = _usage_days(start, end)
+        for tag in [''] + tags[rid]:
+            usage[(app_id, rid, tag)] += days
+    return usage
+
+
+def _usage_days(start, end):
+    """ Days used by a booking (as Booking.days) computed from UTC dates,
+    as they are stored in the database. """
+    utc = dt.timezone.utc
+    return (end.astimezone(utc).date() - start.astimezone(utc).date()).days + 1
+
+
+def _booking_usage_values(booking, previous=False):
+    """ Return (application_id, resource_id, start, end) of the booking.
+    If previous is True, values before any modification are returned. """
+    if not previous:
+        return (booking.application_id, booking.resource_id,
+                booking.start, booking.end)
+
+    attrs = sqlalchemy.inspect(booking).attrs
+
+    def _previous(key):
+        h = attrs[key].history
+        values = h.deleted or h.unchanged or h.added
+        return values[0] if values else None
+
+    return tuple(_previous(k) for k in ['application_id', 'resource_id',
+                                        'start', 'end'])
+
+
+def _entry_grid_slots(entry_id, entryType, extra):
+    """ Return the grid slots rows (as dicts) from the grids_storage_table
+    of an Entry. Rows without a valid location are ignored. """
+    if entryType != 'grids_storage':
+        return []
+
+    table = (extra or {}).get('data', {}).get('grids_storage_table', [])
+    slots = []
+    for i, row in enumerate(table):
+        try:
+            slots.append({
+                'entry_id': entry_id,
+                'row_index': i,
+                'puck_id': int(row['puck_id']),
+                'box_position': int(row['box_position']),
+                'grid_position': ','.join(row['grid_position'])
+            })
+        except:
+            pass
+    return slots
+
+
+class BookingBatch:
+    """ Data shared while validating a group of bookings (e.g. all
+    occurrences of a repeating series). Resources, users and other
+    required data are loaded once for the whole group, and the usage
+    of the already validated bookings is accumulated, so the group is
+    checked as a whole against quotas and pending bookings limits.
+    """
+    def __init__(self, bookings):
+        self.bookings = list(bookings)
+        # Existing bookings in the batch will be checked with their new values
+        self.exclude = {b.id for b in self.bookings if b.id is not None}
+        self.loaded = {}  # resource_id -> {booking_id: Booking}
+        self.validated = defaultdict(list)  # resource_id -> [Booking]
+        self.pending = defaultdict(lambda: 0)  # tag -> new upcoming bookings
+        self.usage = defaultdict(lambda: defaultdict(lambda: 0))  # app -> tag -> days
+        self._cache = {}
+
+    def get(self, key, loadFunc):
+        """ Return the value for key, calling loadFunc only the first time. """
+        if key not in self._cache:
+            self._cache[key] = loadFunc()
+        return self._cache[key]
+
+    def span(self, resource_id):
+        """ Return the (start, end) range of the batch bookings
+        in the given resource. """
+        bookings = [b for b in self.bookings if b.resource_id == resource_id]
+        if not bookings:
+            bookings = self.bookings
+        return (min(b.start for b in bookings), max(b.end for b in bookings))
+
+    def register(self, booking, resource, app, now):
+        """ Account for a booking that has been validated. """
+        self.validated[resource.id].append(booking)
+        tags = resource.tags.split()
+        # Existing bookings are already counted as pending from the db
+        if booking.id is None and booking.start >= now:
+            for tag in tags:
+                self.pending[tag] += 1
+        # The quota used by the batch bookings is not counted from the db
+        if app is not None:
+            for tag in tags:
+                self.usage[app.id][tag] += booking.days
+
+
 class RepeatRanges:
     """ Helper class to generate a series of events with start, end. """
     OPTIONS = {'weekly': 7, 'bi-weekly': 14}
@@ -30,8 +30,8 @@ import datetime as dt
 from collections import OrderedDict
 import jwt
 
-from sqlalchemy import (Column, Integer, String, JSON,
-                        ForeignKey, Text, Table, Float)
+from sqlalchemy import (event, Column, Integer, String, JSON,
+                        ForeignKey, Text, Table, Float, Index)
 from sqlalchemy.orm import relationship
 from sqlalchemy_utc import UtcDateTime, utcnow
 from flask_login import UserMixin
@@ -287,44 +287,87 @@ def create_data_models(dm):
         def json(self):
             return dm.json_from_object(self)
 
+        # Role checks are done many times per request (e.g for each booking
+        # in the calendar), so derived permissions are computed once per
+        # instance and cleared when roles or created applications change.
+        def get_permissions(self):
+            """ Return a tuple (flags, staff_unit) computed from roles. """
+            perms = self.__dict__.get('_permissions', None)
+            if perms is None:
+                roles = self.roles or []
+                flags = set(r for r in roles
+                            if r in ('developer', 'admin', 'manager',
+                                     'head', 'pi', 'independent'))
+                staff = [r.replace('staff-', '') for r in roles
+                         if r.startswith('staff-')]
+                if 'developer' in flags:
+                    flags.add('admin')
+                if flags & {'admin', 'head'}:
+                    flags.add('manager')
+                if staff:
+                    flags.add('staff')
+                perms = (frozenset(flags), staff[0] if staff else None)
+                self.__dict__['_permissions'] = perms
+            return perms
+
+        _cached_permissions = ('_permissions', '_is_application_manager',
+                               '_access')
+
+        def clear_permissions(self):
+            """ Clear cached permissions, computed again when needed. """
+            for key in self._cached_permissions:
+                self.__dict__.pop(key, None)
+
+        def get_access(self):
+            """ Return the AccessContext of this user, created once per
+            instance (i.e. per request) and cleared with permissions. """
+            access = self.__dict__.get('_access', None)
+            if access is None:
+                access = self.__dict__['_access'] = AccessContext(self)
+            return access
+
         @property
         def is_developer(self):
-            return 'developer' in self.roles
+            return 'developer' in self.get_permissions()[0]
 
         @property
         def is_admin(self):
-            return 'admin' in self.roles or self.is_developer
+            return 'admin' in self.get_permissions()[0]
 
         @property
         def is_manager(self):
-            return 'manager' in self.roles or self.is_admin or self.is_head
+            return 'manager' in self.get_permissions()[0]
 
         @property
         def is_head(self):
-            return 'head' in self.roles
+            return 'head' in self.get_permissions()[0]
 
         @property
         def is_staff(self):
-            return any(r.startswith('staff-') for r in self.roles)
+            return 'staff' in self.get_permissions()[0]
 
         @property
         def staff_unit(self):
-            for r in self.roles:
-                if r.startswith('staff-'):
-                    return r.replace('staff-', '')
-            return None
+            return self.get_permissions()[1]
 
         @property
         def is_pi(self):
-            return 'pi' in self.roles
+            return 'pi' in self.get_permissions()[0]
 
         @property
         def is_independent(self):
-            return 'independent' in self.roles
+            return 'independent' in self.get_permissions()[0]
 
         @property
         def is_application_manager(self):
-            return len(self.created_applications) > 0
+            value = self.__dict__.get('_is_application_manager', None)
+            if value is None:
+                if 'created_applications' in self.__dict__:
+                    value = len(self.created_applications) > 0
+                else:  # Avoid loading all applications just to count them
+                    value = dm.count_created_applications(self) > 0
+                self.__dict__['_is_application_manager'] = value
+            return value
 
         @property
         def is_active(self):
@@ -347,24 +390,12 @@ def create_data_models(dm):
         def get_applications(self, status='active'):
             """ Return the applications of this user.
             """
-            applications = []
-            pi = self.get_pi()
-            if pi is not None:
-                applications = list(pi.created_applications)
-                for a in pi.applications:
-                    if a not in applications:
-                        applications.append(a)
-                #applications.extend(pi.applications)
-
-            def _filter(a):
-                return status == 'all' or a.status == status
-
-            return [a for a in applications if _filter(a)]
+            return [a for a in self.get_access().applications
+                    if status == 'all' or a.status == status]
 
         def has_application(self, applicationCode):
             """ Return True if the user has the given application. """
-            return any(a.code == applicationCode
-                       for a in self.get_applications(status='all'))
+            return applicationCode in self.get_access().codes
 
         def get_lab_members(self, onlyActive=True):
             """ Return lab members, filtering or not by active status. """
@@ -548,12 +579,15 @@ def create_data_models(dm):
             if user.is_manager:
                 return not self.confidential or user.id in self.access_list
 
-            user_apps = user.get_applications(status='all')
-            return any(self.id == a.id for a in user_apps)
+            return self.id in user.get_access().application_ids
+
+        # json() also contains 'pi_list', so json dicts are not built from
+        # rows in listings (see DataManager.get_applications)
+        json_from_row = False
 
         def json(self):
             json = dm.json_from_object(self)
-            json['pi_list'] = [pi.id for pi in self.pi_list]
+            json['pi_list'] = list(self.pi_ids)
             return json
 
         @property
@@ -579,23 +613,47 @@ def create_data_models(dm):
             """
             return resourceKey in self.resource_allocation['noslot']
 
+        def _get_pis(self):
+            """ Return (pi_list, pi_ids) computed once per instance and
+            cleared when the creator or users of the application change. """
+            pis = self.__dict__.get('_pis', None)
+            if pis is None:
+                # Since we are importing data now from the Portal, some
+                # application have the creator of the application as one of
+                # the users, so we want to avoid duplicated entries
+                pi_list = []
+
+                # Applications can also be created by facility staff, so only
+                # if the creator is a pi we reported in the "pi_list"
+                creator = self.creator
+                if creator is not None and creator.is_pi:
+                    pi_list.append(creator)
+
+                for u in self.users:
+                    if creator is None or u.id != creator.id:
+                        pi_list.append(u)
+                pis = (tuple(pi_list), frozenset(u.id for u in pi_list))
+                self.__dict__['_pis'] = pis
+            return pis
+
+        def clear_pis(self):
+            """ Clear the cached PI list, computed again when needed. """
+            self.__dict__.pop('_pis', None)
+
         @property
         def pi_list(self):
             """ Return the list of PI. """
-            # Since we are importing data now from the Portal, some application
-            # have the creator of the application as one of the users, so we want
-            # to avoid duplicated entries
-            pi_list = []
+            return list(self._get_pis()[0])
 
-            # Applications can also be created by facility staff, so only if the
-            # creator is a pi we reported in the "pi_list"
-            if self.creator is not None and self.creator.is_pi:
-                pi_list.append(self.creator)
+        @property
+        def pi_ids(self):
+            """ Return the ids of the PIs, in the same order of pi_list. """
+            return tuple(pi.id for pi in self._get_pis()[0])
 
-            for u in self.users:
-                if u.id != self.creator.id:
-                    pi_list.append(u)
-            return pi_list
+        def has_pi(self, user):
+            """ Return True if the user (or user id) is a PI of this
+            application. """
+            return getattr(user, 'id', user) in self._get_pis()[1]
 
         @property
         def representative(self):
@@ -611,6 +669,12 @@ def create_data_models(dm):
     class Booking(Base):
         """Model for user accounts."""
         __tablename__ = 'bookings'
+        # Indexes used by range (overlapping) queries
+        __table_args__ = (
+            Index('ix_bookings_resource_start_end',
+                  'resource_id', 'start', 'end'),
+            Index('ix_bookings_start_end', 'start', 'end'),
+        )
 
         TYPES = ['booking', 'slot', 'downtime', 'maintenance', 'special']
 
@@ -750,7 +814,7 @@ def create_data_models(dm):
             allowedApps = self.slot_auth.get('applications', [])
 
             return (user.id in allowedUsers or 'any' in allowedApps or
-                    any(a.code in allowedApps for a in user.get_applications()))
+                    not user.get_access().active_codes.isdisjoint(allowedApps))
 
         def application_in_slot(self, application):
             if not self.is_slot:
@@ -1093,6 +1157,73 @@ def create_data_models(dm):
             extra[key] = value
             self.extra = extra
 
+    class GridSlot(Base):
+        """ Storage location (puck, gridbox slot and grid positions) of a
+        row in the grids_storage_table of a 'grids_storage' Entry. It is
+        updated in the same transaction that modifies the entries, so
+        storage views can query by puck instead of parsing all entries.
+        """
+        __tablename__ = 'grid_slots'
+
+        id = Column(Integer, primary_key=True)
+
+        puck_id = Column(Integer, ForeignKey('pucks.id'), nullable=False)
+
+        box_position = Column(Integer, nullable=False)
+
+        # Positions in the gridbox, comma separated (e.g '1,2')
+        grid_position = Column(String(64), nullable=False)
+
+        entry_id = Column(Integer, ForeignKey('entries.id'), nullable=False,
+                          index=True)
+
+        # Index of the row in the entry grids_storage_table
+        row_index = Column(Integer, nullable=False)
+
+        __table_args__ = (
+            Index('ix_grid_slots_puck_box', 'puck_id', 'box_position'),
+        )
+
+    class DataVersion(Base):
+        """ Version counter for each table. It is increased in the same
+        transaction of any change in the table, so other processes can
+        cheaply check if their cached data is still valid.
+        """
+        __tablename__ = 'data_versions'
+
+        name = Column(String(64), primary_key=True)
+
+        version = Column(Integer, nullable=False, default=0)
+
+    class SessionCounter(Base):
+        """ Counter used to name the sessions of each group (e.g 'fac' or
+        an application code). It stores the next value to use and it is
+        increased atomically when a session is created.
+        """
+        __tablename__ = 'session_counters'
+
+        group_code = Column(String(64), primary_key=True)
+
+        value = Column(Integer, nullable=False, default=1)
+
+    class QuotaUsage(Base):
+        """ Ledger with the days used by each Application on each Resource,
+        by resource tag. It is updated in the same transaction that creates,
+        modifies or deletes bookings, so quota checks do not need to count
+        over all bookings. Rows with empty tag store the resource total.
+        """
+        __tablename__ = 'quota_usage'
+
+        application_id = Column(Integer, ForeignKey('applications.id'),
+                                primary_key=True)
+
+        resource_id = Column(Integer, ForeignKey('resources.id'),
+                             primary_key=True)
+
+        tag = Column(String(64), primary_key=True)
+
+        days = Column(Integer, nullable=False, default=0)
+
     class PuckStorage:
         """ Simple class to organize pucks access. """
 
@@ -1155,6 +1286,38 @@ def create_data_models(dm):
             cane = self._dewars[d]['canes'].get(c, None) if d in self._dewars else None
             return cane
 
+    def _clear_permissions(target, *args):
+        target.clear_permissions()
+
+    event.listen(User.roles, 'set', _clear_permissions)
+    event.listen(User.pi, 'set', _clear_permissions)
+    for e in ['append', 'remove']:
+        event.listen(User.created_applications, e, _clear_permissions)
+        event.listen(User.applications, e, _clear_permissions)
+
+    def _expire_permissions(state, *args):
+        # Listened with raw=True, the instance might be already garbage
+        # collected when expired on commit (then state.dict is empty)
+        for key in User._cached_permissions:
+            state.dict.pop(key, None)
+
+    for e in ['expire', 'refresh']:
+        event.listen(User, e, _expire_permissions, raw=True)
+
+    def _clear_pis(target, *args):
+        target.clear_pis()
+
+    for attr in [Application.creator, Application.creator_id]:
+        event.listen(attr, 'set', _clear_pis)
+    for e in ['append', 'remove']:
+        event.listen(Application.users, e, _clear_pis)
+
+    def _expire_pis(state, *args):
+        state.dict.pop('_pis', None)
+
+    for e in ['expire', 'refresh']:
+        event.listen(Application, e, _expire_pis, raw=True)
+
     dm.Form = Form
     dm.User = User
     dm.Resource = Resource
@@ -1167,4 +1330,32 @@ def create_data_models(dm):
     dm.Project = Project
     dm.Entry = Entry
     dm.Puck = Puck
+    dm.GridSlot = GridSlot
+    dm.DataVersion = DataVersion
+    dm.SessionCounter = SessionCounter
+    dm.QuotaUsage = QuotaUsage
     dm.PuckStorage = PuckStorage
+
+
+class AccessContext:
+    """ Applications that a user has access to (through its PI), computed
+    once and used for the access checks done many times per request,
+    e.g. Application.allows_access or Booking.allows_user_in_slot.
+    """
+    def __init__(self, user):
+        self.user_id = user.id
+        pi = user.get_pi()
+        self.pi_id = None if pi is None else pi.id
+
+        apps = {}
+        if pi is not None:
+            for a in pi.created_applications:
+                apps[a.id] = a
+            for a in pi.applications:
+                apps.setdefault(a.id, a)
+
+        self.applications = list(apps.values())
+        self.application_ids = set(apps)
+        self.codes = set(a.code for a in self.applications)
+        self.active_codes = set(a.code for a in self.applications
+                                if a.status == 'active')
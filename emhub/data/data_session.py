@@ -99,6 +99,24 @@ class SessionData:
     def update_set_item(self, setId, itemId, attrDict):
         pass
 
+    def add_set_items(self, setId, items):
+        """ Add many items to the set. Each item is a dict with the
+        'item_id' and its attributes. """
+        for itemId, attrDict in _iter_items(items):
+            self.add_set_item(setId, itemId, attrDict)
+
+    def update_set_items(self, setId, items):
+        """ Update many items of the set. Each item is a dict with the
+        'item_id' and the attributes to be modified. """
+        for itemId, attrDict in _iter_items(items):
+            self.update_set_item(setId, itemId, attrDict)
+
+
+def _iter_items(items):
+    for item in items:
+        attrDict = dict(item)
+        yield int(attrDict.pop('item_id')), attrDict
+
 
 class H5SessionData(SessionData):
     """
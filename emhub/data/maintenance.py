@@ -0,0 +1,102 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+"""
+Maintenance commands to rebuild or verify derived data stored in the
+database of an EMhub instance (given by EMHUB_INSTANCE), use them as:
+
+    python -m emhub.data.maintenance <command> [--help]
+"""
+
+import os
+import sys
+import argparse
+
+from .data_manager import DataManager
+
+
+def quota_usage(dm, args):
+    """ Verify or rebuild the quota usage ledger from existing bookings. """
+    diffs = dm.verify_quota_usage()
+    for app_id, rid, tag, ledger, computed in diffs:
+        print("application: %s, resource: %s, tag: '%s', ledger: %s, "
+              "bookings: %s" % (app_id, rid, tag, ledger, computed))
+    print("Quota usage differences: %d" % len(diffs))
+
+    if args.rebuild:
+        n = dm.rebuild_quota_usage()
+        print("Quota usage rebuilt: %d rows" % n)
+    elif diffs:
+        sys.exit(1)
+
+
+def grid_slots(dm, args):
+    """ Rebuild the grid slots index from existing grids_storage entries. """
+    n = dm.rebuild_grid_slots()
+    print("Grid slots rebuilt: %d rows" % n)
+
+
+COMMANDS = {
+    'quota_usage': (quota_usage, [
+        (('--rebuild',), {'action': 'store_true',
+                          'help': 'Recreate the ledger instead of only '
+                                  'verifying it.'}),
+    ]),
+    'grid_slots': (grid_slots, []),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+
+    for name, (func, arguments) in COMMANDS.items():
+        p = subparsers.add_parser(name, help=func.__doc__.split('.')[0].strip())
+        for a, kw in arguments:
+            p.add_argument(*a, **kw)
+
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+
+    instance_path = os.path.abspath(os.environ.get("EMHUB_INSTANCE",
+                                                   'instance'))
+    if not os.path.exists(instance_path):
+        raise Exception("Instance folder '%s' does not exist. "
+                        % instance_path)
+
+    dm = DataManager(instance_path)
+    COMMANDS[args.command][0](dm, args)
+    dm.close_logs()
+
+
+if __name__ == '__main__':
+    main()
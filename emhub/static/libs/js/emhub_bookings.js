@@ -266,8 +266,9 @@
             selectable: true, // allows to select dates
             eventSources: [
                 {
-                  url: Api.urls.booking.range,
-                  method: 'POST'
+                  // Events are requested for the visible dates only
+                  url: Api.urls.booking.events,
+                  method: 'GET'
                 }
             ],
             eventSourceSuccess: function(all_events, xhr) {
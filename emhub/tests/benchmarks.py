@@ -0,0 +1,643 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+"""
+Simple benchmarks to measure the effect of some performance related changes.
+They are not run as part of the tests, use them as:
+
+    python -m emhub.tests.benchmarks <benchmark_name> [--help]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing as mp
+
+
+class Timer:
+    """ Simple context manager to measure elapsed time. """
+    def __init__(self, label=''):
+        self.label = label
+        self.elapsed = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self._start
+
+
+def print_row(*values):
+    print('  '.join('%-20s' % v for v in values))
+
+
+# ------------------------ DB engine (concurrency) ----------------------------
+def _engine_worker(dbPath, engineOptions, role, seconds, queue):
+    from emhub.data import DataLog
+
+    dl = DataLog(dbPath, engineOptions=engineOptions)
+    ops = errors = 0
+    end = time.time() + seconds
+
+    while time.time() < end:
+        try:
+            if role == 'writer':
+                dl.log(1, 'operation', 'benchmark', kwargs={'n': ops})
+            else:
+                dl._db_session.query(dl.Log).order_by(
+                    dl.Log.id.desc()).limit(100).all()
+                dl._db_session.rollback()
+            ops += 1
+        except Exception:
+            dl._db_session.rollback()
+            errors += 1
+
+    dl.dispose()
+    queue.put((role, ops, errors))
+
+
+def bench_engine(args):
+    """ Concurrent read/write throughput with the plain engine and with the
+    default engine profile (WAL, busy timeout, pragmas). Several processes
+    are used to simulate multiple gunicorn workers.
+    """
+    from emhub.data import DataLog
+
+    profiles = [('plain', False), ('profile', None)]
+
+    print_row('engine', 'writes/s', 'reads/s', 'errors')
+
+    for label, engineOptions in profiles:
+        tmpDir = tempfile.mkdtemp()
+        dbPath = os.path.join(tmpDir, 'bench-logs.sqlite')
+        # Create the database first
+        DataLog(dbPath, cleanDb=True, engineOptions=engineOptions).dispose()
+
+        queue = mp.Queue()
+        roles = ['writer'] * args.writers + ['reader'] * args.readers
+        procs = [mp.Process(target=_engine_worker,
+                            args=(dbPath, engineOptions, r, args.seconds, queue))
+                 for r in roles]
+        for p in procs:
+            p.start()
+        results = [queue.get() for _ in procs]
+        for p in procs:
+            p.join()
+
+        writes = sum(r[1] for r in results if r[0] == 'writer')
+        reads = sum(r[1] for r in results if r[0] == 'reader')
+        errors = sum(r[2] for r in results)
+        print_row(label, '%0.1f' % (writes / args.seconds),
+                  '%0.1f' % (reads / args.seconds), errors)
+
+
+# ------------------------ Operation logs -------------------------------------
+def bench_logs(args):
+    """ Logs throughput with one commit per log compared with the
+    buffered writer.
+    """
+    from emhub.data import DataLog
+
+    print_row('writer', 'logs/s', 'flushes', 'avg flush (ms)')
+
+    for label, buffered in [('sync', False), ('buffered', True)]:
+        dbPath = os.path.join(tempfile.mkdtemp(), 'bench-logs.sqlite')
+        dl = DataLog(dbPath, cleanDb=True, buffered=buffered)
+        with Timer() as t:
+            for i in range(args.logs):
+                dl.log(1, 'operation', 'benchmark', attrs={'n': i})
+            dl.flush()
+        stats = dl.get_stats()
+        dl.dispose()
+        print_row(label, '%0.1f' % (args.logs / t.elapsed),
+                  stats.get('flushes', args.logs),
+                  '%0.2f' % stats.get('avg_flush_ms', 0))
+
+
+# ------------------------ JSON responses -------------------------------------
+def bench_json(args):
+    """ Encoding of a large listing (entries with extra values) in one
+    piece compared with the streaming encoder (chunks written to a file).
+    """
+    import json
+    import tracemalloc
+    from emhub.utils import NpJsonEncoder, iter_json
+
+    rows = [{'id': i, 'title': 'Entry %d' % i, 'type': 'grids_storage',
+             'extra': {'data': {'values': list(range(args.values)),
+                                'notes': 'x' * 200}}}
+            for i in range(args.rows)]
+
+    def _dumps():
+        yield json.dumps(rows, cls=NpJsonEncoder)
+
+    print_row('encoder', 'time (ms)', 'first chunk (ms)', 'peak (MB)')
+
+    for label, encode in [('json.dumps', _dumps),
+                          ('iter_json', lambda: iter_json(rows))]:
+        with open(os.devnull, 'w') as out:
+            with Timer() as t:
+                start = time.perf_counter()
+                chunks = encode()
+                out.write(next(chunks))
+                first = time.perf_counter() - start
+                for chunk in chunks:
+                    out.write(chunk)
+            # Measure memory in a separated pass (tracing is slow)
+            tracemalloc.start()
+            for chunk in encode():
+                out.write(chunk)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        print_row(label, '%0.1f' % (t.elapsed * 1000),
+                  '%0.1f' % (first * 1000), '%0.1f' % (peak / 1024 ** 2))
+
+
+# ------------------------ Session items --------------------------------------
+def bench_session_items(args):
+    """ Adding micrographs to a session set with one request per item
+    compared with the batch endpoint (chunks of --chunk items).
+    """
+    from .test_data import create_test_client
+
+    dm, _, _ = create_bench_dm(1)
+    dm.create_session(booking_id=1, create_data=True)
+    _, client = create_test_client(dm)
+
+    def _post(method, **attrs):
+        attrs['session_id'] = 1
+        client.post('/api/%s' % method, json={'attrs': attrs})
+
+    def _items(first):
+        return [{'item_id': first + i, 'location': 'mic%06d.mrc' % i,
+                 'ctfDefocus': 1.5, 'micThumbData': 'x' * 1000}
+                for i in range(args.items)]
+
+    print_row('method', 'requests', 'time (ms)', 'items/s')
+
+    with Timer() as t:
+        _post('create_session_set', set_id='single')
+        for item in _items(1):
+            _post('add_session_item', set_id='single', **item)
+    print_row('add_session_item', args.items, '%0.1f' % (t.elapsed * 1000),
+              '%0.0f' % (args.items / t.elapsed))
+
+    items = _items(1)
+    with Timer() as t:
+        _post('create_session_set', set_id='batch')
+        for i in range(0, len(items), args.chunk):
+            _post('add_session_items', set_id='batch',
+                  items=items[i:i + args.chunk])
+    print_row('add_session_items', -(-args.items // args.chunk),
+              '%0.1f' % (t.elapsed * 1000), '%0.0f' % (args.items / t.elapsed))
+
+
+# ------------------------ Bookings helpers -----------------------------------
+def create_bench_dm(nBookings, nResources=8, nPis=0, seed=0):
+    """ Create a DataManager in a temporary folder with basic data and
+    nBookings synthetic bookings (inserted in bulk, no validation).
+    Bookings are consecutive in each resource, lasting between 1 and 3 days.
+    If nPis > 0, PIs (with 3 lab members and one application each) are
+    also created and used as owners of the bookings, resources get a
+    daily cost and some bookings extra costs.
+    """
+    import random
+    import datetime as dt
+    from .test_data import (create_test_dm, create_test_user,
+                            create_test_application)
+
+    rand = random.Random(seed)
+    dm = create_test_dm()
+    dm.create_form(name='config:bookings', definition={
+        'display': {'show_application': 'yes', 'show_operator': 'yes'}})
+
+    owners = [(1, None)]  # (owner_id, application_id)
+    if nPis:
+        for r in dm.get_resources():
+            dm.update_resource(id=r.id, extra=dict(r.extra,
+                                                   daily_cost=r.id % 3 * 100))
+
+    for i in range(nPis):
+        pi = create_test_user(dm, 'pi%d' % i, ['pi'])
+        app = create_test_application(dm, pi, code='CEM%05d' % i)
+        owners.append((pi.id, app.id))
+        for j in range(3):
+            owners.append((create_test_user(dm, 'user%d%d' % (i, j), ['user'],
+                                            pi_id=pi.id).id, app.id))
+
+    types = ['booking'] * 7 + ['slot', 'downtime', 'maintenance']
+    start0 = dt.datetime(2015, 1, 1, 9, tzinfo=dt.timezone.utc)
+    nextStart = {r: start0 for r in range(1, nResources + 1)}
+    rows = []
+    for i in range(nBookings):
+        rid = rand.randint(1, nResources)
+        start = nextStart[rid]
+        end = start + dt.timedelta(days=rand.randint(1, 3), hours=-1)
+        nextStart[rid] = end + dt.timedelta(hours=1)
+        owner_id, app_id = rand.choice(owners)
+        extra = {}
+        if nPis and rand.random() < 0.05:
+            extra['costs'] = [['service', 'Extra service',
+                               str(rand.randint(1, 10) * 50)]]
+        rows.append({'title': 'Booking %d' % i,
+                     'start': start, 'end': end,
+                     'type': rand.choice(types) if nPis else (
+                         'slot' if i % 10 == 0 else 'booking'),
+                     'resource_id': rid,
+                     'creator_id': 1, 'owner_id': owner_id,
+                     'application_id': app_id,
+                     'repeat_value': 'no',
+                     'slot_auth': {}, 'extra': extra})
+
+    dm._db_session.execute(dm.Booking.__table__.insert(), rows)
+    dm._db_session.execute(dm.DataVersion.__table__.insert(),
+                           [{'name': 'bookings', 'version': 1}])
+    dm.commit()
+
+    return dm, start0, max(nextStart.values())
+
+
+# ------------------------ Bookings index -------------------------------------
+def bench_booking_index(args):
+    """ Overlap lookups with the in-memory bookings index compared with the
+    SQL range query.
+    """
+    import random
+    import datetime as dt
+
+    with Timer() as t:
+        dm, first, last = create_bench_dm(args.bookings)
+    print("Created %d bookings in %0.2f s" % (args.bookings, t.elapsed))
+
+    with Timer() as t:
+        index = dm.get_booking_index()
+    print("Index loaded in %0.2f s" % t.elapsed)
+
+    rand = random.Random(1)
+    span = (last - first).total_seconds()
+    queries = []
+    for _ in range(args.queries):
+        s = first + dt.timedelta(seconds=rand.uniform(0, span))
+        queries.append((rand.randint(1, 8), s, s + dt.timedelta(days=2)))
+
+    with Timer() as tSql:
+        nSql = sum(len(dm.get_bookings_range(s, e, resource=r))
+                   for r, s, e in queries)
+    with Timer() as tIndex:
+        nIndex = sum(len(index.overlap(r, s, e)) for r, s, e in queries)
+
+    print_row('method', 'queries/s', 'results')
+    print_row('sql', '%0.1f' % (args.queries / tSql.elapsed), nSql)
+    print_row('index', '%0.1f' % (args.queries / tIndex.elapsed), nIndex)
+
+    with Timer() as t:
+        diffs = dm.check_booking_index()
+    print("Consistency check: %d differences (%0.2f s)" % (len(diffs), t.elapsed))
+
+
+# ------------------------ Calendar (user permissions) ------------------------
+def _legacy_permissions(User):
+    """ Replace User permissions with the previous implementation (roles
+    scanned on every check) and return a function to restore them.
+    """
+    legacy = {
+        'is_developer': lambda u: 'developer' in u.roles,
+        'is_admin': lambda u: 'admin' in u.roles or u.is_developer,
+        'is_manager': lambda u: 'manager' in u.roles or u.is_admin or u.is_head,
+        'is_head': lambda u: 'head' in u.roles,
+        'is_staff': lambda u: any(r.startswith('staff-') for r in u.roles),
+        'is_pi': lambda u: 'pi' in u.roles,
+        'is_application_manager': lambda u: len(u.created_applications) > 0
+    }
+    current = {k: getattr(User, k) for k in legacy}
+    for k, func in legacy.items():
+        setattr(User, k, property(func))
+
+    def _restore():
+        for k, prop in current.items():
+            setattr(User, k, prop)
+
+    return _restore
+
+
+def bench_calendar(args):
+    """ Render calendar events for a manager with cached user permissions
+    compared with checking the roles every time, and with a single
+    BookingEventSerializer for all bookings.
+    """
+    from types import SimpleNamespace
+    from emhub.data import DataContent
+
+    dm, _, _ = create_bench_dm(args.bookings)
+    user = dm.get_user_by(id=1)  # admin, also manager
+    dc = DataContent(SimpleNamespace(dm=dm, user=user))
+    bookings = dm.get_bookings(load='calendar')
+
+    def _render():
+        with Timer() as t:
+            for _ in range(args.repeat):
+                events = [dc.booking_to_event(b) for b in bookings]
+        return t.elapsed, events
+
+    def _serialize():
+        with Timer() as t:
+            for _ in range(args.repeat):
+                serializer = dc.booking_serializer()
+                events = [serializer(b) for b in bookings]
+        return t.elapsed, events
+
+    restore = _legacy_permissions(dm.User)
+    try:
+        tLegacy, events1 = _render()
+    finally:
+        restore()
+    tCached, events2 = _render()
+    tSerializer, events3 = _serialize()
+
+    if events1 != events2 or events1 != events3:
+        print("ERROR: events are different!")
+
+    n = len(bookings) * args.repeat
+    print_row('permissions', 'events/s')
+    print_row('legacy', '%0.1f' % (n / tLegacy))
+    print_row('cached', '%0.1f' % (n / tCached))
+    print_row('serializer', '%0.1f' % (n / tSerializer))
+
+
+# ------------------------ Calendar events feed -------------------------------
+def bench_calendar_feed(args):
+    """ Calendar page with all bookings events embedded compared with the
+    events feed requested for the visible month (and revalidated with ETag).
+    """
+    import datetime as dt
+    from .test_data import create_test_client
+
+    dm, first, last = create_bench_dm(args.bookings)
+    print("Bookings from %s to %s" % (first.date(), last.date()))
+    _, client = create_test_client(dm)
+
+    def _all_events():
+        # Previous calendar content: events of all bookings
+        return client.post('/api/get_bookings_range',
+                           json={'start': first.isoformat(),
+                                 'end': last.isoformat()})
+
+    month = first + (last - first) / 2
+    params = {'start': month.isoformat(),
+              'end': (month + dt.timedelta(days=42)).isoformat()}
+    url = '/api/get_booking_events'
+
+    def _feed():
+        return client.get(url, query_string=params)
+
+    etag = _feed().headers['ETag']
+
+    def _revalidate():
+        return client.get(url, query_string=params,
+                          headers={'If-None-Match': etag})
+
+    print_row('method', 'time (ms)', 'payload (KB)', 'status')
+    for label, func in [('all events', _all_events), ('feed', _feed),
+                        ('feed (etag)', _revalidate)]:
+        with Timer() as t:
+            for _ in range(args.repeat):
+                result = func()
+        print_row(label, '%0.1f' % (t.elapsed * 1000 / args.repeat),
+                  '%0.1f' % (len(result.data) / 1024), result.status_code)
+
+
+# ------------------------ Reports (BookingFrame) -----------------------------
+def bench_reports(args):
+    """ Report aggregations (days and cost per PI, resource, application
+    and month) looping over Booking objects compared with the BookingFrame.
+    """
+    import numpy as np
+    from collections import defaultdict
+
+    with Timer() as t:
+        dm, first, last = create_bench_dm(args.bookings, nPis=args.pis)
+    print("Created %d bookings (%d years) in %0.2f s"
+          % (args.bookings, (last - first).days // 365, t.elapsed))
+
+    keys = ['pi_id', 'resource_id', 'application_id', 'month']
+
+    def _orm():
+        dm.close()
+        result = {k: defaultdict(lambda: [0, 0]) for k in keys}
+        for b in dm.get_bookings_range(first, last, load='report'):
+            if b.resource.daily_cost <= 0 or not b.is_booking:
+                continue
+            pi = b.owner.get_pi()
+            values = {'pi_id': pi.id if pi else 0,
+                      'resource_id': b.resource.id,
+                      'application_id': b.application_id or 0,
+                      'month': b.start.year * 100 + b.start.month}
+            days, cost = b.days, b.total_cost
+            for k in keys:
+                result[k][values[k]][0] += days
+                result[k][values[k]][1] += cost
+        return {k: dict(v) for k, v in result.items()}
+
+    def _frame():
+        dm.close()
+        frame = dm.get_booking_frame(first, last)
+        rids = [r.id for r in dm.get_resources() if r.daily_cost > 0]
+        frame = frame.select(np.isin(frame['resource_id'], rids) &
+                             frame.is_type('booking'))
+        result = {}
+        for k in keys:
+            days = frame.group_sum(k, 'days')
+            cost = frame.group_sum(k, 'total_cost')
+            result[k] = {v: [days[v], cost[v]] for v in days}
+        return result
+
+    print_row('method', 'time (s)', 'bookings/s')
+    for label, func in [('orm', _orm), ('frame', _frame)]:
+        with Timer() as t:
+            result = func()
+        print_row(label, '%0.3f' % t.elapsed,
+                  '%0.1f' % (args.bookings / t.elapsed))
+        if label == 'orm':
+            expected = result
+        elif result != expected:
+            print("ERROR: results are different!")
+
+
+# ------------------------ Listings (row serializer) --------------------------
+def bench_listing(args):
+    """ Json listing of all bookings (as the API get_bookings endpoint)
+    from ORM objects converted value by value, compared with rows of a
+    projected query converted by the precompiled RowSerializer.
+    """
+    from emhub.data.data_db import DbManager
+
+    with Timer() as t:
+        dm, first, last = create_bench_dm(args.bookings)
+    print("Created %d bookings in %0.2f s" % (args.bookings, t.elapsed))
+
+    def _legacy():
+        dm.close()
+        return [{c.key: DbManager.json_from_value(getattr(b, c.key))
+                 for c in b.__table__.c} for b in dm.get_bookings()]
+
+    def _rows():
+        dm.close()
+        return dm.get_bookings(asJson=True)
+
+    assert _legacy() == _rows()
+
+    print_row('method', 'time (ms)', 'bookings/s')
+    for label, func in [('orm + json', _legacy), ('row serializer', _rows)]:
+        with Timer() as t:
+            for _ in range(args.repeat):
+                func()
+        elapsed = t.elapsed / args.repeat
+        print_row(label, '%0.1f' % (elapsed * 1000),
+                  '%0.0f' % (args.bookings / elapsed))
+
+
+# ------------------------ Dashboard (bookings digest) ------------------------
+def bench_dashboard(args):
+    """ Upcoming bookings digest of the dashboard, iterating over all bookings
+    compared with the windowed query and with the cached digest.
+    """
+    import datetime as dt
+    from types import SimpleNamespace
+    from emhub.data import DataContent
+
+    dm, first, last = create_bench_dm(args.bookings, nPis=args.pis)
+    now = dm.now()
+    print("Bookings from %s to %s" % (first.date(), last.date()))
+    users = [u for u in dm.get_users() if u.is_pi][:args.users]
+    dc = DataContent(SimpleNamespace(dm=dm))
+    digest = dc._DataContent__get_bookings_digest
+
+    def _legacy(user):
+        # Previous loop over all bookings, keeping the next 30 days
+        bookings = [[], [], []]
+        for b in dm.get_bookings(orderBy='start', load='calendar'):
+            if not user.is_manager and not user.same_pi(b.owner) or not b.is_booking:
+                continue
+            if b.start <= now <= b.end:
+                bookings[0].append(b.id)
+            elif now <= b.start <= now + dt.timedelta(days=7):
+                bookings[1].append(b.id)
+            elif now <= b.start <= now + dt.timedelta(days=30):
+                bookings[2].append(b.id)
+        return [len(bList) for bList in bookings]
+
+    def _window(user):
+        dc._digestCache = {}
+        return [len(bList) for _, bList in digest(user)['bookings']]
+
+    def _cached(user):
+        return [len(bList) for _, bList in digest(user)['bookings']]
+
+    print_row('method', 'dashboards/s')
+    for label, func in [('legacy', _legacy), ('window', _window),
+                        ('cached', _cached)]:
+        if label == 'cached':
+            for u in users:
+                _cached(u)
+        with Timer() as t:
+            result = [func(u) for u in users]
+        print_row(label, '%0.1f' % (len(users) / t.elapsed))
+        if label == 'legacy':
+            expected = result
+        elif result != expected:
+            print("ERROR: results are different!")
+
+
+BENCHMARKS = {
+    'booking_index': (bench_booking_index, [
+        (('--bookings',), {'type': int, 'default': 100000}),
+        (('--queries',), {'type': int, 'default': 2000}),
+    ]),
+    'calendar': (bench_calendar, [
+        (('--bookings',), {'type': int, 'default': 20000}),
+        (('--repeat',), {'type': int, 'default': 3}),
+    ]),
+    'dashboard': (bench_dashboard, [
+        (('--bookings',), {'type': int, 'default': 20000}),
+        (('--pis',), {'type': int, 'default': 50}),
+        (('--users',), {'type': int, 'default': 20}),
+    ]),
+    'calendar_feed': (bench_calendar_feed, [
+        (('--bookings',), {'type': int, 'default': 50000}),
+        (('--repeat',), {'type': int, 'default': 5}),
+    ]),
+    'listing': (bench_listing, [
+        (('--bookings',), {'type': int, 'default': 50000}),
+        (('--repeat',), {'type': int, 'default': 3}),
+    ]),
+    'reports': (bench_reports, [
+        (('--bookings',), {'type': int, 'default': 50000}),
+        (('--pis',), {'type': int, 'default': 50}),
+    ]),
+    'session_items': (bench_session_items, [
+        (('--items',), {'type': int, 'default': 2000}),
+        (('--chunk',), {'type': int, 'default': 100}),
+    ]),
+    'logs': (bench_logs, [
+        (('--logs',), {'type': int, 'default': 5000}),
+    ]),
+    'json': (bench_json, [
+        (('--rows',), {'type': int, 'default': 20000}),
+        (('--values',), {'type': int, 'default': 100}),
+    ]),
+    'engine': (bench_engine, [
+        (('--writers',), {'type': int, 'default': 2}),
+        (('--readers',), {'type': int, 'default': 4}),
+        (('--seconds',), {'type': float, 'default': 5}),
+    ]),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    for name, (func, arguments) in BENCHMARKS.items():
+        p = subparsers.add_parser(name, help=func.__doc__.split('.')[0].strip())
+        for a, kw in arguments:
+            p.add_argument(*a, **kw)
+
+    args = parser.parse_args()
+
+    if args.benchmark is None:
+        parser.print_help()
+        sys.exit(1)
+
+    BENCHMARKS[args.benchmark][0](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,14 +26,66 @@
 # *
 # **************************************************************************
 
+import os
 import unittest
+import tempfile
+import sqlalchemy
 import datetime as dt
 from pprint import pprint
 
 from emhub.data import (DataManager, ImageSessionData, H5SessionData,
                         PytablesSessionData, DataLog)
+from emhub.data.imports import TestDataBase
 from emhub.data.imports.test import TestData
-from emhub.utils import datetime_to_isoformat
+from emhub.utils import datetime_to_isoformat, pretty_datetime
+
+
+# ------------------------ Testing helpers ------------------------------------
+def create_test_dm():
+    """ Create a DataManager in a new temporary folder with only the basic
+    testing data (admin user, forms and resources).
+    """
+    dm = DataManager(tempfile.mkdtemp(), cleanDb=True)
+    TestDataBase(dm)
+    return dm
+
+
+def create_test_user(dm, name, roles, pi_id=None):
+    return dm.create_user(username=name, email='%s@emhub.org' % name,
+                          phone='', password=name, name=name,
+                          roles=roles, pi_id=pi_id)
+
+
+def create_test_application(dm, creator, code='CEM00001', status='active',
+                            quota=None, noslot=None):
+    """ Create an application with the given creator (PI), the template
+    is created with the first application.
+    """
+    templates = dm.get_templates()
+    template = templates[0] if templates else dm.create_template(
+        title='Template', description='', status='active')
+    app = dm.create_application(
+        code=code, alias='', title='', description='', status=status,
+        template_id=template.id, invoice_address='',
+        resource_allocation={'quota': quota or {}, 'noslot': noslot or []})
+    app.creator_id = creator.id
+    dm.commit()
+    return app
+
+
+def create_test_client(dm, config=None):
+    """ Create the flask app for the DataManager folder and a test client
+    logged in as admin.
+    """
+    from unittest import mock
+    from emhub import create_app
+
+    with mock.patch.dict(os.environ, {'EMHUB_INSTANCE': dm._dataPath}):
+        app = create_app(config)
+    client = app.test_client()
+    client.post('/api/login', json={'username': 'admin',
+                                    'password': 'admin'})
+    return app, client
 
 
 class TestDataManager(unittest.TestCase):
@@ -141,6 +193,968 @@ class TestDataManager(unittest.TestCase):
         self.assertFalse(all(m.requires_slot for m in microscopes))
 
 
+class TestBookingsRange(unittest.TestCase):
+    """ Check range queries with a basic DataManager (only resources). """
+    @classmethod
+    def setUpClass(cls):
+        cls.dm = create_test_dm()
+        cls.day0 = dt.datetime(2030, 1, 7, 9, tzinfo=dt.timezone.utc)
+
+        for rid, s, e in [(1, 0, 1), (1, 3, 5), (1, 10, 12), (3, 2, 4)]:
+            cls.dm.create_booking(title='',
+                                  start=cls.day(s),
+                                  end=cls.day(e).replace(hour=23),
+                                  type='booking',
+                                  resource_id=rid)
+
+    @classmethod
+    def day(cls, n):
+        return cls.day0 + dt.timedelta(days=n)
+
+    def _range(self, s, e, resource=None):
+        bookings = self.dm.get_bookings_range(self.day(s), self.day(e),
+                                              resource=resource)
+        return [(b.resource_id, b.start) for b in bookings]
+
+    def test_overlap(self):
+        day = self.day
+        self.assertEqual(self._range(-5, -1), [])
+        self.assertEqual(self._range(1, 1), [(1, day(0))])
+        self.assertEqual(self._range(2, 2), [(3, day(2))])
+        self.assertEqual(self._range(4, 11),
+                         [(3, day(2)), (1, day(3)), (1, day(10))])
+        self.assertEqual(self._range(4, 11, resource=1),
+                         [(1, day(3)), (1, day(10))])
+        # Touching the end of a booking is also overlapping
+        self.assertEqual(self._range(5, 6, resource=1), [(1, day(3))])
+        # Bookings spanning over the whole range
+        self.assertEqual(self._range(11, 11), [(1, day(10))])
+
+    def test_query_plan(self):
+        query = self.dm._query_bookings_range(self.day(0), self.day(1),
+                                              resource=1)
+        sql = str(query.statement.compile(compile_kwargs={'literal_binds': True}))
+        with self.dm._db_engine.connect() as conn:
+            plan = ' '.join(str(r) for r in
+                            conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql))
+        self.assertIn('ix_bookings_resource_start_end', plan)
+
+
+class TestBookingIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dm = create_test_dm()
+        cls.day0 = dt.datetime(2030, 1, 7, 9, tzinfo=dt.timezone.utc)
+
+    def day(self, n, hour=9):
+        return (self.day0 + dt.timedelta(days=n)).replace(hour=hour)
+
+    def test_index(self):
+        dm = self.dm
+        v0 = dm.get_data_version('bookings')
+        b1 = dm.create_booking(title='', start=self.day(0), end=self.day(2),
+                               type='booking', resource_id=1)[0]
+        dm.create_booking(title='', start=self.day(0), end=self.day(5),
+                          type='slot', resource_id=1)
+        self.assertEqual(dm.get_data_version('bookings'), v0 + 2)
+
+        index = dm.get_booking_index()
+        self.assertEqual(len(index), 2)
+        self.assertEqual(dm.check_booking_index(), [])
+
+        # Overlapping booking should fail validation
+        with self.assertRaises(Exception):
+            dm.create_booking(title='', start=self.day(1), end=self.day(3),
+                              type='booking', resource_id=1)
+
+        # The index is updated with our own changes (no reload)
+        b3 = dm.create_booking(title='', start=self.day(3), end=self.day(4),
+                               type='booking', resource_id=1)[0]
+        self.assertIs(dm.get_booking_index(), index)
+        self.assertEqual(len(index.overlap(1, self.day(3), self.day(3))), 2)
+        self.assertEqual(index.overlap(1, self.day(3), self.day(3),
+                                       slots=False), [b3.id])
+
+        dm.update_booking(id=b1.id, start=self.day(6), end=self.day(7))
+        dm.delete_booking(id=b3.id)
+        self.assertEqual(index.overlap(1, self.day(6), self.day(6)), [b1.id])
+        self.assertEqual(dm.check_booking_index(), [])
+
+        # Simulate a change from other process, the outdated index is not
+        # used (nor reloaded) and overlaps are queried from the database
+        dm._db_session.execute(
+            sqlalchemy.text("UPDATE bookings SET resource_id=3 WHERE id=%d"
+                            % b1.id))
+        dm._db_session.execute(
+            sqlalchemy.text("UPDATE data_versions SET version=version+1 "
+                            "WHERE name='bookings'"))
+        dm._db_session.commit()
+        self.assertIsNone(dm.get_booking_index())
+        self.assertEqual(index.overlap(1, self.day(6), self.day(6)), [b1.id])
+        b4 = dm.create_booking(title='', start=self.day(6), end=self.day(7),
+                               type='booking', resource_id=1)[0]
+        b5 = dm.Booking(start=self.day(6, 12), end=self.day(6, 13),
+                        resource_id=3)
+        self.assertEqual([b.id for b in dm.get_bookings_overlap(b5)], [b1.id])
+        with self.assertRaises(Exception):
+            dm.create_booking(title='', start=self.day(6), end=self.day(7),
+                              type='booking', resource_id=3)
+
+        # The index is reloaded after BOOKING_INDEX_RELOAD seconds
+        dm.BOOKING_INDEX_RELOAD = 0
+        self.assertIs(dm.get_booking_index(), index)
+        self.assertEqual(index.overlap(1, self.day(6), self.day(6)), [b4.id])
+        self.assertEqual(dm.check_booking_index(), [])
+
+
+class TestRepeatingBookings(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dm = dm = create_test_dm()
+        cls.pi = create_test_user(dm, 'pi', ['pi'])
+        cls.app = create_test_application(dm, cls.pi, quota={'krios': 3},
+                                          noslot=[1])
+        cls.day0 = dt.datetime(2030, 1, 7, 9, tzinfo=dt.timezone.utc)
+
+    def day(self, n, hour=9):
+        return (self.day0 + dt.timedelta(days=n)).replace(hour=hour)
+
+    def create_series(self, startDay, endDay, stopDay, **kwargs):
+        return self.dm.create_booking(
+            title='', type='booking', resource_id=1, owner_id=self.pi.id,
+            start=self.day(startDay), end=self.day(endDay, 17),
+            repeat_value='weekly', repeat_stop=self.day(stopDay), **kwargs)
+
+    def test_series(self):
+        dm = self.dm
+        nBookings = len(dm.get_bookings())
+
+        # Series overlapping with itself should fail
+        with self.assertRaises(Exception):
+            self.create_series(0, 8, 30)
+
+        # Quota is exceeded by the series itself (4 days out of 3)
+        with self.assertRaises(Exception):
+            self.create_series(0, 0, 28)
+        self.assertEqual(len(dm.get_bookings()), nBookings)
+        self.assertEqual(dm.check_booking_index(), [])
+
+        bookings = self.create_series(0, 0, 21)
+        self.assertEqual(len(bookings), 3)
+        self.assertEqual(len({b.repeat_id for b in bookings}), 1)
+        self.assertTrue(all(b.application_id == self.app.id for b in bookings))
+        self.assertEqual(dm.check_booking_index(), [])
+
+        # No more quota left for a single booking
+        with self.assertRaises(Exception):
+            dm.create_booking(title='', type='booking', resource_id=1,
+                              owner_id=self.pi.id, start=self.day(1),
+                              end=self.day(1, 17))
+
+        # Moving the whole series one day later should not conflict
+        # with the current position of other bookings in the series
+        updated = dm.update_booking(id=bookings[0].id, modify_all='yes',
+                                    start=self.day(1), end=self.day(1, 17),
+                                    repeat_value='weekly')
+        self.assertEqual(len(updated), 3)
+        self.assertEqual([b.start.day for b in updated], [8, 15, 22])
+        self.assertEqual(dm.check_booking_index(), [])
+
+        self.assertEqual(dm.get_application_usage(self.app),
+                         {'microscope': 3, 'krios': 3, 'solna': 3})
+
+        dm.delete_booking(id=bookings[1].id, modify_all='yes')
+        self.assertEqual(len(dm.get_bookings()), nBookings + 1)
+        self.assertEqual(dm.check_booking_index(), [])
+        self.assertEqual(dm.get_application_usage(self.app)['krios'], 1)
+        self.assertEqual(dm.verify_quota_usage(), [])
+
+    def test_usage_ledger(self):
+        dm = self.dm
+        b = dm.create_booking(title='', type='booking', resource_id=1,
+                              owner_id=self.pi.id, start=self.day(60),
+                              end=self.day(61, 17))[0]
+        usage = dm.get_application_usage(self.app)
+        count = dm.count_booking_resources([self.app.id])[self.app.id]
+        self.assertEqual(usage['krios'], count[1])
+        self.assertEqual(dm.verify_quota_usage(), [])
+
+        dm.update_booking(id=b.id, start=self.day(60), end=self.day(60, 17))
+        self.assertEqual(dm.get_application_usage(self.app)['krios'],
+                         usage['krios'] - 1)
+
+        dm._db_session.execute(sqlalchemy.text(
+            "UPDATE quota_usage SET days=days+5 WHERE tag='krios'"))
+        dm.commit()
+        diffs = dm.verify_quota_usage()
+        self.assertEqual(len(diffs), 1)
+        self.assertEqual(diffs[0][2:], ('krios', usage['krios'] + 4,
+                                        usage['krios'] - 1))
+        dm.rebuild_quota_usage()
+        self.assertEqual(dm.verify_quota_usage(), [])
+
+        # Changing resource tags also updates the ledger, only for the
+        # rows of that resource (a wrong row of other resource is kept)
+        dm._db_session.execute(sqlalchemy.text(
+            "INSERT INTO quota_usage VALUES (%d, 2, '', 3)" % self.app.id))
+        dm.commit()
+        dm.update_resource(id=1, tags='microscope krios solna new')
+        self.assertIn('new', dm.get_application_usage(self.app))
+        dm.update_resource(id=1, tags='microscope krios solna')
+        dm.delete_booking(id=b.id)
+        self.assertEqual([d[:3] for d in dm.verify_quota_usage()],
+                         [(self.app.id, 2, '')])
+
+
+class TestLoadProfiles(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dm = dm = create_test_dm()
+        day0 = dt.datetime(2030, 1, 7, 9, tzinfo=dt.timezone.utc)
+        for i in range(4):
+            pi = create_test_user(dm, 'pi%d' % i, ['pi'])
+            create_test_application(dm, pi, code='CEM0000%d' % i, noslot=[4])
+            for j in range(3):
+                u = create_test_user(dm, 'user%d%d' % (i, j), ['user'],
+                                     pi_id=pi.id)
+                start = day0 + dt.timedelta(days=i * 3 + j)
+                dm.create_booking(title='', type='booking', resource_id=4,
+                                  owner_id=u.id, operator_id=pi.id,
+                                  start=start,
+                                  end=start + dt.timedelta(hours=8))
+
+    @staticmethod
+    def _touch(b):
+        """ Access the same relationships that booking_to_event does. """
+        pi = b.owner.get_pi()
+        a = b.application
+        return (b.resource.name, b.owner.name, pi and pi.name,
+                b.operator and b.operator.name, b.creator.name,
+                a and a.creator.name)
+
+    def test_calendar(self):
+        dm = self.dm
+        dm.close()  # Start with a new session and empty identity map
+        with dm.count_queries() as lazy:
+            events = [self._touch(b) for b in dm.get_bookings()]
+
+        dm.close()
+        with dm.count_queries(maxCount=7) as eager:
+            events2 = [self._touch(b) for b in dm.get_bookings(load='calendar')]
+
+        self.assertEqual(len(events), 12)
+        self.assertEqual(events, events2)
+        self.assertGreater(lazy.count, len(events))
+
+        dm.close()
+        with dm.count_queries(maxCount=7):
+            start = dt.datetime(2030, 1, 1, tzinfo=dt.timezone.utc)
+            bookings = dm.get_bookings_range(start, start + dt.timedelta(days=30),
+                                             load='report')
+            self.assertEqual([self._touch(b) for b in bookings], events)
+
+    def test_profiles(self):
+        dm = self.dm
+        with dm.count_queries(maxCount=1):
+            self.assertEqual(dm.get_sessions(load='session_list'), [])
+
+        with self.assertRaises(Exception):
+            dm.get_bookings(load='session_list')
+
+        with self.assertRaises(Exception):
+            dm.get_bookings(load='invalid')
+
+        with self.assertRaises(AssertionError):
+            with dm.count_queries(maxCount=0):
+                dm.get_bookings()
+
+    def test_pagination(self):
+        dm = self.dm
+        allIds = [b['id'] for b in dm.get_bookings(asJson=True)]
+
+        ids, pages, after_id = [], 0, None
+        while True:
+            with dm.count_queries(maxCount=1) as counter:
+                page = dm.get_bookings(asJson=True, attrs=['title'],
+                                       limit=5, after_id=after_id)
+            # Only the requested columns (and id) are selected
+            self.assertNotIn('resource_id', counter.statements[0])
+            ids.extend(b['id'] for b in page)
+            pages += 1
+            if len(page) < 5:
+                break
+            after_id = page[-1]['id']
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(ids, sorted(allIds))
+        self.assertEqual(set(page[0].keys()), {'id', 'title'})
+
+        # Non-column attributes fallback to full objects
+        apps = dm.get_applications(asJson=True, attrs=['code', 'pi_list'],
+                                   limit=2)
+        self.assertEqual(len(apps), 2)
+        self.assertEqual(set(apps[0].keys()), {'id', 'code', 'pi_list'})
+
+        with self.assertRaises(Exception):
+            dm.get_bookings(orderBy='start', limit=5)
+
+
+class TestBookingFrame(unittest.TestCase):
+    def test_frame(self):
+        dm = create_test_dm()
+        dm.update_resource(id=4, extra={'daily_cost': 100})
+        pi = create_test_user(dm, 'pi', ['pi'])
+        user = create_test_user(dm, 'user', ['user'], pi_id=pi.id)
+        day0 = dt.datetime(2030, 1, 30, 22, tzinfo=dt.timezone.utc)
+        for i, (owner, btype) in enumerate([(pi, 'booking'), (user, 'booking'),
+                                            (user, 'downtime'), (1, 'booking')]):
+            start = day0 + dt.timedelta(days=i * 2)
+            # Added without validation, owners have no applications
+            b = dm.Booking(title='', type=btype, resource_id=4,
+                           owner_id=getattr(owner, 'id', owner),
+                           creator_id=1, start=start,
+                           end=start + dt.timedelta(hours=4),
+                           slot_auth={}, extra={})
+            dm._db_session.add(b)
+        b.costs = [('extra', 'Some service', '50'), ('x', 'Invalid', 'a')]
+        dm.commit()
+
+        frame = dm.get_booking_frame()
+        bookings = dm.get_bookings(orderBy='start')
+        self.assertEqual(len(frame), len(bookings))
+        for i, b in enumerate(bookings):
+            pi_b = b.owner.get_pi()
+            self.assertEqual(frame['id'][i], b.id)
+            self.assertEqual(frame['days'][i], b.days)
+            self.assertEqual(frame['total_cost'][i], b.total_cost)
+            self.assertEqual(frame['pi_id'][i], pi_b.id if pi_b else 0)
+            self.assertEqual(frame['title'][i], b.title)
+            self.assertEqual(frame['operator_id'][i], b.operator_id or 0)
+
+        self.assertEqual(frame['days'].tolist(), [2, 2, 2, 2])
+        self.assertEqual(frame['month'].tolist(), [203001, 203002, 203002,
+                                                   203002])
+        bookings = frame.select(frame.is_type('booking'))
+        self.assertEqual(bookings.group_sum('pi_id'), {0: 1, pi.id: 2})
+        self.assertEqual(bookings.group_sum('pi_id', 'total_cost'),
+                         {0: 250, pi.id: 400})
+        self.assertEqual(bookings.group_sum(('pi_id', 'month'), 'days'),
+                         {(0, 203002): 2, (pi.id, 203001): 2,
+                          (pi.id, 203002): 2})
+        self.assertEqual(bookings.group_unique('pi_id', 'owner_id'),
+                         {0: {1}, pi.id: {pi.id, user.id}})
+        self.assertEqual(bookings.group_values('pi_id', 'id'),
+                         {0: [b.id], pi.id: bookings['id'][:2].tolist()})
+
+        start = day0 + dt.timedelta(days=3)
+        self.assertEqual(len(dm.get_booking_frame(start, start)), 0)
+        self.assertEqual(len(dm.get_booking_frame(start)), 2)
+        self.assertEqual(dm.get_booking_frame(start).group_sum('pi_id'),
+                         {0: 1, pi.id: 1})
+
+
+class TestDashboardDigest(unittest.TestCase):
+    def test_digest(self):
+        from types import SimpleNamespace
+        from emhub.data.data_content import DataContent
+
+        dm = create_test_dm()
+        pi = create_test_user(dm, 'pi', ['pi'])
+        user = create_test_user(dm, 'user', ['user'], pi_id=pi.id)
+        now = dm.now()
+
+        def _booking(owner, days, hours=4):
+            start = now + dt.timedelta(days=days)
+            b = dm.Booking(title='', type='booking', resource_id=4,
+                           owner_id=owner.id, creator_id=1, start=start,
+                           end=start + dt.timedelta(hours=hours),
+                           slot_auth={}, extra={})
+            dm._db_session.add(b)
+            dm.commit()
+            return b
+
+        def _version():
+            return dm.get_data_versions('bookings:upcoming')[0]
+
+        _booking(pi, -1, hours=30)  # in progress
+        b = _booking(user, 3)
+        _booking(user, 20)
+        other = _booking(dm.get_user_by(id=1), 2)
+        old = _booking(user, -60)
+        version = _version()
+        self.assertEqual(len(dm.get_bookings_range(
+            now, now + dt.timedelta(days=30))), 4)
+        self.assertEqual(len(dm.get_bookings_range(
+            now, now + dt.timedelta(days=30), owners=[pi.id, user.id])), 3)
+
+        # Changes of old bookings do not modify the upcoming version
+        old.title = 'Old booking'
+        dm.commit()
+        self.assertEqual(_version(), version)
+
+        dc = DataContent(SimpleNamespace(dm=dm))
+        digest = dc._DataContent__get_bookings_digest(user)
+        self.assertEqual([len(bList) for _, bList in digest['bookings']],
+                         [1, 1, 1])
+        with dm.count_queries(maxCount=1):
+            self.assertIs(dc._DataContent__get_bookings_digest(user), digest)
+
+        # Moving a booking out of the window, invalidates the cache
+        b.start += dt.timedelta(days=60)
+        b.end += dt.timedelta(days=60)
+        dm.commit()
+        self.assertGreater(_version(), version)
+        digest = dc._DataContent__get_bookings_digest(user)
+        self.assertEqual([len(bList) for _, bList in digest['bookings']],
+                         [1, 0, 1])
+
+
+class TestBookingEvents(unittest.TestCase):
+    def test_feed(self):
+        import json
+
+        dm = create_test_dm()
+        dm.create_form(name='config:bookings', definition={
+            'display': {'show_application': 'yes', 'show_operator': 'yes'}})
+        day0 = dt.datetime(2030, 1, 1, 9, tzinfo=dt.timezone.utc)
+        for i in range(10):
+            start = day0 + dt.timedelta(days=i)
+            dm._db_session.add(dm.Booking(
+                title='B%d' % i, type='booking', resource_id=i % 2 + 1,
+                owner_id=1, creator_id=1, start=start,
+                end=start + dt.timedelta(hours=4), slot_auth={}, extra={}))
+        dm.commit()
+
+        app, client = create_test_client(dm)
+
+        # Local time offsets of the range are converted to UTC, while other
+        # callers (e.g. booking payloads) still replace the offset by UTC
+        from emhub.utils import datetime_from_isoformat
+        value = '2030-01-03T01:00:00+01:00'
+        self.assertEqual(datetime_from_isoformat(value),
+                         dt.datetime(2030, 1, 3, 1, tzinfo=dt.timezone.utc))
+        self.assertEqual(datetime_from_isoformat(value, keepOffset=True),
+                         dt.datetime(2030, 1, 3, 0, tzinfo=dt.timezone.utc))
+        params = {'start': '2030-01-03T01:00:00+01:00',
+                  'end': '2030-01-06T00:00:00Z'}
+        r = client.get('/api/get_booking_events', query_string=params)
+        self.assertEqual([e['booking_title'] for e in json.loads(r.data)],
+                         ['B2', 'B3', 'B4'])
+        r2 = client.get('/api/get_booking_events',
+                        query_string=dict(params, resource_id=1))
+        self.assertEqual([e['booking_title'] for e in json.loads(r2.data)], ['B2', 'B4'])
+
+        etag = r.headers['ETag']
+        r = client.get('/api/get_booking_events', query_string=params,
+                       headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+
+        # Modifying bookings changes the ETag
+        client.post('/api/update_booking', json={'attrs': {
+            'id': 3, 'title': 'New title'}})
+        r = client.get('/api/get_booking_events', query_string=params,
+                       headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.data)[0]['booking_title'], 'New title')
+
+
+class TestBookingEventSerializer(unittest.TestCase):
+    def test_serializer(self):
+        import json
+        from types import SimpleNamespace
+        from emhub.data.data_content import DataContent
+
+        dm = create_test_dm()
+        dm.create_form(name='config:bookings', definition={
+            'display': {'show_application': 'yes', 'show_operator': 'no'}})
+        pis = [create_test_user(dm, 'pi%d' % i, ['pi']) for i in range(2)]
+        users = [create_test_user(dm, 'user%d' % i, ['user'], pi_id=pis[i].id)
+                 for i in range(2)]
+        app = create_test_application(dm, pis[0])
+
+        day0 = dt.datetime(2030, 1, 1, 9, tzinfo=dt.timezone.utc)
+        bookings = [
+            ('booking', 'Booking', users[0], app.id, 1),
+            ('booking', 'Booking no app', users[1], None, 2),
+            ('booking', 'cycle 12', users[1], app.id, 1),
+            ('slot', 'Slot', 1, None, 2),
+            ('downtime', 'Broken', 1, None, 1),
+            ('special', 'Special', pis[1], None, 3),
+            ('maintenance', 'Service', 1, None, 1),
+            ('booking', 'Missing resource', users[0], app.id, 999),
+        ]
+        for i, (btype, title, owner, app_id, rid) in enumerate(bookings):
+            start = day0 + dt.timedelta(days=i)
+            dm._db_session.add(dm.Booking(
+                title=title, type=btype, resource_id=rid,
+                owner_id=getattr(owner, 'id', owner), operator_id=pis[0].id,
+                application_id=app_id, creator_id=1, start=start,
+                end=start + dt.timedelta(hours=4),
+                slot_auth={'applications': ['CEM00001']}, extra={}))
+        dm.commit()
+        bookings = dm.get_bookings(orderBy='start')
+
+        for user in [dm.get_user_by(id=1), pis[0], pis[1], users[0], users[1]]:
+            dc = DataContent(SimpleNamespace(dm=dm, user=user))
+            for kwargs in [{}, {'prettyDate': True, 'piApp': True}]:
+                serializer = dc.booking_serializer(**kwargs)
+                events = json.dumps([serializer(b) for b in bookings])
+                legacy = json.dumps([_legacy_booking_to_event(dc, b, **kwargs)
+                                     for b in bookings])
+                self.assertEqual(events, legacy)
+                self.assertEqual(json.dumps(dc.booking_to_event(bookings[0],
+                                                                **kwargs)),
+                                 json.dumps(json.loads(legacy)[0]))
+
+
+class TestContentCache(unittest.TestCase):
+    def test_lru(self):
+        import sys
+        from emhub.data.data_cache import ContentCache
+
+        value = 'x' * 1000
+        size = sys.getsizeof(value)
+        cache = ContentCache(maxBytes=3 * size)
+        for k in 'abc':
+            cache.put(k, value)
+        self.assertEqual(cache.get('a'), value)  # 'b' is now the oldest
+        cache.put('d', value)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 3)
+        cache.put('big', 'x' * 4000)  # bigger than the cache, not stored
+        self.assertIsNone(cache.get('big'))
+
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                         (1, 2, 1))
+        self.assertEqual(stats['bytes'], 3 * size)
+
+    def test_get_content(self):
+        dm = create_test_dm()
+        app, client = create_test_client(
+            dm, {'CONTENT_CACHE_MAX_BYTES': 1024 * 1024})
+
+        def _get(**kwargs):
+            r = client.get('/get_content', query_string=dict(
+                content_id='resources_list', **kwargs))
+            return r.headers.get('X-Content-Cache'), r.data.decode()
+
+        status, html = _get()
+        self.assertEqual(status, 'miss')
+        self.assertEqual(_get(), ('hit', html))
+        self.assertEqual(_get(no_cache=1), ('bypass', html))
+
+        # Any change in the resources table invalidates the content
+        client.post('/api/update_resource', json={'attrs': {
+            'id': 1, 'name': 'Renamed resource'}})
+        status, html = _get()
+        self.assertEqual(status, 'miss')
+        self.assertIn('Renamed resource', html)
+
+        # Resource images are saved after the update, then the version
+        # is increased again (see handle_resource)
+        app.dm.bump_data_version('resources')
+        self.assertEqual(_get()[0], 'miss')
+
+        # Contents not declared as cacheable are not stored
+        r = client.get('/get_content', query_string={'content_id': 'dashboard'})
+        self.assertNotIn('X-Content-Cache', r.headers)
+
+        stats = app.content_cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+
+
+class TestConfigCache(unittest.TestCase):
+    def test_config(self):
+        dm = create_test_dm()
+
+        display = {'show_application': 'yes', 'show_operator': 'no'}
+        form = dm.create_form(name='config:bookings',
+                              definition={'display': display})
+        formId = form.id
+        dm.create_form(name='sessions_config', definition={'sections': [
+            {'label': 'data_deletion',
+             'params': [{'label': 'cem00001', 'value': 5}]}
+        ]})
+
+        self.assertEqual(dm.get_config('bookings')['display'], display)
+        self.assertEqual(dm.get_session_data_deletion('cem00001'), 5)
+        # Further reads should not hit the database
+        with dm.count_queries(maxCount=0):
+            for _ in range(100):
+                dm.get_config('bookings')
+                dm.get_session_data_deletion('cem00001')
+
+        # Our own changes are seen immediately
+        display = {'show_application': 'no', 'show_operator': 'yes'}
+        dm.update_form(id=formId, definition={'display': display})
+        self.assertEqual(dm.get_config('bookings')['display'], display)
+
+
+        # Changes from other process are seen after the version is checked
+        # again, i.e on next request, after closing the session
+        dm._db_session.execute(sqlalchemy.text(
+            "UPDATE forms SET definition='{\"display\": {}}' "
+            "WHERE name='config:bookings'"))
+        dm._db_session.execute(sqlalchemy.text(
+            "UPDATE data_versions SET version=version+1 WHERE name='forms'"))
+        dm._db_session.commit()
+        self.assertEqual(dm.get_config('bookings')['display'], display)
+        dm.close()
+        self.assertEqual(dm.get_config('bookings')['display'], {})
+
+        dm.delete_form(id=formId)
+        with self.assertRaises(Exception):
+            dm.get_config('bookings')
+
+
+class TestSessionCounters(unittest.TestCase):
+    def test_counters(self):
+        dm = create_test_dm()
+        self.assertEqual(dm.get_session_counter('fac'), 1)
+
+        # Reserving a counter is a single statement
+        with dm.count_queries(maxCount=1):
+            self.assertEqual(dm.next_session_counter('fac'), 1)
+        self.assertEqual(dm.next_session_counter('fac'), 2)
+        dm.commit()
+        self.assertEqual(dm.get_session_counter('fac'), 3)
+
+        # Reserved counters are released if the transaction is not committed
+        self.assertEqual(dm.next_session_counter('fac'), 3)
+        dm._db_session.rollback()
+        self.assertEqual(dm.get_session_counter('fac'), 3)
+
+        dm.update_session_counter('cem00001', 10)
+        dm.update_session_counter('cem00001', 5, onlyIncrease=True)
+        self.assertEqual(dm.get_session_counter('cem00001'), 10)
+        dm.update_session_counter('cem00001', 12, onlyIncrease=True)
+        self.assertEqual(dm.get_session_counter('cem00001'), 12)
+        dm.update_session_counter('cem00001', 5)
+        self.assertEqual(dm.get_session_counter('cem00001'), 5)
+
+        start = dm.now()
+        booking = dm.Booking(title='', type='booking', resource_id=1,
+                             owner_id=1, creator_id=1, start=start,
+                             end=start + dt.timedelta(hours=4),
+                             slot_auth={}, extra={})
+        dm._db_session.add(booking)
+        dm.commit()
+        info = dm.get_new_session_info(booking.id)
+        self.assertEqual(info['name'], 'fac00003')
+        session = dm.create_session(booking_id=booking.id)
+        self.assertEqual(session.name, 'fac00003')
+        self.assertEqual(dm.get_session_counter('fac'), 4)
+
+        dm.update_session(id=session.id, name='fac00020')
+        self.assertEqual(dm.get_session_counter('fac'), 21)
+        dm.update_session(id=session.id, name='fac00010')
+        self.assertEqual(dm.get_session_counter('fac'), 21)
+
+        # Updates that do not change the name don't touch the counters
+        with dm.count_queries() as queries:
+            dm.update_session(id=session.id, status='finished')
+        self.assertFalse(any('session_counters' in q
+                             for q in queries.statements))
+
+
+class TestPendingSessions(unittest.TestCase):
+    def test_wait(self):
+        import time
+        import threading
+
+        dm = create_test_dm()
+        start = dm.now()
+        for i in range(2):
+            dm._db_session.add(dm.Booking(
+                title='', type='booking', resource_id=1, owner_id=1,
+                creator_id=1, start=start, end=start + dt.timedelta(hours=4),
+                slot_auth={}, extra={}))
+        dm.commit()
+
+        # Waiting does not expire the objects already loaded
+        user = dm.get_user_by(id=1)
+        t = time.time()
+        self.assertEqual(dm.wait_pending_sessions(timeout=0.2), [])
+        self.assertGreaterEqual(time.time() - t, 0.2)
+        self.assertIn('username', user.__dict__)
+
+        def _create(dataManager, bookingId):
+            time.sleep(0.2)
+            dataManager.create_session(booking_id=bookingId)
+
+        # Sessions created by this process wake up the waiting one
+        thread = threading.Thread(target=_create, args=(dm, 1))
+        thread.start()
+        t = time.time()
+        sessions = dm.wait_pending_sessions(timeout=10, interval=5)
+        thread.join()
+        self.assertLess(time.time() - t, 2)
+        self.assertEqual([s.booking_id for s in sessions], [1])
+
+        # Sessions from other processes are noticed from the data version
+        dm.update_session(id=sessions[0].id, status='created')
+        dm2 = DataManager(dm._dataPath)
+        thread = threading.Thread(target=_create, args=(dm2, 2))
+        thread.start()
+        sessions = dm.wait_pending_sessions(timeout=10, interval=0.1)
+        thread.join()
+        self.assertEqual([s.booking_id for s in sessions], [2])
+
+
+class TestJsonStream(unittest.TestCase):
+    def test_iter_json(self):
+        import json
+        import flask
+        import numpy as np
+        from emhub.utils import NpJsonEncoder, iter_json, send_json_data
+
+        data = {'items': [{'id': i, 'extra': {'values': list(range(10))}}
+                          for i in range(1000)],
+                'matrix': np.arange(12.0).reshape(3, 4),
+                'vector': np.arange(10000), 'count': np.int64(3),
+                'scalar': np.array(1.5), 'empty': [], 1: 'int key'}
+        expected = json.dumps(data, cls=NpJsonEncoder)
+        chunks = list(iter_json(data, chunkSize=1000))
+        self.assertGreater(len(chunks), 5)
+        self.assertEqual(''.join(chunks), expected)
+
+        with flask.Flask(__name__).test_request_context():
+            resp = send_json_data(data)
+            self.assertFalse(resp.is_streamed)
+            resp = send_json_data(data, streamSize=1000)
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(resp.get_data(as_text=True), expected)
+            # Only large lists are streamed, other data is encoded at once
+            small = {'text': 'x' * 5000, 'items': list(range(100))}
+            resp = send_json_data(small, streamSize=1000)
+            self.assertFalse(resp.is_streamed)
+            self.assertEqual(resp.get_data(as_text=True),
+                             json.dumps(small))
+
+
+class TestRowSerializer(unittest.TestCase):
+    def test_listing(self):
+        from emhub.data.data_db import DbManager
+
+        dm = create_test_dm()
+        start = dm.now()
+        dm.create_invoice_period(start=start, end=start + dt.timedelta(days=3),
+                                 status='active')
+
+        def _legacy(obj):
+            return {c.key: DbManager.json_from_value(getattr(obj, c.key))
+                    for c in obj.__table__.c}
+
+        for name in ['users', 'resources', 'invoice_periods']:
+            getFunc = getattr(dm, 'get_%s' % name)
+            objects = getFunc()
+            self.assertEqual([o.json() for o in objects],
+                             [_legacy(o) for o in objects])
+            # Listings are built from rows, without loading any object
+            dm.close()
+            items = getFunc(asJson=True)
+            self.assertEqual(len(dm._db_session.identity_map), 0)
+            self.assertEqual(items, [_legacy(o) for o in getFunc()])
+
+        period = dm.get_invoice_periods(asJson=True, attrs=['start'])[0]
+        self.assertEqual(period, {'start': start.astimezone(
+            dt.timezone.utc).isoformat()})
+
+
+class TestHttpCaching(unittest.TestCase):
+    def test_validators(self):
+        import flask
+
+        dm = create_test_dm()
+        app, client = create_test_client(dm)
+
+        # Static URLs have the content hash and are cached for long
+        with app.test_request_context():
+            url = flask.url_for('static', filename='libs/css/emhub.css')
+        self.assertIn('?v=', url)
+        r = client.get(url)
+        self.assertTrue(r.cache_control.immutable)
+        self.assertGreater(r.cache_control.max_age, 0)
+        r = client.get('/static/libs/css/missing.css?v=1234')
+        self.assertEqual(r.status_code, 404)
+        self.assertFalse(r.cache_control.immutable)
+
+        # Thumbnails ETag needs the 'v' argument, bad ids are rejected
+        for args, status in [('', 400), ('resource_id=a', 400),
+                             ('resource_id=1', 404)]:
+            r = client.get('/images/resource_thumbnail?' + args)
+            self.assertEqual(r.status_code, status)
+
+        from PIL import Image
+        imagePath = dm.get_resource_image_path(dm.get_resource_by(id=1))
+        os.makedirs(os.path.dirname(imagePath), exist_ok=True)
+        Image.new('RGB', (256, 256)).save(imagePath, format='PNG')
+        r = client.get('/images/resource_thumbnail?resource_id=1')
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn('thumb-', r.headers['ETag'])
+        r = client.get('/images/resource_thumbnail?resource_id=1&v=10')
+        self.assertEqual(r.headers['ETag'], '"thumb-1-10"')
+
+        # Profile images and API reads are validated without DB queries
+        imageName = 'profile-image-000001.png'
+        with open(os.path.join(app.config['USER_IMAGES'], imageName), 'w') as f:
+            f.write('image')
+        dm.update_user(id=1, profile_image=imageName)
+
+        with app.test_request_context():
+            url = app.dc.user_profile_image(app.dm.get_user_by(id=1))
+        for url in [url, '/api/get_forms']:
+            r = client.get(url)
+            self.assertEqual(r.status_code, 200)
+            etag = r.headers['ETag']
+            # API reads only load the logged user and the data versions
+            maxCount = 0 if 'images' in url else 2
+            with app.dm.count_queries(maxCount=maxCount):
+                r = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(r.status_code, 304)
+
+        # Modified data changes the ETag
+        dm.create_form(name='new_form', definition={})
+        r = client.get('/api/get_forms', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+
+
+class TestUserPermissions(unittest.TestCase):
+    def test_permissions(self):
+        dm = create_test_dm()
+        u = create_test_user(dm, 'staff', ['user', 'staff-solna'])
+        self.assertTrue(u.is_staff)
+        self.assertEqual(u.staff_unit, 'solna')
+        self.assertFalse(u.is_manager)
+        self.assertFalse(u.is_application_manager)
+
+        # Permissions are computed once
+        with dm.count_queries(maxCount=0):
+            for _ in range(100):
+                self.assertFalse(u.is_admin or u.is_pi)
+                self.assertFalse(u.is_application_manager)
+
+        u.roles = ['developer']
+        self.assertTrue(u.is_manager and u.is_admin)
+        self.assertFalse(u.is_staff)
+        self.assertIsNone(u.staff_unit)
+
+        create_test_application(dm, u)
+        self.assertTrue(u.is_application_manager)
+        self.assertTrue(u.is_manager)
+
+    def test_access(self):
+        dm = create_test_dm()
+        pi = create_test_user(dm, 'pi', ['pi'])
+        member = create_test_user(dm, 'member', ['user'], pi_id=pi.id)
+        other = create_test_user(dm, 'other', ['pi'])
+        apps = [create_test_application(dm, pi, code='CEM0000%d' % i,
+                                        status=status)
+                for i, status in enumerate(['active', 'closed'])]
+
+        slot = dm.Booking(type='slot', slot_auth={'applications': ['CEM00001']})
+        # Only the first iteration loads users and applications
+        for i in range(100):
+            with dm.count_queries(maxCount=None if i == 0 else 0):
+                self.assertEqual(member.get_applications(), apps[:1])
+                self.assertEqual(member.get_applications('all'), apps)
+                self.assertTrue(member.has_application('CEM00001'))
+                self.assertTrue(all(a.allows_access(member) for a in apps))
+                self.assertFalse(apps[0].allows_access(other))
+                # Only active applications are allowed in slots
+                self.assertFalse(member.can_book_slot(slot))
+
+        self.assertEqual(member.get_access().pi_id, pi.id)
+        apps[1].status = 'active'
+        dm.commit()
+        self.assertTrue(member.can_book_slot(slot))
+
+        # PI list is cached and updated with pi_to_add/pi_to_remove
+        a = apps[0]
+        self.assertEqual(a.pi_ids, (pi.id,))
+        self.assertNotEqual(other.id, pi.id)  # reload expired user
+        with dm.count_queries(maxCount=0):
+            for _ in range(100):
+                self.assertTrue(a.has_pi(pi) and a.has_pi(pi.id))
+                self.assertFalse(a.has_pi(other))
+
+        dm.update_application(id=a.id, pi_to_add=[other.id])
+        self.assertEqual(a.pi_list, [pi, other])
+        self.assertEqual(a.json()['pi_list'], [pi.id, other.id])
+        dm.update_application(id=a.id, pi_to_remove=[other.id])
+        self.assertFalse(a.has_pi(other))
+        with self.assertRaises(Exception):
+            dm.update_application(id=a.id, pi_to_remove=[other.id])
+
+
+class TestResourceThumbnail(unittest.TestCase):
+    def test_thumbnail(self):
+        from PIL import Image
+
+        dm = create_test_dm()
+        r = dm.get_resource_by(id=1)
+        self.assertEqual(dm.get_resource_thumbnail(r), (None, None))
+
+        imagePath = dm.get_resource_image_path(r)
+        os.makedirs(os.path.dirname(imagePath), exist_ok=True)
+        Image.new('RGB', (512, 256)).save(imagePath, format='PNG')
+
+        path, version = dm.get_resource_thumbnail(r, create=False)
+        self.assertFalse(os.path.exists(path))
+        path, version = dm.get_resource_thumbnail(r)
+        with Image.open(path) as img:
+            self.assertEqual(img.size, (128, 64))
+
+        # A new image creates a new thumbnail and the old one is removed
+        Image.new('RGB', (256, 256)).save(imagePath, format='PNG')
+        os.utime(imagePath, (version + 10, version + 10))
+        path2, version2 = dm.get_resource_thumbnail(r)
+        self.assertEqual(version2, version + 10)
+        self.assertFalse(os.path.exists(path))
+        with Image.open(path2) as img:
+            self.assertEqual(img.size, (128, 128))
+
+
+class TestGridSlots(unittest.TestCase):
+    def test_slots(self):
+        dm = create_test_dm()
+        pucks = [dm.create_puck(label='P%d' % i, code='p%d' % i, color='red',
+                                dewar=1, cane=1, position=i, extra={})
+                 for i in range(1, 4)]
+        project = dm.create_project(title='Project', status='active',
+                                    user_id=dm._user.id)
+
+        def _row(puck, box, grids):
+            return {'puck_id': str(puck.id), 'box_position': str(box),
+                    'grid_position': grids}
+
+        def _slots(puck):
+            return [(s.box_position, s.grid_position, e.id, s.row_index)
+                    for s, e in dm.get_grid_slots([puck.id])]
+
+        table = [_row(pucks[0], 1, ['1', '2']), _row(pucks[1], 3, ['4']),
+                 {'puck_id': 'invalid'}, _row(pucks[0], 2, ['3'])]
+        entry = dm.create_entry(title='Storage', type='grids_storage',
+                                project_id=project.id, extra={'data': {
+                                    'grids_storage_table': table}})
+        self.assertEqual(_slots(pucks[0]), [(1, '1,2', entry.id, 0),
+                                            (2, '3', entry.id, 3)])
+        self.assertEqual(_slots(pucks[1]), [(3, '4', entry.id, 1)])
+
+        dm.update_entry(id=entry.id, extra={'data': {
+            'grids_storage_table': [_row(pucks[2], 5, ['1'])]}})
+        self.assertEqual(_slots(pucks[0]), [])
+        self.assertEqual(_slots(pucks[2]), [(5, '1', entry.id, 0)])
+
+        # The rebuild gives the same slots
+        self.assertEqual(dm.rebuild_grid_slots(), 1)
+        self.assertEqual(_slots(pucks[2]), [(5, '1', entry.id, 0)])
+
+        dm.delete_entry(id=entry.id)
+        self.assertEqual(_slots(pucks[2]), [])
+
+
 class TestSessionData(unittest.TestCase):
     def test_basic(self):
         setId = 1
@@ -182,6 +1196,57 @@ class TestSessionData(unittest.TestCase):
 
 
 
+class TestSessionItems(unittest.TestCase):
+    def test_batch(self):
+        import json
+        from unittest import mock
+
+        dm = create_test_dm()
+        start = dm.now()
+        dm._db_session.add(dm.Booking(
+            title='', type='booking', resource_id=1, owner_id=1, creator_id=1,
+            start=start, end=start + dt.timedelta(hours=4),
+            slot_auth={}, extra={}))
+        dm.commit()
+        session = dm.create_session(booking_id=1, create_data=True)
+
+        app, client = create_test_client(dm)
+
+        def _post(method, **attrs):
+            attrs.update(session_id=session.id, set_id='Micrographs_01')
+            r = client.post('/api/%s' % method, json={'attrs': attrs})
+            return json.loads(r.data)
+
+        _post('create_session_set')
+        items = [{'item_id': i + 1, 'location': 'mic%03d.mrc' % i,
+                  'ctfDefocus': 1.5 + i} for i in range(250)]
+        self.assertEqual(_post('add_session_items', items=items),
+                         {'items': {'count': 250}})
+        r = _post('update_session_items', items=[
+            {'item_id': 2, 'ctfDefocus': 0.5, 'coordinates': [[1, 2]]}])
+        self.assertEqual(r, {'items': {'count': 1}})
+
+        data = dm.load_session(session.id).data
+        mics = data.get_set_items('Micrographs_01',
+                                  attrList=['location', 'ctfDefocus'])
+        data.close()
+        self.assertEqual(len(mics), 250)
+        self.assertEqual(mics[1]['ctfDefocus'], 0.5)
+        self.assertEqual(mics[-1]['location'], 'mic249.mrc')
+
+        # Batch writes failing in the middle are not retried and the
+        # session data is closed (it can be opened again for writing)
+        from emhub.data.data_session import H5SessionData
+        with mock.patch.object(H5SessionData, 'add_set_item',
+                               side_effect=[None, OSError('disk')]) as add:
+            r = client.post('/api/add_session_items', json={'attrs': {
+                'session_id': session.id, 'set_id': 'Micrographs_01',
+                'items': [{'item_id': 300}, {'item_id': 301}]}})
+        self.assertEqual(r.status_code, 500)
+        self.assertEqual(add.call_count, 2)
+        dm.load_session(session.id, mode='a').data.close()
+
+
 class TestPytablesSessionData(unittest.TestCase):
     def test_basic(self):
         setId = 1
@@ -239,3 +1304,187 @@ class TestDataLog(unittest.TestCase):
         logs = dl.get_logs()
         self.assertEqual(2, len(logs))
         dl.close()
+
+    def test_buffered(self):
+        dbPath = os.path.join(tempfile.mkdtemp(), 'emhub-logs.sqlite')
+        dl = DataLog(dbPath, cleanDb=True, buffered=True,
+                     flushInterval=60, flushSize=10)
+
+        def _count():
+            with dl._db_engine.connect() as conn:
+                return conn.exec_driver_sql('SELECT COUNT(*) FROM logs').scalar()
+
+        for i in range(25):
+            dl.log(1, 'operation', 'test_log', i, value=i)
+
+        dl.flush()
+        self.assertEqual(25, _count())
+        stats = dl.get_stats()
+        self.assertEqual(stats['written'], 25)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertGreaterEqual(stats['flushes'], 3)  # batches of 10
+
+        logs = dl.get_logs()
+        self.assertEqual([l.args for l in logs], [[i] for i in range(25)])
+        self.assertEqual(logs[-1].kwargs, {'value': 24})
+
+        # Pending logs are written when stopping, buffered logs return
+        # the queued values
+        row = dl.log(1, 'operation', 'last_log')
+        self.assertEqual(row['name'], 'last_log')
+        dl.dispose()
+        self.assertEqual(26, len(DataLog(dbPath).get_logs()))
+
+    def test_buffered_errors(self):
+        dbPath = os.path.join(tempfile.mkdtemp(), 'emhub-logs.sqlite')
+        dl = DataLog(dbPath, cleanDb=True, buffered=True,
+                     flushInterval=60, flushSize=10, maxRetrySize=5)
+        with dl._db_engine.begin() as conn:
+            conn.exec_driver_sql('DROP TABLE logs')
+
+        # Rows that can not be written are retried, up to maxRetrySize
+        for i in range(8):
+            dl.log(1, 'operation', 'test_log', i)
+        dl.flush()
+        stats = dl.get_stats()
+        self.assertEqual((stats['errors'], stats['dropped']), (1, 3))
+        self.assertEqual(stats['queue_depth'], 5)
+
+        dl.Base.metadata.create_all(dl._db_engine)
+        dl.log(1, 'operation', 'test_log', 8)
+        dl.flush()
+        self.assertEqual([l.args for l in dl.get_logs()],
+                         [[i] for i in range(3, 9)])
+        self.assertEqual(dl.get_stats()['queue_depth'], 0)
+        dl.dispose()
+
+    def test_engine_options(self):
+        dbPath = os.path.join(tempfile.mkdtemp(), 'emhub-logs.sqlite')
+
+        def _pragma(dl, name):
+            with dl._db_engine.connect() as conn:
+                return conn.exec_driver_sql('PRAGMA %s' % name).scalar()
+
+        dl = DataLog(dbPath, cleanDb=True)
+        self.assertEqual('wal', _pragma(dl, 'journal_mode'))
+        self.assertEqual(30000, _pragma(dl, 'busy_timeout'))
+        dl.dispose()
+
+        dl = DataLog(dbPath, cleanDb=True,
+                     engineOptions={'journal_mode': 'DELETE',
+                                    'busy_timeout': 1000})
+        self.assertEqual('delete', _pragma(dl, 'journal_mode'))
+        self.assertEqual(1000, _pragma(dl, 'busy_timeout'))
+        dl.dispose()
+
+
+def _legacy_booking_to_event(self, booking, **kwargs):
+    """ Previous implementation of DataContent.booking_to_event, used to
+    verify that BookingEventSerializer returns the same events. """
+    resource = booking.resource
+    # Bookings should have resources, just in case an erroneous one
+    if resource is None:
+        resource = self.app.dm.Resource(
+            name='Error: MISSING',
+            status='inactive',
+            tags='',
+            image='',
+            color='rgba(256, 256, 256, 1.0)',
+            extra={})
+
+    owner = booking.owner
+    owner_name = owner.name
+    operator = booking.operator  # shortcut
+    if operator:
+        operator_dict = {'id': operator.id, 'name': operator.name}
+    else:
+        operator_dict = {'id': None, 'name': ''}
+
+    creator = booking.creator
+    a = booking.application
+    user = self.app.user
+    dm = self.app.dm
+    b_title = booking.title
+    b_description = booking.description
+
+    user_can_book = False
+    # Define which users are allowed to modify the booking
+    # - managers
+    # - application creators
+    # - the owner and pi of the owner
+    can_modify_list = [owner.id]
+
+    if a is not None:
+        can_modify_list.append(a.creator.id)
+
+    if user.is_manager and (a is None or a.allows_access(user)):
+        can_modify_list.append(user.id)
+
+    pi = owner.get_pi()
+    if pi is not None:
+        can_modify_list.append(pi.id)
+
+    user_can_modify = user.id in can_modify_list
+    user_can_view = user_can_modify or user.same_pi(owner)
+    color = resource.color if resource else 'grey'
+
+    application_label = 'None'
+
+    if booking.type == 'special':
+        color = 'rgba(98,50,45,1.0)'
+        title = "%s (SPECIAL): %s" % (resource.name, b_title)
+    if booking.type == 'downtime':
+        color = 'rgba(181,4,0,1.0)'
+        title = "%s (DOWNTIME): %s" % (resource.name, b_title)
+    if booking.type == 'maintenance' or any(k in b_title for k in ['cycle', 'installation', 'maintenance', 'afis']):
+        color = 'rgba(255,107,53,1.0)'
+        title = "%s (MAINTENANCE): %s" % (resource.name, b_title)
+    elif booking.type == 'slot':
+        color = color.replace('1.0', '0.5')  # transparency for slots
+        title = "%s (SLOT): %s" % (resource.name,
+                                   booking.slot_auth.get('applications', ''))
+        user_can_book = user.can_book_slot(booking)
+    else:
+        # Show all booking information in title in some cases only
+        display = dm.get_config('bookings')['display']
+        emptyApp = a is None or display['show_application'] == 'no'
+        appStr = '' if emptyApp else ', %s' % a.code
+        emptyOp = operator is None or display['show_operator'] == 'no'
+        opStr = '' if emptyOp else ' -> ' + operator.name
+        extra = "%s%s%s" % (owner.name, appStr, opStr)
+        if user_can_view:
+            title = "%s (%s) %s" % (resource.name, extra, b_title)
+            if a:
+                application_label = a.code
+                if a.alias:
+                    application_label += "  (%s)" % a.alias
+        else:
+            title = "%s (%s)" % (resource.name, extra)
+            b_title = "Hidden title"
+            b_description = "Hidden description"
+
+    bd = {
+        'id': booking.id,
+        'title': title,
+        'resource': {'id': resource.id},
+        'start': datetime_to_isoformat(booking.start),
+        'end': datetime_to_isoformat(booking.end),
+        'color': color,
+        'textColor': 'white',
+        'booking_title': b_title,
+    }
+
+    if kwargs.get('prettyDate', False):
+        bd['pretty_start'] = pretty_datetime(booking.start)
+        bd['pretty_end'] = pretty_datetime(booking.end)
+
+    if kwargs.get('piApp', False):
+        if pi is not None:
+            bd['pi_id'] = pi.id
+            bd['pi_name'] = pi.name
+
+        app = booking.application
+        if app is not None:
+            bd['app_id'] = app.id
+
+    return bd
@@ -24,7 +24,10 @@
 # *
 # **************************************************************************
 
+import os
 import json
+import hashlib
+import functools
 import datetime as dt
 import numpy as np
 
@@ -61,11 +64,17 @@ def pretty_quarter(quarter):
                         qe.strftime('%b %Y'))
 
 
-def datetime_from_isoformat(iso_string):
-    """ Parse the input string and handle ending Z and assume UTC. """
+def datetime_from_isoformat(iso_string, keepOffset=False):
+    """ Parse the input string and handle ending Z and assume UTC.
+    If keepOffset is True, a time zone offset in the string is honoured
+    (converting the datetime to UTC) instead of being replaced by UTC.
+    """
     dt_string = iso_string.replace('Z', '+00:00').replace('+0000', '+00:00')
+    d = dt.datetime.fromisoformat(dt_string)
 
-    return dt.datetime.fromisoformat(dt_string).replace(tzinfo=dt.timezone.utc)
+    if keepOffset and d.tzinfo is not None:
+        return d.astimezone(dt.timezone.utc)
+    return d.replace(tzinfo=dt.timezone.utc)
 
 
 def datetime_to_isoformat(input_dt):
@@ -106,13 +115,182 @@ class NpJsonEncoder(json.JSONEncoder):
         return super(NpJsonEncoder, self).default(obj)
 
 
-def send_json_data(data):
+# JSON responses bigger than this (in characters) are streamed in chunks
+JSON_STREAM_SIZE = 1024 * 1024
+
+_JSON_KEY_TYPES = (str, int, float, bool, type(None))
+
+
+def iter_json(data, chunkSize=64 * 1024, depth=2):
+    """ Encode data as JSON (same output as json.dumps with NpJsonEncoder),
+    yielding chunks of about chunkSize characters.
+    Lists and NumPy arrays are encoded in slices of items (arrays by rows)
+    and dicts in the first depth levels value by value, so the whole JSON
+    string is never in memory.
+    """
+    encode = NpJsonEncoder().encode
+    chunk, size = [], 0
+
+    for piece in _iter_json_pieces(data, encode, depth):
+        chunk.append(piece)
+        size += len(piece)
+        if size >= chunkSize:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _iter_json_pieces(obj, encode, depth, sliceSize=256):
+    if isinstance(obj, np.ndarray) and obj.ndim > 1:
+        yield '['
+        for i, row in enumerate(obj):
+            if i:
+                yield ', '
+            yield from _iter_json_pieces(row, encode, depth)
+        yield ']'
+    elif isinstance(obj, np.ndarray) and obj.ndim == 1:
+        # Convert vectors in slices, not with a single tolist()
+        yield from _iter_json_slices(obj, lambda s: encode(s.tolist()), 4096)
+    elif isinstance(obj, (list, tuple)) and len(obj) > sliceSize:
+        yield from _iter_json_slices(obj, encode, sliceSize)
+    elif (depth > 0 and isinstance(obj, dict)
+          and all(isinstance(k, _JSON_KEY_TYPES) for k in obj)):
+        yield '{'
+        for i, (k, v) in enumerate(obj.items()):
+            # Non-string keys are converted as json.dumps does
+            key = encode(k if isinstance(k, str) else encode(k))
+            yield ', %s: ' % key if i else '%s: ' % key
+            yield from _iter_json_pieces(v, encode, depth - 1)
+        yield '}'
+    else:
+        yield encode(obj)
+
+
+def _iter_json_slices(items, encodeSlice, sliceSize):
+    """ Encode a sequence in slices of sliceSize items. """
+    yield '['
+    for i in range(0, len(items), sliceSize):
+        if i:
+            yield ', '
+        yield encodeSlice(items[i:i + sliceSize])[1:-1]
+    yield ']'
+
+
+def send_json_data(data, streamSize=JSON_STREAM_SIZE):
+    """ Return a JSON response with the data. Large lists (or dicts with
+    them) that are estimated bigger than streamSize characters are sent
+    in chunks while encoding them. The first streamSize characters are
+    encoded before the response starts, later errors truncate the JSON.
+    """
     import flask
-    resp = flask.make_response(json.dumps(data, cls=NpJsonEncoder))
+    chunks = None
+
+    if _json_size_estimate(data) < streamSize:
+        head = [json.dumps(data, cls=NpJsonEncoder)]
+    else:
+        chunks = iter_json(data)
+        head, size = [], 0
+
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= streamSize:
+                break
+        else:  # Smaller than estimated, send it in a single piece
+            chunks = None
+
+    if chunks is None:
+        resp = flask.make_response(''.join(head))
+    else:
+        def _generate():
+            yield from head
+            yield from chunks
+        resp = flask.Response(flask.stream_with_context(_generate()))
+
     resp.status_code = 200
     resp.headers['Access-Control-Allow-Origin'] = '*'
     return resp
 
 
+def _json_size_estimate(obj, depth=1, sampleSize=256):
+    """ Estimate the JSON size of lists (from a sample of sampleSize items)
+    and arrays, also as values of a dict. Other values are not estimated.
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.size * 8
+    elif isinstance(obj, (list, tuple)) and len(obj) > sampleSize:
+        sample = json.dumps(obj[:sampleSize], cls=NpJsonEncoder)
+        return len(sample) * len(obj) // sampleSize
+    elif depth > 0 and isinstance(obj, dict):
+        return sum(_json_size_estimate(v, depth - 1) for v in obj.values())
+    return 0
+
+
 def send_error(msg):
     return send_json_data({'error': msg})
+
+
+# ------------------------- HTTP caching --------------------------------------
+def file_version(path, cache):
+    """ Return a short hash of the file content (None if the file does not
+    exist), to be used in URLs that change when the file changes.
+    Hashes are stored in the cache dict while the file mtime is the same.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+
+    cached = cache.get(path, None)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = cache[path] = (mtime,
+                                    hashlib.md5(f.read()).hexdigest()[:12])
+    return cached[1]
+
+
+def not_modified(etag):
+    """ Return a 304 (Not Modified) response with the etag if the request
+    already has it (If-None-Match), or None otherwise. """
+    import flask
+    if not flask.request.if_none_match.contains_weak(etag):
+        return None
+    resp = flask.Response(status=304)
+    resp.set_etag(etag)
+    return resp
+
+
+def versioned_get(*tables):
+    """ Decorator for views that only read data from the given tables.
+    GET responses have a weak ETag computed from the data versions of the
+    tables, the user and the request, so when the client already has the
+    current one, 304 (Not Modified) is returned without calling the view.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            import flask
+            request = flask.request
+            if request.method != 'GET':
+                return func(*args, **kwargs)
+
+            app = flask.current_app
+            user = app.user
+            etag = hashlib.sha1(repr((
+                getattr(user, 'id', None), request.full_path,
+                request.get_data(),
+                app.dm.get_data_versions(*tables))).encode()).hexdigest()
+
+            if request.if_none_match.contains_weak(etag):
+                resp = flask.Response(status=304)
+            else:
+                resp = flask.make_response(func(*args, **kwargs))
+            resp.set_etag(etag, weak=True)
+            # Cached by the browser but validated on every request
+            resp.cache_control.private = True
+            resp.cache_control.no_cache = True
+            return resp
+        return wrapper
+    return decorator
@@ -24,6 +24,7 @@
 # *
 # **************************************************************************
 
+import os
 import io
 import numpy as np
 import base64
@@ -95,6 +96,18 @@ class Base64Converter:
 
         return result
 
+
+def create_thumbnail(inputPath, outputPath, max_size=(128, 128)):
+    """ Write a PNG thumbnail of the input image to outputPath.
+    The file is first written with a temporary name and then renamed,
+    so other processes never read a partially written thumbnail.
+    """
+    tmpPath = '%s.%d.tmp' % (outputPath, os.getpid())
+    with Image.open(inputPath) as img:
+        img.thumbnail(max_size)
+        img.save(tmpPath, format='PNG')
+    os.replace(tmpPath, outputPath)
+
 #
 # def fn_to_blob(filename):
 #     """ Read the image filename as a PIL image